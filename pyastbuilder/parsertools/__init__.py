@@ -21,6 +21,15 @@ class ParsertoolsException(Exception):
 class NoPrefixError(ParsertoolsException):
     pass
 
+class GeneratorException(ParsertoolsException):
+    pass
+
+class ParseTimeoutError(ParsertoolsException):
+    pass
+
+class SelectorException(ParsertoolsException):
+    pass
+
 print('parsertools version {}, build {}'.format(open(versionfilepath).read().strip(), buildno))
 
 
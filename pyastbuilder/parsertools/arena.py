@@ -0,0 +1,382 @@
+'''
+Array-backed storage for parse trees. A ParseArena holds a complete parse tree in a few flat arrays, with one entry per element, instead of
+in one ParseStruct object per element. Elements are identified by their index in the arrays. The root has index 0, and the children of an
+element have consecutive indices. For every element the arrays hold:
+
+- the id of its class (an index in a table of classes),
+- the index of its parent (-1 for the root),
+- the index of its first child, and its number of children,
+- the id of its label (an index in a table of labels, with 0 for no label),
+- the range of its tokens, the strings in its items and in those of its descendants, in a token array shared by the whole tree,
+- the id of its other attributes, such as the prefixes of a SPARQL element (an index in a table of attribute dicts, in which equal
+  attributes are stored once).
+
+Traversal, searching, ancestor lookup and rendering work on these arrays, and do not create an object per element. The rendering of an
+element, for instance, is the join of its range in the token array.
+
+ParseArena objects are built from a parsed ParseStruct tree, which can be discarded afterwards. ArenaElement objects are lightweight,
+read-only views of a single element, that offer the ParseStruct methods for inspecting a tree. They are created on demand. A real ParseStruct
+tree for (part of) the arena can be obtained with getElement().
+'''
+
+from array import array
+import sys
+
+from pyparsing import ParseException
+from parsertools.base import ParseStruct, _spanStrings, _isShared
+
+def _freeze(value):
+    '''Returns a hashable key for value, that is equal for equal dicts with the same order of keys, and for equal hashable values. Other
+    values are compared by identity.'''
+    if isinstance(value, dict):
+        return (dict,) + tuple((k, _freeze(v)) for (k, v) in value.items())
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return (id, id(value))
+
+class ParseArena:
+    '''Holds a parse tree in flat arrays (see the module documentation). The argument is the ParseStruct element at the root of the tree.
+    Compact elements (see ParseStruct.compact) are stored as the chains of elements they stand for, without being expanded.
+    The methods take and return element indices. Use getView for ArenaElement views.'''
+
+    def __init__(self, element):
+        assert isinstance(element, ParseStruct), type(element)
+        self._classes = []
+        self._labelNames = [None]
+        self._attributes = []
+        self._strings = []
+        self._types = array('H')
+        self._parents = array('i')
+        self._firstChildren = array('i')
+        self._childCounts = array('i')
+        self._labels = array('H')
+        self._tokenStarts = array('i')
+        self._tokenEnds = array('i')
+        self._attributeIds = array('i')
+        self._tokens = array('i')
+        self._store(self._flatten(element))
+
+    def _flatten(self, element):
+        '''Returns a nested record for element and its descendants, and fills the token array. A record is a list with the class, label id,
+        attributes id, token range, and the records of the children of an element. The chain of a compact element results in a record for
+        every element in the chain.'''
+        classIds = {}
+        labelIds = {None: 0}
+        attributeIds = {}
+        stringIds = {}
+
+        def record(class_, label, attributes, parent):
+            if not class_ in classIds:
+                classIds[class_] = len(self._classes)
+                self._classes.append(class_)
+            if not label in labelIds:
+                labelIds[label] = len(self._labelNames)
+                self._labelNames.append(label)
+            result = [classIds[class_], labelIds[label], attributes, len(self._tokens), None, []]
+            if parent is not None:
+                parent[5].append(result)
+            return result
+
+        # Keys of attribute values by their id. Children often share the values of their parent, and the tree keeps the values alive.
+        frozenValues = {}
+
+        def freeze(value):
+            if not id(value) in frozenValues:
+                frozenValues[id(value)] = _freeze(value)
+            return frozenValues[id(value)]
+
+        def attributesId(element):
+            attributes = element._getAttributes()
+            key = tuple((k, freeze(v)) for (k, v) in attributes.items())
+            if not key in attributeIds:
+                attributeIds[key] = len(self._attributes)
+                self._attributes.append(attributes)
+            return attributeIds[key]
+
+        root = None
+        # Stack of (item, record of its parent), and of (None, record) to mark the end of the items of a record
+        todo = [(element, None)]
+        while todo:
+            item, parent = todo.pop()
+            if item is None:
+                parent[4] = len(self._tokens)
+            elif isinstance(item, str):
+                if not item in stringIds:
+                    stringIds[item] = len(self._strings)
+                    self._strings.append(sys.intern(item))
+                self._tokens.append(stringIds[item])
+            else:
+                assert isinstance(item, ParseStruct), type(item)
+                # Shared elements get the attributes of their parent, as when they are replaced (see Parser.setShared)
+                attributes = parent[2] if _isShared(item) else attributesId(item)
+                records = [record(item.__class__, item._label, attributes, parent)]
+                if item._chain is None:
+                    items = item._items
+                else:
+                    for class_, label in item._chain:
+                        records.append(record(class_, label, attributes, records[-1]))
+                    items = item._chainItems
+                if item._source is not None:
+                    items = _spanStrings(items, item._source)
+                if root is None:
+                    root = records[0]
+                todo.extend((None, r) for r in records)
+                todo.extend((i, records[-1]) for i in reversed(items))
+        return root
+
+    def _store(self, root):
+        '''Fills the arrays from the records returned by _flatten, numbering the elements breadth first.'''
+        order = [root]
+        self._parents.append(-1)
+        for index, (type_, label, attributes, tokenStart, tokenEnd, children) in enumerate(order):
+            self._types.append(type_)
+            self._labels.append(label)
+            self._attributeIds.append(attributes)
+            self._tokenStarts.append(tokenStart)
+            self._tokenEnds.append(tokenEnd)
+            self._firstChildren.append(len(order))
+            self._childCounts.append(len(children))
+            self._parents.extend([index] * len(children))
+            order.extend(children)
+
+    def __len__(self):
+        '''Returns the number of elements.'''
+        return len(self._types)
+
+    def getClass(self, index):
+        '''Returns the ParseStruct subclass of the element.'''
+        return self._classes[self._types[index]]
+
+    def getLabel(self, index):
+        '''Returns the label of the element, or None.'''
+        return self._labelNames[self._labels[index]]
+
+    def getAttributes(self, index):
+        '''Returns the attributes of the element other than its items, label and parent, as a dict. The dict is shared with other elements.'''
+        return self._attributes[self._attributeIds[index]]
+
+    def getParent(self, index):
+        '''Returns the index of the parent of the element, or None for the root.'''
+        parent = self._parents[index]
+        return None if parent < 0 else parent
+
+    def getChildren(self, index):
+        '''Returns the indices of the children of the element, as a range.'''
+        first = self._firstChildren[index]
+        return range(first, first + self._childCounts[index])
+
+    def getAncestors(self, index):
+        '''Returns the indices of the ancestors of the element, starting with its parent and ending with the root.'''
+        result = []
+        parents = self._parents
+        index = parents[index]
+        while index >= 0:
+            result.append(index)
+            index = parents[index]
+        return result
+
+    def getItems(self, index):
+        '''Returns the items of the element: a list of strings and of the indices of its children, in the order of the ParseStruct items.
+        The strings that are not part of a child are the tokens in the range of the element that are not in the range of a child.'''
+        result = []
+        position = self._tokenStarts[index]
+        for child in self.getChildren(index):
+            start = self._tokenStarts[child]
+            result.extend(self._strings[t] for t in self._tokens[position:start])
+            result.append(child)
+            position = self._tokenEnds[child]
+        result.extend(self._strings[t] for t in self._tokens[position:self._tokenEnds[index]])
+        return result
+
+    def getString(self, index):
+        '''Returns the rendering of the element, equal to that of the corresponding ParseStruct element.'''
+        strings = self._strings
+        return ' '.join([s for s in map(strings.__getitem__, self._tokens[self._tokenStarts[index]:self._tokenEnds[index]]) if s != ''])
+
+    def iterIndices(self, index=0):
+        '''Yields the indices of the element and all its descendants, in document order (depth first).'''
+        firstChildren = self._firstChildren
+        childCounts = self._childCounts
+        stack = [index]
+        while stack:
+            index = stack.pop()
+            yield index
+            first = firstChildren[index]
+            stack.extend(range(first + childCounts[index] - 1, first - 1, -1))
+
+    def searchElements(self, index=0, *, label=None, element_type=None, value=None, labeledOnly=False):
+        '''Returns the indices of the elements that ParseStruct.searchElements would return for the element at index, with the same arguments.'''
+        labelId = self._labelNames.index(label) if label in self._labelNames else -1
+        typeId = self._classes.index(element_type) if element_type in self._classes else -1
+        if label and labelId < 0 or element_type and typeId < 0:
+            return []
+        labels = self._labels
+        types = self._types
+        parsed = {}
+        result = []
+        for i in [index] + list(self.iterIndices(index)):
+            if labeledOnly and not labels[i]:
+                continue
+            if label and labels[i] != labelId:
+                continue
+            if element_type and types[i] != typeId:
+                continue
+            if value:
+                class_ = self.getClass(i)
+                if not class_ in parsed:
+                    try:
+                        parsed[class_] = str(class_._parse(value, parseAll=False))
+                    except ParseException:
+                        parsed[class_] = None
+                if parsed[class_] is None or parsed[class_] != self.getString(i):
+                    continue
+            result.append(i)
+        return result
+
+    def dump(self, index=0, indent='', step='|  '):
+        '''Returns the dump of the element, equal to that of the corresponding ParseStruct element (see ParseStruct.dump).'''
+        result = []
+        stack = [(index, indent)]
+        while stack:
+            item, indent = stack.pop()
+            if isinstance(item, str):
+                result.append(indent + item + '\n')
+                continue
+            label = self.getLabel(item)
+            result.append(indent + ('> ' + label + ':\n' + indent if label else '') + '[' + self.getClass(item).__name__ + '] ' + '/' + self.getString(item) + '/' + '\n')
+            stack.extend((i, indent + step) for i in reversed(self.getItems(item)))
+        return ''.join(result)
+
+    def getElement(self, index=0):
+        '''Returns a new ParseStruct tree for the element and its descendants. Its root has no parent.'''
+        root = self.getClass(index)(None)
+        root.__setstate__(dict(self.getAttributes(index), _label=self.getLabel(index)))
+        # Stack of (index, element), of elements whose items still contain indices
+        stack = [(index, root)]
+        while stack:
+            index, element = stack.pop()
+            items = self.getItems(index)
+            for position, item in enumerate(items):
+                if not isinstance(item, str):
+                    child = self.getClass(item)(None)
+                    child.__setstate__(dict(self.getAttributes(item), _label=self.getLabel(item), _parent=element))
+                    items[position] = child
+                    stack.append((item, child))
+            element.__setstate__({'_items': items})
+        return root
+
+    def getView(self, index=0):
+        '''Returns an ArenaElement view of the element.'''
+        return ArenaElement(self, index)
+
+
+class ArenaElement:
+    '''Read-only view of an element in a ParseArena. It offers the methods of ParseStruct for inspecting a parse tree, which work on the
+    arrays of the arena. Views are created on demand, so two views of the same element are equal but not identical.
+    Use getElement() for a ParseStruct tree that can be changed.'''
+
+    __slots__ = ('_arena', '_index')
+
+    def __init__(self, arena, index):
+        object.__setattr__(self, '_arena', arena)
+        object.__setattr__(self, '_index', index)
+
+    def __getattr__(self, att):
+        '''Retrieves the view of the unique child having a label equal to the argument, as ParseStruct.__getattr__ does.'''
+        if not att.startswith('_'):
+            values = self.getValuesForLabel(att)
+            if len(values) == 1:
+                return values[0]
+        raise AttributeError('No attribute, or unique label found for argument "{}".'.format(att))
+
+    def __setattr__(self, label, value):
+        raise AttributeError('Direct setting of attributes not allowed. Arena elements are read-only.')
+
+    def __eq__(self, other):
+        '''Compares the class and the rendering with those of another view, as ParseStruct.__eq__ does for elements.'''
+        return isinstance(other, ArenaElement) and self.getClass() == other.getClass() and str(self) == str(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        '''Returns a hash of the class and the rendering, as ParseStruct.__hash__ does for elements.'''
+        return hash((self.getClass(), str(self)))
+
+    def __repr__(self):
+        return self.getClass().__name__ + '("' + str(self) + '")'
+
+    def __str__(self):
+        return self._arena.getString(self._index)
+
+    def _view(self, index):
+        return None if index is None else ArenaElement(self._arena, index)
+
+    def getArena(self):
+        '''Returns the ParseArena of the element.'''
+        return self._arena
+
+    def getIndex(self):
+        '''Returns the index of the element in its ParseArena.'''
+        return self._index
+
+    def getClass(self):
+        '''Returns the ParseStruct subclass of the element.'''
+        return self._arena.getClass(self._index)
+
+    def getLabel(self):
+        return self._arena.getLabel(self._index)
+
+    def getItems(self):
+        '''Returns the items of the element, with views for its children.'''
+        return [item if isinstance(item, str) else self._view(item) for item in self._arena.getItems(self._index)]
+
+    def getLabels(self):
+        '''Returns a list of all labels from the children.'''
+        return [label for label in map(self._arena.getLabel, self._arena.getChildren(self._index)) if label]
+
+    def hasLabel(self, k):
+        return k in self.getLabels()
+
+    def getValuesForLabel(self, k):
+        '''Returns the views of all children with k as label.'''
+        return [self._view(i) for i in self._arena.getChildren(self._index) if self._arena.getLabel(i) == k]
+
+    def getChildren(self):
+        return [self._view(i) for i in self._arena.getChildren(self._index)]
+
+    def getParent(self):
+        return self._view(self._arena.getParent(self._index))
+
+    def getAncestors(self):
+        return [self._view(i) for i in self._arena.getAncestors(self._index)]
+
+    def searchElements(self, *, label=None, element_type=None, value=None, labeledOnly=False):
+        '''Returns views of the elements that ParseStruct.searchElements would return.'''
+        return [self._view(i) for i in self._arena.searchElements(self._index, label=label, element_type=element_type, value=value, labeledOnly=labeledOnly)]
+
+    def isBranch(self):
+        return len(self._arena.getItems(self._index)) > 1
+
+    def isAtom(self):
+        items = self._arena.getItems(self._index)
+        return len(items) == 1 and isinstance(items[0], str)
+
+    def descend(self):
+        '''Descends until either an atom or a branch node is encountered; returns that node.'''
+        result = self
+        while not result.isAtom() and not result.isBranch():
+            result = result.getChildren()[0]
+        return result
+
+    def dump(self, indent='', step='|  '):
+        return self._arena.dump(self._index, indent, step)
+
+    def render(self):
+        print(self.__str__())
+
+    def getElement(self):
+        '''Returns a new ParseStruct tree for the element and its descendants (see ParseArena.getElement).'''
+        return self._arena.getElement(self._index)
@@ -4,17 +4,68 @@ Created on 3 mrt. 2016
 @author: jeroenbruijning
 '''
 from pyparsing import *
-from parsertools import ParsertoolsException
+from parsertools import ParsertoolsException, ParseTimeoutError
+from collections import namedtuple
+from contextlib import contextmanager
+import re
+import threading
+import time
+import weakref
 
 class ParseStruct:
     '''Parent class for all ParseStruct subclasses. These subclasses will typically correspond to productions in a given grammar,
-    e.g. an EBNF grammar.'''
+    e.g. an EBNF grammar.
+    The attributes of the elements are stored in slots instead of an instance dict, to reduce the memory taken by parse trees.
+    Subclasses that add attributes should declare them in __slots__ as well; the element classes generated by Parser.addElement
+    declare no slots of their own. The attributes are set with object.__setattr__, since setting attributes directly is not allowed
+    (see __setattr__).
+    Elements parsed with spans (see Parser.setSpans) hold the string they were parsed from in _source, and have spans, ints that stand 
+    for a part of that string, among their items instead of strings. getItems() returns the items with the spans turned into strings.
+    They also record their own location in that string in _location, as a span, so that the text they were parsed from can be sliced 
+    from it (see getLocation and getSourceText).
+    The string of an element is cached in _string once it has been rendered (see __str__), until the items of the element or of one of
+    its descendants are changed.
+    The parent of an element is held in _parent by a weak reference, so that parse trees have no reference cycles, and are freed as soon
+    as they are no longer used, without waiting for the cyclic garbage collector. An element does not keep its parent alive: once
+    nothing refers to the tree above an element any more, the element has no parent.
+    The top element of a tree holds an index of the elements of the tree by class and by label in _index, once it has been searched
+    (see searchElements), until the tree is changed (see setItems).'''
+    
+    __slots__ = ('_items', '_label', '_parent', '_chain', '_chainItems', '_source', '_location', '_string', '_index', '__weakref__')
+    
+    # The Parser object a subclass was registered with. This is set by Parser.addElement.
+    _parser = None
+    
+    # Shared chains of collapsed elements (see compact). Equal chains are stored only once.
+    _chains = {}
     
     @classmethod
     def getPattern(cls):
         return cls._pattern
     
-    def __init__(self, expr):
+    @classmethod
+    def _useCompact(cls, compact):
+        '''Returns True if a freshly parsed element is to be compacted (see compact). If compact is None, the setting of the Parser object
+        the class was registered with is used.'''
+        if compact is None:
+            return cls._parser is not None and cls._parser.getCompact()
+        return compact
+    
+    @classmethod
+    def _usePackrat(cls):
+        '''Returns True if parses are memoized (see Parser.setPackrat).'''
+        return ParserElement._packratEnabled
+    
+    @classmethod
+    def _parse(cls, expr, *, parseAll=True, spans=None, shared=None):
+        '''Parses expr against the _pattern of the class and returns the resulting ParseStruct object. The parsing is delegated to the Parser object
+        the class was registered with, if any, so that parser-wide settings such as spans are applied. The spans and shared arguments can be 
+        used to override the settings of the Parser object for this parse.'''
+        if cls._parser is None:
+            return cls._pattern.parseString(expr, parseAll=parseAll)[0]
+        return cls._parser.parseString(cls._pattern, expr, parseAll=parseAll, spans=spans, shared=shared)[0]
+    
+    def __init__(self, expr, *, compact=None, spans=None, shared=None, deadline=None, timeout=None):
         '''A ParseStruct object contains a _pattern attribute, that corresponds to a pyparsing _pattern.
         It can be initialized wih either a valid string for the subclass concerned,
         using its own _pattern attribute to parse it, or it can be initialized with an explicit "None" as argument. This latter option is only
@@ -25,35 +76,69 @@ class ParseStruct:
         - another ParseStruct object.
         
         This nested list is the basic internal structure for the class.
-        The other attibutes: _label and _parent_, are context dependent and will be set by a containing higher level ParseStruct, if that exists.'''
+        The other attibutes: _label and _parent_, are context dependent and will be set by a containing higher level ParseStruct, if that exists.
+        The parent pointers are set while the elements are built, so that only the children of the element itself need to be adopted
+        after the parse. A memoized parse (see Parser.setPackrat) can reuse an element in several candidate parents, so then all parent
+        pointers are set again afterwards.
+        The optional argument compact overrides the compact setting of the Parser object (see Parser.setCompact and compact()),
+        and the optional arguments spans and shared override its spans and shared settings (see Parser.setSpans and Parser.setShared).
+        The optional arguments deadline (a time.monotonic() value) and timeout (in seconds) bound the time the parse may take, see deadlineScope.'''
         
-        self.__dict__['_items'] = None
-        self.__dict__['_label'] = None
-        self.__dict__['_parent'] = None
+        _setItems(self, None)
+        _setLabel(self, None)
+        _setParent(self, None)
+        _setChain(self, None)
+        _setSource(self, None)
+        _setLocation(self, None)
+        _setString(self, None)
+        _setIndex(self, None)
         
         if not expr is None:
             assert isinstance(expr, str), type(expr)
-            other = self.__getPattern().parseString(expr, parseAll=True)[0]
-            for attr in other.__dict__:
-                self.__dict__[attr] = other.__dict__[attr]
-            self.createParentPointers()
+            with deadlineScope(deadline=deadline, timeout=timeout):
+                other = self._parse(expr, spans=spans, shared=shared)
+                self.__setstate__(other.__getstate__())
+                self.createParentPointers(recursive=self._usePackrat())
+                if self._useCompact(compact):
+                    self.compact()
                 
     def __eq__(self, other):
         '''Compares the instances for equality of:
         - class
         - string representation.
         This means that the labels, parent pointers etc. are not taken into account. This is because
-        these are a form of annotation and/or context, separate from the parse tree in terms of resolved production rules.'''
+        these are a form of annotation and/or context, separate from the parse tree in terms of resolved production rules.
+        The strings are cached (see __str__), and so are their hashes, so that two elements that have been compared or hashed before are
+        told apart by their hashes without comparing the strings.'''
         
-        return self.__class__ == other.__class__ and str(self) == str(other)
+        if self is other:
+            return True
+        if self.__class__ != other.__class__:
+            return False
+        string, otherString = str(self), str(other)
+        return hash(string) == hash(otherString) and string == otherString
     
     def __ne__(self, other):
         return not self == other
     
+    def __hash__(self):
+        '''Returns a hash of the class and the string representation, which is consistent with __eq__. A hash of the structure of the
+        element would not be, since elements with different structures, such as a compact and a plain element (see compact), can be equal.
+        Like the string, the hash changes when the element or one of its descendants is changed, so an element should not be changed
+        while it is a member of a set or a key of a dict.'''
+        return hash((self.__class__, str(self)))
+    
     def __getattr__(self, att):
         '''Retrieves the unique, direct subelement having a label equal to the argument, if it exists.
-        Raises an exception if zero, or more than one values exist for that label.'''
+        Raises an exception if zero, or more than one values exist for that label.
+        The items of a compact element are only created when they are accessed (see compact).
+        Labels never start with an underscore, so that such names, e.g. of attributes that have not been set, are not looked up as labels.'''
         
+        if att == '_items' and self._chain is not None:
+            self._expand()
+            return self._items
+        if att.startswith('_'):
+            raise AttributeError('No attribute "{}" found.'.format(att))
         if att in self.getLabels():
             values = self.getValuesForLabel(att)
             if len(values) == 1:
@@ -66,93 +151,319 @@ class ParseStruct:
         
         raise AttributeError('Direct setting of attributes not allowed. To change an element e, try e.updateWith() instead.')
     
+    def __getstate__(self):
+        '''Returns a dict with the attributes of the element that have been set, other than its parent and its index. Used for copying and 
+        pickling. The children of a copy get the copy as their parent (see __setstate__), and a copy of an element without its tree has 
+        no parent. A copy builds an index of its own when it is searched (see searchElements).'''
+        state = self._getState(_slots(self.__class__))
+        state.pop('_parent', None)
+        state.pop('_index', None)
+        return state
+    
+    def _getState(self, slots):
+        '''Returns a dict with the values of the given slots that have been set, and the contents of the instance dict, if any.'''
+        state = {}
+        for name, slot in slots:
+            try:
+                state[name] = slot.__get__(self)
+            except AttributeError:
+                pass
+        if self.__class__.__dictoffset__:
+            # The class has an instance dict
+            state.update(vars(self))
+        return state
+    
+    def __setstate__(self, state):
+        '''Sets the attributes of the element from a dict as returned by __getstate__. A parent in state is set as the parent of the element,
+        and the element is set as the parent of the children among its items. A copy, which is created without __init__, has no parent.'''
+        if '_parent' not in state:
+            try:
+                self._parent
+            except AttributeError:
+                _setParentRef(self, None)
+        _setIndex(self, None)
+        for name, value in state.items():
+            if name == '_parent':
+                _setParent(self, value)
+            else:
+                _setattr(self, name, value)
+        if '_items' in state or '_chainItems' in state:
+            self.createParentPointers(recursive=False)
+    
+    def __reduce_ex__(self, protocol):
+        '''Copies and unpickled versions of a shared element (see Parser.setShared) are the shared element itself.'''
+        if _isShared(self):
+            return _sharedElement, (self.__class__, self._label, str(self))
+        return object.__reduce_ex__(self, protocol)
+    
     def __repr__(self):
         return self.__class__.__name__ + '("' + str(self) + '")'
     
     def __str__(self):
         '''Generates a string corresponding to the object. Except for possible whitespace variation, 
-        this is identical to the string that was used to create the object.'''
+        this is identical to the string that was used to create the object.
+        The tree is traversed with an explicit stack instead of by recursion, so that the depth of the tree is not limited by the 
+        recursion limit. The same holds for the other methods that traverse the tree.
+        The string is cached in the element, and the cached strings of its descendants are used (see setItems). Only the element
+        itself keeps its string, so that rendering a tree does not store the strings of all its subtrees.'''
         
+        string = self._string
+        if string is not None:
+            return string
         result = []
-        for t in self._items:
+        # The items still to be rendered, the next one last
+        stack = [self]
+        while stack:
+            t = stack.pop()
             if isinstance(t, str):
-                result.append(t) 
+                if t != '':
+                    result.append(t)
             else:
                 assert isinstance(t, ParseStruct), '__str__: found value {} of type {} instead of ParseStruct instance'.format(t, type(t))
-                result.append(str(t))
-        return ' '.join([r for r in result if r != ''])
+                string = t._string
+                if string is not None:
+                    if string != '':
+                        result.append(string)
+                    continue
+                # A compact element renders as the last element of its chain, which renders as its items
+                items = t._items if t._chain is None else t._chainItems
+                stack.extend(reversed(items if t._source is None else _spanStrings(items, t._source)))
+        string = ' '.join(result)
+        _setString(self, string)
+        return string
 
     def __getPattern(self):
         '''Returns the _pattern used to parse expressions for this class.'''
         return self.__class__.getPattern()
     
-    def __getElements(self, labeledOnly = True):
+    def __getElements(self, labeledOnly = True, keep = None):
         '''Returns a flat list of all enmbedded ParseStruct instances (inclusing itself),
         at any depth of recursion.
-        If labeledOnly is True, then in addition label may not be None.'''
-        
-        def flattenElement(p):
-            result = []
-            if isinstance(p, ParseStruct):
-                result.extend(p.__getElements(labeledOnly=labeledOnly))
-            else:
-                assert isinstance(p, str), type(p)
-            return result
-        
-        def flattenList(l):
-            result = []
-            for p in l:
-                result.extend(flattenElement(p))
-            return result
+        If labeledOnly is True, then in addition label may not be None.
+        The optional function keep takes a class and a label. If it returns False for all elements in the chain of a compact element,
+        these elements are left out, so that the chain need not be expanded.'''
         
         result = []
-        if self.getLabel() or not labeledOnly:
-                result.append(self)
-        result.extend(flattenList(self.getItems()))
+        # The elements still to be visited, the next one last
+        stack = [self]
+        while stack:
+            element = stack.pop()
+            if element.getLabel() or not labeledOnly:
+                result.append(element)
+            stack.extend(i for i in reversed(element._searchItems(keep)) if isinstance(i, ParseStruct))
         return result  
     
+    def _searchItems(self, keep):
+        '''Returns the items of the element to search (see __getElements). If the optional function keep, which takes a class and a label,
+        returns False for all elements in the chain of a compact element, or for all shared elements among the items, these are left in 
+        place, so that they need not be created.'''
+        if self._chain is None and not _hasShared(self._items):
+            # The elements among the items are the same as those among getItems()
+            return self._items
+        if keep and self._chain is not None and not any(keep(class_, label) for class_, label in self._chain):
+            return self._chainItems
+        if keep and not any(keep(i.__class__, i._label) for i in self._items if _isShared(i)):
+            # Shared elements that cannot be kept are left in place (see Parser.setShared)
+            return self._items
+        return self.getItems()
+    
     def createParentPointers(self, recursive=True):
-        for i in self.getItems():
-            if isinstance(i, ParseStruct):
-                i.__dict__['_parent'] = self
-                if recursive:
-                    i.createParentPointers()
+        stack = [self]
+        while stack:
+            element = stack.pop()
+            parent = _ref(element)
+            for i in element._items if element._chain is None else element._chainItems:
+                # Shared elements have no parent (see Parser.setShared)
+                if isinstance(i, ParseStruct) and not _isShared(i):
+                    _setParentRef(i, parent)
+                    if recursive:
+                        stack.append(i)
+
+    def compact(self):
+        '''Collapses every chain of elements that each have a single element as their only item, such as the Expression elements that lead
+        to a single literal, into the element at the top of the chain. Only the classes and labels of the other elements in the chain are kept,
+        together with the items of the last one. The elements of a chain are created again when they are accessed, e.g. with getItems,
+        getChildren or descend. Other methods, such as __str__, behave as before. This reduces the number of elements in the tree.
+        An element is only added to the chain of its parent if its attributes, other than its items, label and parent, are equal to those
+        of its parent. Returns itself.'''
+        
+        # The elements in preorder, so that every element comes after its ancestors
+        elements = []
+        stack = [self]
+        while stack:
+            element = stack.pop()
+            elements.append(element)
+            stack.extend(i for i in (element._items if element._chain is None else element._chainItems) if isinstance(i, ParseStruct))
+        for element in reversed(elements):
+            element._compactChild()
+        # Trees with compact elements are not indexed (see searchElements)
+        _setIndex(_rootOf(self), None)
+        return self
+    
+    def _compactChild(self):
+        '''Collapses the only item of the element into its chain, if that item is an element (see compact). Its descendants have been
+        compacted already.'''
+        if self._chain is not None or len(self._items) != 1 or not isinstance(self._items[0], ParseStruct):
+            return
+        child = self._items[0]
+        if not _isShared(child) and (self._getAttributes() != child._getAttributes() or child._source is not self._source):
+            # The spans in the items of the child, if any, are parts of its own source. A shared child has no spans, and would get the
+            # attributes of its parent.
+            return
+        if child._chain is not None:
+            chain = ((child.__class__, child._label),) + child._chain
+            items = child._chainItems
+        else:
+            chain = ((child.__class__, child._label),)
+            items = child._items
+        _delattr(self, '_items')
+        _setChain(self, self._chains.setdefault(chain, chain))
+        _setattr(self, '_chainItems', items)
+        for item in items:
+            if isinstance(item, ParseStruct):
+                _setParent(item, self)
+    
+    def isCompact(self):
+        '''Returns True if the element holds a collapsed chain of elements (see compact).'''
+        return self._chain is not None
+    
+    def _getAttributes(self):
+        '''Returns the attributes of the element other than its items, label, parent and chain.'''
+        return self._getState(_slots(self.__class__)[len(_slots(ParseStruct)):])
+    
+    def _expand(self):
+        '''Creates the elements of the chain of a compact element (see compact).'''
+        chain = self._chain
+        items = self._chainItems
+        _setChain(self, None)
+        _delattr(self, '_chainItems')
+        attributes = self._getAttributes()
+        parent = self
+        for class_, label in chain:
+            element = class_(None)
+            element.__setstate__(attributes)
+            _setLabel(element, label)
+            _setSource(element, self._source)
+            _setLocation(element, self._location)
+            _setParent(element, parent)
+            _setItems(parent, [element])
+            parent = element
+        _setItems(parent, items)
+        for item in items:
+            if isinstance(item, ParseStruct):
+                _setParent(item, parent)
 
     def copy(self):
         '''Returns a deep copy of itself.'''
-        result = self._pattern.parseString(str(self))[0]
+        result = self._parse(str(self), parseAll=False)
         assert result == self
         return result
     
     def setItems(self, items):
-        self.__dict__['_items'] = items
+        '''Replaces the items of the element. The element becomes the parent of the elements among the new items. The cached strings of 
+        the element and its ancestors are dropped (see __str__), and so are their locations, since their text no longer matches the 
+        source (see getLocation), and the index of the tree (see searchElements). The ancestors are found through the parent pointers.'''
+        assert not _isShared(self), 'shared elements cannot be changed'
+        if self._chain is not None:
+            _setChain(self, None)
+            _delattr(self, '_chainItems')
+        _setItems(self, items)
+        self.createParentPointers(recursive=False)
+        element = self
+        while element is not None:
+            _setString(element, None)
+            _setLocation(element, None)
+            root = element
+            element = _parentOf(element)
+        _setIndex(root, None)
     
     def searchElements(self, *, label=None, element_type = None, value = None, labeledOnly=False):
         '''Returns a list of all elements with the specified search _pattern. If labeledOnly is True,
         only elements with label not None are considered for inclusion. Otherwise (the default case) all elements are considered.
-        Keyword arguments label, element_type, value are used as a wildcard if None. All must be matched for an element to be included in the result.'''
+        Keyword arguments label, element_type, value are used as a wildcard if None. All must be matched for an element to be included in the result.
+        A search of the top element of a tree for an element_type or a label takes the candidates from the index of the tree, which is built 
+        by the first such search, instead of visiting the whole tree. This speeds up repeated searches of a tree that is not changed in 
+        between, such as those of an application that inspects a parsed query. A change drops the index (see setItems), and the next 
+        search builds it again. Trees with compact or shared elements (see compact and Parser.setShared) are not indexed.
+        The value is parsed once for each class of the elements it is compared with, and not for every element.'''
         
-        result = []
+        elements = self._indexed(element_type or label) if element_type or label else None
+        if elements is None:
+            elements = self.__getElements(labeledOnly=labeledOnly, keep=_searchKeep(label, element_type, labeledOnly))
+        needles = {}
+        return [e for e in [self] + elements if e._matches(label, element_type, value, labeledOnly, needles)]
+    
+    def iterElements(self, *, label=None, element_type=None, value=None, labeledOnly=False, prune=None):
+        '''Generates the elements that match the arguments as in searchElements, in the same order, one at a time, so that a search can 
+        stop at the first match without visiting the rest of the tree. Unlike searchElements, which lists the element itself twice if it
+        matches, iterElements generates it once.
+        The optional function prune takes an element. If it returns True, the descendants of that element are skipped; the element itself
+        is generated if it matches. The children of an element are taken before it is generated, so that an element can be updated when
+        it is generated, but the tree should not be changed otherwise while it is iterated.'''
         
-        for e in [self] + self.__getElements(labeledOnly=labeledOnly):
-#             print('DEBUG: e.name =', e.getLabel())
-
-            if labeledOnly and not e.getLabel():
-                continue
-            if label and label != e.getLabel():
-                continue
-            if element_type and element_type != e.__class__:
-                continue
-            if value:
+        keep = None if prune else _searchKeep(label, element_type, labeledOnly)
+        needles = {}
+        # The elements still to be visited, the next one last
+        stack = [self]
+        while stack:
+            element = stack.pop()
+            if not (prune and prune(element)):
+                stack.extend(i for i in reversed(element._searchItems(keep)) if isinstance(i, ParseStruct))
+            if element._matches(label, element_type, value, labeledOnly, needles):
+                yield element
+    
+    def findFirst(self, *, label=None, element_type=None, value=None, labeledOnly=False, prune=None):
+        '''Returns the first element that iterElements generates for the arguments, or None if there is none. The search stops there.'''
+        return next(self.iterElements(label=label, element_type=element_type, value=value, labeledOnly=labeledOnly, prune=prune), None)
+    
+    def select(self, selector):
+        '''Returns a list of the element and its descendants that match selector, in preorder. The selector is a string, such as 
+        'WhereClause TriplesBlock > Var', or a compiled Selector object. See parsertools.selector for the syntax. Selectors given as 
+        strings are cached once compiled (see Selector.getSelector). Use a SelectorSet to find the matches of several selectors in a 
+        single traversal.'''
+        from parsertools.selector import Selector
+        return Selector.getSelector(selector).select(self)
+    
+    def _matches(self, label, element_type, value, labeledOnly, needles):
+        '''Returns True if the element matches the arguments of searchElements. The dict needles holds value as parsed for each class it 
+        has been compared with during the search, or None if it cannot be parsed as that class. The element is compared with it by 
+        __eq__, which uses the cached strings and their hashes.'''
+        if labeledOnly and not self._label:
+            return False
+        if label and label != self._label:
+            return False
+        if element_type and element_type != self.__class__:
+            return False
+        if value:
+            class_ = self.__class__
+            try:
+                needle = needles[class_]
+            except KeyError:
                 try:
-                    e1 = e._pattern.parseString(value)[0]
-                    if e != e1:
-                        continue
+                    needle = self._parse(value, parseAll=False)
                 except ParseException:
-                    continue
-            result.append(e)
-        return result    
+                    needle = None
+                needles[class_] = needle
+            if needle is None or self != needle:
+                return False
+        return True
 
+    def _indexed(self, key):
+        '''Returns the element and the elements of its tree with key, a class or a label, as a list in preorder, like __getElements, from 
+        the index of the tree (see searchElements), which is built if needed. Returns None if the element is not the top element of its 
+        tree, or if the tree cannot be indexed.'''
+        if _parentOf(self) is not None:
+            return None
+        index = self._index
+        if index is None:
+            elements = _indexElements(self)
+            if elements is None:
+                return None
+            # The index leaves out the top element, which would otherwise be kept alive by a reference cycle
+            index = _indexKeys(elements[1:])
+            _setIndex(self, index)
+        return [self] + index.get(key, [])
+    
     def updateWith(self, new_content):
         '''Replaces the items attribute with the items attribute of a freshly parsed new_content, which must be a string.
         The parsing is done with the _pattern of the element being updated.
@@ -160,11 +471,10 @@ class ParseStruct:
         
         assert isinstance(new_content, str), 'UpdateFrom function needs a string'
         try:
-            other = self._pattern.parseString(new_content, parseAll=True)[0]
+            other = self._parse(new_content)
         except ParseException:
             raise ParsertoolsException('{} is not a valid string for {} element'.format(new_content, self.__class__.__name__))        
-        self.__dict__['_items'] = other.__dict__['_items']
-        self.createParentPointers(recursive=False)
+        self.setItems(other.getItems())
         assert self.isValid()
     
     def check(self, *, report = False, render=False, dump=False):
@@ -185,8 +495,27 @@ class ParseStruct:
         return self._label
 
     def getItems(self):
-        '''Returns items attribute.'''
-        return self._items
+        '''Returns a new list with the items of the element, so that changing the list does not change the element (see setItems). 
+        For an element with spans (see Parser.setSpans), the spans are turned into strings. Shared elements among the items are replaced 
+        by elements of its own first (see Parser.setShared).'''
+        if _hasShared(self._items):
+            self._unshare()
+        if self._source is None:
+            return list(self._items)
+        return _spanStrings(self._items, self._source)
+    
+    def _unshare(self):
+        '''Replaces the shared elements among the items by new elements, with the attributes of the element (see Parser.setShared).'''
+        items = self._items
+        attributes = self._getAttributes()
+        for position, item in enumerate(items):
+            if _isShared(item):
+                element = item.__class__(None)
+                element.__setstate__(attributes)
+                _setLabel(element, item._label)
+                _setItems(element, list(item._items))
+                _setParent(element, self)
+                items[position] = element
 
     def hasLabel(self, k):
         '''True if k present as label of a direct descendant.'''
@@ -204,10 +533,33 @@ class ParseStruct:
         '''Returns a list of all its non-string child elements.'''
         return [i for i in self.getItems() if isinstance(i, ParseStruct)]
     
+    def getLocation(self):
+        '''Returns (start, end), the offsets of the text the element was parsed from in the string it was parsed from, or None if they
+        are not known. Locations are recorded in parses with spans (see Parser.setSpans), and are dropped when the element or one of
+        its descendants is changed (see setItems). Shared elements (see Parser.setShared) have no location.
+        For a query parsed with parseQuery, the offsets are in the prepared query string.'''
+        location = self._location
+        if location is None:
+            return None
+        return location >> _spanShift, location & _spanMask
+    
+    def getSourceText(self):
+        '''Returns the text the element was parsed from, exactly as it occurs in the string it was parsed from, including whitespace and
+        comments between its tokens, or None if its location is not known (see getLocation). Unlike str(), this takes no rendering.'''
+        location = self._location
+        if location is None:
+            return None
+        return self._source[location >> _spanShift:location & _spanMask]
+    
     def getParent(self):
         '''Returns its parent element, which is the first element encountered when going up in the parse tree.
-        For the top element, the method returns None'''
-        return self._parent
+        For the top element, and for an element of which the tree above it is no longer used, the method returns None'''
+        parent = _parentOf(self)
+        if parent is not None and parent._chain is not None:
+            # The parent is the last element of a collapsed chain, which is created now
+            parent._expand()
+            parent = _parentOf(self)
+        return parent
     
     def getAncestors(self):
         '''Returns the list of parent nodes, starting with the direct parent and ending with the top element.'''
@@ -220,11 +572,11 @@ class ParseStruct:
     
     def isBranch(self):
         '''Checks whether the node branches.'''
-        return len(self.getItems()) > 1
+        return len(self._items) > 1
             
     def isAtom(self):
         '''Test whether the node has a string as its single descendant.'''
-        return len(self.getItems()) == 1 and isinstance(self._items[0], str)
+        return len(self._items) == 1 and isinstance(self._items[0], (str, int))
     
     def descend(self):
         '''Descends until either an atom or a branch node is encountered; returns that node.'''
@@ -235,24 +587,32 @@ class ParseStruct:
         
     def dump(self, indent='', step='|  '):
         '''Returns a dump of the object, with rich information'''
-        result = ''
-        def dumpString(s, indent, step):
-            return indent + s + '\n'
-        
-        def dumpItems(items, indent, step):
-            result = ''
-            for i in items:
-                if isinstance(i, str):
-                    result += dumpString(i, indent+step, step)
-                else:
-                    assert isinstance(i, ParseStruct) 
-                    result += i.dump(indent+step, step)
-            return result       
-       
-        result += indent + ('> '+ self.getLabel() + ':\n' + indent if self.getLabel() else '') + '[' + self.__class__.__name__ + '] ' + '/' + self.__str__() + '/' + '\n'
-        result += dumpItems(self._items, indent, step)
-        
-        return result
+        # The items of the elements, in preorder, with the spans turned into strings. Shared elements are dumped as they are (see 
+        # Parser.setShared).
+        elements = []
+        stack = [self]
+        while stack:
+            element = stack.pop()
+            items = element._items if element._source is None else _spanStrings(element._items, element._source)
+            elements.append((element, items))
+            stack.extend(i for i in items if isinstance(i, ParseStruct))
+        # The strings of the elements (see __str__), each made from those of its items
+        strings = {}
+        for element, items in reversed(elements):
+            strings[id(element)] = element._string if element._string is not None else ' '.join(t for t in (strings[id(i)] if isinstance(i, ParseStruct) else i for i in items) if t != '')
+        itemsOf = dict((id(element), items) for element, items in elements)
+        result = []
+        # The items still to be dumped, with their indents, the next one last
+        stack = [(self, indent)]
+        while stack:
+            item, indent = stack.pop()
+            if isinstance(item, str):
+                result.append(indent + item + '\n')
+            else:
+                assert isinstance(item, ParseStruct)
+                result.append(indent + ('> '+ item.getLabel() + ':\n' + indent if item.getLabel() else '') + '[' + item.__class__.__name__ + '] ' + '/' + strings[id(item)] + '/' + '\n')
+                stack.extend((i, indent + step) for i in reversed(itemsOf[id(item)]))
+        return ''.join(result)
     
     def render(self):
         print(self.__str__())
@@ -261,7 +621,7 @@ class ParseStruct:
         '''Returns True if the rendered expression can be parsed again to an element of the same class.
         This should normally be the case.'''
         try:
-            self.__getPattern().parseString(self.__str__(), parseAll=True)
+            self._parse(self.__str__())
             return True
         except ParseException:
             return False
@@ -269,14 +629,246 @@ class ParseStruct:
     def isValid(self):
         '''Returns True if the object is equal to the result of re-parsing its own rendering.
         This should normally be the case.'''
-        return self == self.__getPattern().parseString(self.__str__())[0]
+        return self == self._parse(self.__str__(), parseAll=False)
     
     def hasParentPointers(self):
-        for item in [i for i in self.getItems() if isinstance(i, ParseStruct)]:
-            if not item.getParent() == self or not item.hasParentPointers():
-                return False
+        stack = [self]
+        while stack:
+            element = stack.pop()
+            for item in element.getItems():
+                if isinstance(item, ParseStruct):
+                    if item.getParent() is not element:
+                        return False
+                    stack.append(item)
         return True
     
+# Attributes of ParseStruct objects are set and deleted with these, since ParseStruct.__setattr__ does not allow it.
+# The setters for the individual slots are faster, and are used where elements are created.
+_setattr = object.__setattr__
+_delattr = object.__delattr__
+_setItems = ParseStruct._items.__set__
+_setLabel = ParseStruct._label.__set__
+_setParentRef = ParseStruct._parent.__set__
+_setChain = ParseStruct._chain.__set__
+_setSource = ParseStruct._source.__set__
+_setLocation = ParseStruct._location.__set__
+_setString = ParseStruct._string.__set__
+_setIndex = ParseStruct._index.__set__
+
+_ref = weakref.ref
+
+def _setParent(element, parent):
+    '''Sets the parent of element, which is held by a weak reference (see ParseStruct).'''
+    _setParentRef(element, None if parent is None else _ref(parent))
+
+def _parentOf(element):
+    '''Returns the parent of element, or None, without expanding a compact parent (see ParseStruct.getParent).'''
+    parent = element._parent
+    return None if parent is None else parent()
+
+def _searchKeep(label, element_type, labeledOnly):
+    '''Returns a function that takes a class and a label, and returns True if an element with these can match the arguments of 
+    ParseStruct.searchElements.'''
+    def keep(class_, elementLabel):
+        return (elementLabel or not labeledOnly) and (not label or label == elementLabel) and (not element_type or element_type == class_)
+    return keep
+
+def _rootOf(element):
+    '''Returns the top element of the tree of element, without expanding compact elements.'''
+    parent = _parentOf(element)
+    while parent is not None:
+        element, parent = parent, _parentOf(parent)
+    return element
+
+#
+# The index of a tree: a dict from classes and labels to the elements of the tree with that class or label, in preorder (see searchElements)
+#
+
+def _indexElements(element):
+    '''Returns a list of element and its descendants in preorder, or None if it has compact or shared elements (see ParseStruct.compact
+    and Parser.setShared), which are not indexed.'''
+    result = []
+    stack = [element]
+    while stack:
+        element = stack.pop()
+        if element._chain is not None:
+            return None
+        result.append(element)
+        items = [i for i in element._items if isinstance(i, ParseStruct)]
+        if _hasShared(items):
+            return None
+        stack.extend(reversed(items))
+    return result
+
+def _indexKeys(elements):
+    '''Returns a dict from the classes and labels of elements to the elements with that class or label, in the order of elements.'''
+    result = {}
+    for element in elements:
+        result.setdefault(element.__class__, []).append(element)
+        if element._label:
+            result.setdefault(element._label, []).append(element)
+    return result
+
+def _slots(class_, _cache={}):
+    '''Returns a tuple of (name, descriptor) pairs for the slots of class_ and its base classes, starting with those of ParseStruct.'''
+    try:
+        return _cache[class_]
+    except KeyError:
+        result = []
+        for c in reversed(class_.__mro__):
+            slots = c.__dict__.get('__slots__', ())
+            for name in (slots,) if isinstance(slots, str) else slots:
+                if name not in ('__dict__', '__weakref__'):
+                    result.append((name, c.__dict__[name]))
+        return _cache.setdefault(class_, tuple(result))
+
+#
+# Settings for the elements built by the parse in progress in a thread, see Parser.parseString
+#
+
+class _ParseState(threading.local):
+    # True if tokens are stored as spans (see Parser.setSpans)
+    spans = False
+    # The string being parsed, if it has no tabs. Otherwise, pyparsing parses a copy with the tabs expanded, which is used instead.
+    source = None
+    # True if elements with a fixed text are shared (see Parser.setShared)
+    shared = False
+    # The string being parsed in token mode and its token table, as a pair, or None (see Parser.setLexer)
+    tokens = None
+
+_parseState = _ParseState()
+
+#
+# Spans: tokens stored as offsets into the string that was parsed, instead of as copies of part of that string
+#
+
+# A span is an int, with the start offset of the token in the bits above _spanShift and the end offset in the bits below it.
+# Tokens beyond _spanMask are left as strings.
+_spanShift = 32
+_spanMask = (1 << _spanShift) - 1
+
+_skipWhite = re.compile('[{}]*'.format(re.escape(ParserElement.DEFAULT_WHITE_CHARS))).match
+
+def _spanStrings(items, source):
+    '''Returns a copy of items, with the spans turned into the parts of source they stand for.'''
+    return [source[i >> _spanShift:i & _spanMask] if isinstance(i, int) else i for i in items]
+
+def _spanEnd(element):
+    '''Returns the end offset of the last span in the items of element or of its descendants, -1 if element has no non-empty items,
+    or None if the last one is not a span.'''
+    # The items still to be searched, from the last one, of element and of the descendants entered so far
+    stack = [reversed(element._items)]
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, int):
+                return item & _spanMask
+            if isinstance(item, ParseStruct):
+                stack.append(reversed(item._items))
+                break
+            if item != '':
+                return None
+        else:
+            stack.pop()
+    return -1
+
+def _wordsEnd(item, source, loc):
+    '''Returns the offset after item in source at loc, for a string such as 'INSERT DATA' or '( )' of which the words may be separated by
+    other whitespace in source, or None if item is not found there.'''
+    for word in item.split():
+        start = _skipWhite(source, loc).end()
+        loc = start + len(word)
+        if source[start:loc].upper() != word.upper():
+            return None
+    return loc
+
+def _spanItems(items, source, loc):
+    '''Returns (items, end) for items, the items of an element that was parsed from source at loc, with each string replaced by a span
+    if it is found in source at its position, and end, the offset after the last of the items, or None if it is not known. The positions 
+    are found by skipping whitespace from loc and over the preceding items. Strings that differ from the source, such as those of 
+    caseless keywords and of terminals with whitespace normalized, such as NIL, are kept. Once a position cannot be determined, the remaining items are kept.'''
+    result = []
+    for position, item in enumerate(items):
+        if isinstance(item, str):
+            if item != '':
+                start = _skipWhite(source, loc).end()
+                end = start + len(item)
+                if source.startswith(item, start):
+                    if end <= _spanMask:
+                        item = start << _spanShift | end
+                elif source[start:end].upper() != item.upper():
+                    end = _wordsEnd(item, source, start)
+                    if end is None:
+                        return result + items[position:], None
+                loc = end
+        elif isinstance(item, ParseStruct):
+            location = item._location
+            end = _spanEnd(item) if location is None else location & _spanMask
+            if end is None:
+                return result + items[position:], None
+            loc = max(loc, end)
+        else:
+            return result + items[position:], None
+        result.append(item)
+    # A copy has no room to spare for appends, unlike result
+    return result[:], loc
+
+def _setSpans(element, source, loc):
+    '''Replaces the strings in the items of element, which was parsed from source at loc, by spans, and records the location of element,
+    if a parse with spans is in progress.'''
+    if _parseState.spans:
+        if _parseState.source is not None:
+            source = _parseState.source
+        _setSource(element, source)
+        start = _skipWhite(source, loc).end()
+        items, end = _spanItems(element._items, source, start)
+        _setItems(element, items)
+        if end is not None and end <= _spanMask:
+            _setLocation(element, start << _spanShift | max(start, end))
+
+#
+# Shared elements: a single, immutable element for all occurrences of a terminal with a fixed text, such as a keyword or punctuation
+#
+
+# The shared elements, by class, label and text
+_sharedElements = {}
+# The ids of the shared elements
+_sharedIds = set()
+
+def _hasFixedText(class_, _cache={}):
+    '''Returns True if the pattern of class_ only matches a fixed text, which is the text of all its elements.'''
+    try:
+        return _cache[class_]
+    except KeyError:
+        return _cache.setdefault(class_, isinstance(getattr(class_, '_pattern', None), (Literal, Keyword)))
+
+def _isShared(element):
+    return id(element) in _sharedIds
+
+def _hasShared(items):
+    '''Returns True if items contains a shared element.'''
+    return bool(_sharedIds) and not _sharedIds.isdisjoint(map(id, items))
+
+def _sharedElement(class_, label, text):
+    '''Returns the shared element of class_ with the given label and text, which is created if it does not exist yet.'''
+    key = (class_, label, text)
+    try:
+        return _sharedElements[key]
+    except KeyError:
+        element = class_(None)
+        _setLabel(element, label)
+        _setItems(element, [text])
+        element = _sharedElements.setdefault(key, element)
+        _sharedIds.add(id(element))
+        return element
+
+def _setShared(element):
+    '''Replaces the children of element that have a fixed text by shared elements, if a parse with shared elements is in progress.'''
+    if _parseState.shared:
+        items = element._items
+        for position, item in enumerate(items):
+            if isinstance(item, ParseStruct) and _hasFixedText(item.__class__) and not _isShared(item):
+                items[position] = _sharedElement(item.__class__, item._label, str(item))
+
 def parseStructFunc(class_):
     '''Returns the function that converts a ParseResults object to a ParseStruct object of class "class_", with label set to None, and
     items set to a recursive list of objects, each of which is either a string or a further ParseStruct object.
@@ -295,8 +887,8 @@ def parseStructFunc(class_):
             if isinstance(t, str):
                 result.append(t)
             elif isinstance(t, ParseStruct):
-                if t.__dict__['_label'] == None:
-                    t.__dict__['_label'] = valuedict.get(id(t))
+                if t._label == None:
+                    _setLabel(t, valuedict.get(id(t)))
                 result.append(t)
             elif isinstance(t, list):
                 result.append(t)
@@ -306,12 +898,16 @@ def parseStructFunc(class_):
                 result.extend(itemList(t))
         return result
     
-    def makeparseinfo(parseresults):
+    def makeparseinfo(instring, loc, parseresults):
         # The function to be returned.
         assert issubclass(class_, ParseStruct)
         assert isinstance(parseresults, ParseResults)
+        checkDeadline()
         result = class_(None)
         result.setItems(itemList(parseresults))
+        _setSpans(result, instring, loc)
+        _setShared(result)
+        result.createParentPointers(recursive=False)
         return result
     
     return makeparseinfo
@@ -331,7 +927,7 @@ def separatedList(_pattern, sep=','):
         templist = []
         for item in parseresults:
             if isinstance(item, ParseStruct):
-                item.__dict__['_label'] = label
+                _setLabel(item, label)
                 templist.append(item)
             else:
                 assert isinstance(item, str)
@@ -346,6 +942,643 @@ def separatedList(_pattern, sep=','):
       
     result = delimitedList(_pattern, sep)
     result.setParseAction(makeList)
+    # Marks the parse action for the code generator (see parsertools.generator)
+    result._separator = sep
     return result
 
-                           
+#
+# Deadlines, to bound the time spent on a parse and on its post processing
+#
+
+class _DeadlineState(threading.local):
+    # The deadline in force in a thread, as a time.monotonic() value, or None
+    deadline = None
+    
+_deadlineState = _DeadlineState()
+# The number of threads with a deadline in force, so that checkDeadline costs next to nothing when there are none
+_deadlineThreads = 0
+_deadlineLock = threading.Lock()
+
+@contextmanager
+def deadlineScope(*, deadline=None, timeout=None):
+    '''Context manager that sets a deadline for the work done in the current thread inside the with statement: the earliest of deadline
+    (a time.monotonic() value), the current time plus timeout (in seconds), and the deadline in force already, if any. In the meantime,
+    the parse (whenever an element is created or alternatives are tried) and the post processing steps call checkDeadline, which raises 
+    a ParseTimeoutError when the deadline has passed. Yields the deadline in force, or None.'''
+    global _deadlineThreads
+    previous = _deadlineState.deadline
+    deadlines = [d for d in (previous, deadline, None if timeout is None else time.monotonic() + timeout) if d is not None]
+    if not deadlines:
+        yield None
+        return
+    if previous is None:
+        with _deadlineLock:
+            _deadlineThreads += 1
+    _deadlineState.deadline = min(deadlines)
+    try:
+        yield _deadlineState.deadline
+    finally:
+        _deadlineState.deadline = previous
+        if previous is None:
+            with _deadlineLock:
+                _deadlineThreads -= 1
+        
+def checkDeadline():
+    '''Raises a ParseTimeoutError if the deadline in force in the current thread (see deadlineScope) has passed.'''
+    if _deadlineThreads:
+        deadline = _deadlineState.deadline
+        if deadline is not None:
+            now = time.monotonic()
+            if now > deadline:
+                raise ParseTimeoutError('Deadline exceeded by {:.3f} seconds'.format(now - deadline))
+
+#
+# Single pass tokenizer, for front-end processing of strings before (or instead of) a full parse
+#
+
+LexerToken = namedtuple('LexerToken', ['kind', 'text', 'start', 'end'])
+
+class Lexer:
+    '''Tokenizer defined by an ordered list of (kind, regex) pairs. The regexes are combined into one master regex with a named group per kind,
+    so that a string is scanned in a single left-to-right pass. At every position the first kind in the list that matches is taken, hence
+    more specific kinds must precede more general ones (e.g. a DOUBLE before an INTEGER). Text matching skip (by default whitespace) is 
+    skipped between tokens. Tokens are returned as LexerToken tuples (kind, text, start, end), with start and end the offsets in the string.'''
+    
+    def __init__(self, tokendefs, *, skip=r'\s+', flags=0):
+        assert len(tokendefs) > 0, 'Lexer needs at least one token definition'
+        self._kinds = [kind for kind, _ in tokendefs]
+        assert len(set(self._kinds)) == len(self._kinds), 'Duplicate token kinds in {}'.format(self._kinds)
+        self._regexes = dict(tokendefs)
+        self._flags = flags
+        self._master = re.compile('|'.join('(?P<{}>{})'.format(kind, regex) for kind, regex in tokendefs), flags)
+        self._skip = re.compile(skip) if skip else None
+        
+    def getKinds(self):
+        '''Returns the token kinds of this lexer, in order of precedence.'''
+        return list(self._kinds)
+        
+    def iterTokens(self, text, pos=0):
+        '''Generator yielding the tokens in text, starting at offset pos. Raises a ParsertoolsException when no token kind matches at some position.
+        Since tokens are produced lazily, callers that only need a prefix of the token stream can stop early without scanning the rest of text.'''
+        master = self._master.match
+        skip = self._skip.match if self._skip else None
+        end = len(text)
+        while pos < end:
+            if skip:
+                m = skip(text, pos)
+                if m:
+                    pos = m.end()
+                    if pos == end:
+                        break
+            m = master(text, pos)
+            if not m or m.end() == pos:
+                raise ParsertoolsException('Cannot tokenize text at position {}: "{}"'.format(pos, text[pos:pos+20]))
+            yield LexerToken(m.lastgroup, m.group(), pos, m.end())
+            pos = m.end()
+            
+    def tokenize(self, text):
+        '''Returns the list of tokens in text.'''
+        return list(self.iterTokens(text))
+
+    def _tokenTable(self, text):
+        '''Returns a dict from the start of every token in text to its kind and end, as a pair. The table ends where text cannot be 
+        tokenized.'''
+        table = {}
+        try:
+            for token in self.iterTokens(text):
+                table[token.start] = token.kind, token.end
+        except ParsertoolsException:
+            pass
+        return table
+
+class TokenRegex(Regex):
+    '''A Regex for a terminal in token mode (see Parser.setLexer). The string being parsed is tokenized once, and the terminal matches on the 
+    kind of the token at the parse location instead of running its regex there. The terminal has the same regex as the token kind of its 
+    name, so if that is the kind of the token, the token is its match. If the token is of a later kind of the lexer, the terminal does not
+    match, since the lexer, which tries the kinds in order, would otherwise have taken it. Otherwise, as where no token starts, or the token
+    is of an earlier kind, which can end at a different place, the regex is run. The results are the same as those of the Regex.'''
+
+    def parseImpl(self, instring, loc, doActions=True):
+        tokens = _parseState.tokens
+        if tokens is None or tokens[0] is not instring:
+            tokens = _parseState.tokens = instring, self._lexer._tokenTable(instring)
+        token = tokens[1].get(loc)
+        if token is not None:
+            kind, end = token
+            if kind == self.name:
+                return end, ParseResults(instring[loc:end])
+            if kind in self._later:
+                raise ParseException(instring, loc, self.errmsg, self)
+        return Regex.parseImpl(self, instring, loc, doActions)
+
+#
+# Dispatch on the leading keyword of alternatives
+#
+
+def _leadingKeywords(expr, seen=frozenset()):
+    '''Returns the set of (upper case) keywords one of which expr must start with, or None if this cannot be determined. Only
+    caseless keywords with the default identifier characters are recognized, as these are what KeywordDispatch can look up.'''
+    if isinstance(expr, CaselessKeyword):
+        if {c.upper() for c in expr.identChars} == {c.upper() for c in Keyword.DEFAULT_KEYWORD_CHARS}:
+            return {expr.match.upper()}
+        return None
+    if isinstance(expr, And):
+        return _leadingKeywords(expr.exprs[0], seen) if expr.exprs else None
+    if isinstance(expr, MatchFirst):
+        result = set()
+        for e in expr.exprs:
+            keywords = _leadingKeywords(e, seen)
+            if keywords is None:
+                return None
+            result |= keywords
+        return result
+    if isinstance(expr, Forward):
+        if expr in seen or expr.expr is None:
+            return None
+        return _leadingKeywords(expr.expr, seen | {expr})
+    if isinstance(expr, (TokenConverter, OneOrMore, ParseAccelerator)):
+        return _leadingKeywords(expr.expr, seen)
+    return None
+
+class _Alternatives:
+    '''Mixin for elements that try a number of candidate alternatives in order, like a MatchFirst. It has no slots, and comes after the
+    pyparsing class among the bases, so that MatchFirst elements can be turned into PredictiveMatchFirst elements in place (see 
+    Parser.compile).'''
+
+    __slots__ = ()
+
+    def _tryAlternatives(self, candidates, instring, loc, doActions):
+        '''Returns the result of the first of candidates that matches at loc. Otherwise raises the ParseException of the alternative 
+        that got furthest, as MatchFirst does.'''
+        maxException = None
+        try:
+            for e in candidates:
+                try:
+                    return e._parse(instring, loc, doActions)
+                except ParseException as err:
+                    if maxException is None or err.loc > maxException.loc:
+                        maxException = err
+                except IndexError:
+                    if maxException is None or len(instring) > maxException.loc:
+                        maxException = ParseException(instring, len(instring), e.errmsg, self)
+            if maxException is not None:
+                raise maxException
+            raise ParseException(instring, loc, self.errmsg, self)
+        finally:
+            # The exception refers to this frame through its traceback, which would otherwise be a reference cycle that keeps the
+            # frames of the parse, and the elements they refer to, alive until the cyclic garbage collector runs
+            maxException = None
+
+class ParseAccelerator(ParseElementEnhance):
+    '''Base class for elements that parse the same strings as the element they wrap, with the same results, but faster. The analyses
+    of the grammar (leading keywords, FirstSets) and the code generator (see parsertools.generator) look through them at the wrapped
+    element. Subclasses implement parseImpl.'''
+    
+class KeywordDispatch(ParseAccelerator, _Alternatives):
+    '''Drop-in replacement for a MatchFirst whose alternatives (mostly) start with a keyword. Instead of trying the alternatives in
+    order, the word at the parse location is looked up in a table that maps every leading keyword to the alternatives that can 
+    start with it. Alternatives for which no leading keyword can be determined are tried for every word. The order of the original
+    MatchFirst is kept, so the result is the same as that of the MatchFirst. The table is built at the first parse, when all
+    Forward elements have been defined.'''
+    
+    def __init__(self, expr):
+        assert isinstance(expr, MatchFirst), 'KeywordDispatch needs a MatchFirst, got {}'.format(expr.__class__.__name__)
+        super().__init__(expr)
+        self._table = None
+        self._others = None
+        self._word = re.compile('[{}]*([{}]*)'.format(re.escape(ParserElement.DEFAULT_WHITE_CHARS), re.escape(Keyword.DEFAULT_KEYWORD_CHARS)))
+        
+    def _alternatives(self, expr):
+        if isinstance(expr, MatchFirst) and not expr.parseAction and not expr.resultsName:
+            return [a for e in expr.exprs for a in self._alternatives(e)]
+        return [expr]
+    
+    def _buildTable(self):
+        alternatives = self._alternatives(self.expr)
+        keywords = [_leadingKeywords(e) for e in alternatives]
+        table = {}
+        for key in set().union(*[k for k in keywords if k]):
+            table[key] = [e for e, k in zip(alternatives, keywords) if k is None or key in k]
+        self._others = [e for e, k in zip(alternatives, keywords) if k is None]
+        self._all = alternatives
+        self._table = table
+        
+    def parseImpl(self, instring, loc, doActions=True):
+        checkDeadline()
+        if self._table is None:
+            self._buildTable()
+        if self.ignoreExprs:
+            candidates = self._all
+        else:
+            candidates = self._table.get(self._word.match(instring, loc).group(1).upper(), self._others)
+        return self._tryAlternatives(candidates, instring, loc, doActions)
+
+#
+# FIRST set analysis, used by Parser.compile() to prune the alternatives of MatchFirst elements
+#
+
+try:
+    from re import _parser as _sre_parse
+except ImportError:
+    import sre_parse as _sre_parse
+
+_ascii = frozenset(chr(i) for i in range(128))
+# Non-ascii characters that str.upper() maps to an ascii letter, hence are accepted by caseless matching in pyparsing
+_upperAliases = {'I': 'ı', 'S': 'ſ'}
+_categories = {str(c): frozenset(ch for ch in _ascii if re.match(p, ch)) for c, p in [(_sre_parse.CATEGORY_DIGIT, r'\d'), 
+                                                                                     (_sre_parse.CATEGORY_NOT_DIGIT, r'\D'), 
+                                                                                     (_sre_parse.CATEGORY_SPACE, r'\s'), 
+                                                                                     (_sre_parse.CATEGORY_NOT_SPACE, r'\S'), 
+                                                                                     (_sre_parse.CATEGORY_WORD, r'\w'), 
+                                                                                     (_sre_parse.CATEGORY_NOT_WORD, r'\W')]}
+
+class FirstSet:
+    '''Conservative approximation of the set of characters a pattern can start with, i.e. a superset of the true FIRST set. It consists 
+    of a set of characters, a flag nonascii that stands for (some) characters beyond ascii that are not listed explicitly, and a flag 
+    nullable for patterns that can match the empty string (and hence can succeed whatever comes next). A FirstSet with anything set
+    stands for all characters. Whitespace that a pattern skips before matching is included in the characters.'''
+    
+    def __init__(self, chars=(), *, nonascii=False, nullable=False, anything=False):
+        self.chars = frozenset(chars)
+        self.nonascii = nonascii
+        self.nullable = nullable
+        self.anything = anything
+        
+    def __repr__(self):
+        if self.anything:
+            return 'FirstSet(anything=True)'
+        return 'FirstSet({!r}, nonascii={}, nullable={})'.format(''.join(sorted(self.chars)), self.nonascii, self.nullable)
+        
+    def union(self, other):
+        return FirstSet(self.chars | other.chars, nonascii=self.nonascii or other.nonascii, nullable=self.nullable or other.nullable, anything=self.anything or other.anything)
+    
+    def then(self, other):
+        '''Returns the FirstSet of a sequence of this pattern followed by other.'''
+        if self.anything or not self.nullable:
+            return self
+        return FirstSet(self.chars | other.chars, nonascii=self.nonascii or other.nonascii, nullable=other.nullable, anything=other.anything)
+    
+    def canStartWith(self, c):
+        '''Returns False if a pattern with this FirstSet can certainly not match when c is the next character (None at the end of the string).'''
+        if self.anything or self.nullable:
+            return True
+        if c is None:
+            return False
+        return c in self.chars or (self.nonascii and c not in _ascii)
+    
+FirstSet.ANYTHING = FirstSet(anything=True)
+FirstSet.EMPTY = FirstSet(nullable=True)
+    
+def _caselessChars(chars):
+    result = set()
+    for c in chars:
+        for v in (c, c.lower(), c.upper(), c.lower().upper(), c.upper().lower()):
+            if len(v) == 1:
+                result.add(v)
+                if v in _upperAliases:
+                    result.add(_upperAliases[v])
+    return result
+
+def _regexFirst(items, ignorecase):
+    '''Returns the FirstSet of a parsed regular expression (a list of (opcode, argument) pairs), or FirstSet.ANYTHING if it contains
+    constructs that are not analyzed.'''
+    result = FirstSet.EMPTY
+    for op, av in items:
+        if op is _sre_parse.LITERAL:
+            first = FirstSet(_caselessChars([chr(av)]) if ignorecase else [chr(av)], nonascii=ignorecase)
+        elif op is _sre_parse.IN:
+            chars = set()
+            nonascii = ignorecase
+            for cop, cav in av:
+                if cop is _sre_parse.LITERAL:
+                    chars.add(chr(cav))
+                elif cop is _sre_parse.RANGE:
+                    chars.update(chr(i) for i in range(cav[0], min(cav[1], 127) + 1))
+                    nonascii = nonascii or cav[1] > 127
+                elif cop is _sre_parse.CATEGORY and str(cav) in _categories:
+                    chars.update(_categories[str(cav)])
+                    nonascii = True
+                else:
+                    return FirstSet.ANYTHING
+            first = FirstSet(_caselessChars(chars) if ignorecase else chars, nonascii=nonascii)
+        elif op is _sre_parse.BRANCH:
+            first = FirstSet()
+            for branch in av[1]:
+                first = first.union(_regexFirst(branch, ignorecase))
+        elif op is _sre_parse.SUBPATTERN:
+            first = _regexFirst(av[-1], ignorecase or bool(av[1] & re.IGNORECASE))
+        elif op in (_sre_parse.MAX_REPEAT, _sre_parse.MIN_REPEAT, getattr(_sre_parse, 'POSSESSIVE_REPEAT', None)):
+            first = _regexFirst(av[2], ignorecase)
+            if av[0] == 0:
+                first = first.union(FirstSet.EMPTY)
+        elif op in (_sre_parse.AT, _sre_parse.ASSERT, _sre_parse.ASSERT_NOT):
+            first = FirstSet.EMPTY
+        else:
+            return FirstSet.ANYTHING
+        result = result.then(first)
+        if result.anything or not result.nullable:
+            break
+    return result
+
+def firstSet(expr, _memo=None):
+    '''Returns the FirstSet of the pyparsing element expr. Elements that are not analyzed get FirstSet.ANYTHING.'''
+    if _memo is None:
+        _memo = {}
+    if id(expr) in _memo:
+        # A value of None marks an element that is being analyzed, which is only reached again through (left) recursion
+        return _memo[id(expr)] or FirstSet.ANYTHING
+    _memo[id(expr)] = None
+    result = _firstSet(expr, _memo)
+    if not result.anything and expr.skipWhitespace:
+        result = FirstSet(result.chars | set(expr.whiteChars), nonascii=result.nonascii, nullable=result.nullable)
+    if expr.ignoreExprs:
+        result = FirstSet.ANYTHING
+    _memo[id(expr)] = result
+    return result
+    
+def _firstSet(expr, memo):
+    if isinstance(expr, Keyword):
+        if getattr(expr, 'caseless', False):
+            return FirstSet(_caselessChars(expr.match[0]))
+        return FirstSet(expr.match[0])
+    if isinstance(expr, CaselessLiteral):
+        return FirstSet(_caselessChars(expr.match[0]))
+    if isinstance(expr, Literal):
+        return FirstSet(expr.match[0]) if expr.match else FirstSet.EMPTY
+    if isinstance(expr, Regex):
+        try:
+            return _regexFirst(_sre_parse.parse(expr.re.pattern, expr.re.flags), bool(expr.re.flags & re.IGNORECASE))
+        except Exception:
+            return FirstSet.ANYTHING
+    if isinstance(expr, Word) and not isinstance(expr, White):
+        return FirstSet(expr.initChars)
+    if isinstance(expr, (Empty, NotAny, FollowedBy)) and not isinstance(expr, (LineEnd, StringEnd)):
+        return FirstSet.EMPTY
+    if isinstance(expr, And):
+        result = FirstSet.EMPTY
+        for e in expr.exprs:
+            result = result.then(firstSet(e, memo))
+            if result.anything or not result.nullable:
+                break
+        return result
+    if isinstance(expr, MatchFirst):
+        result = FirstSet()
+        for e in expr.exprs:
+            result = result.union(firstSet(e, memo))
+        return result
+    if isinstance(expr, (Optional, ZeroOrMore)):
+        return firstSet(expr.expr, memo).union(FirstSet.EMPTY)
+    if isinstance(expr, (TokenConverter, OneOrMore, Forward, ParseAccelerator)):
+        return firstSet(expr.expr, memo) if expr.expr is not None else FirstSet.ANYTHING
+    return FirstSet.ANYTHING
+
+class PredictiveMatchFirst(MatchFirst, _Alternatives):
+    '''MatchFirst that skips the alternatives whose FirstSet rules out the next character. Parser.compile() turns the MatchFirst elements
+    of a grammar into PredictiveMatchFirst elements in place, so that they keep their names, parse actions and results names.
+    The alternatives that remain are tried in their original order, hence the result is the same as that of a MatchFirst.
+    Copies are plain MatchFirst elements, as their alternatives may be copies that are changed independently.'''
+    
+    _firstTable = None
+    
+    def copy(self):
+        result = super().copy()
+        result.__class__ = MatchFirst
+        return result
+    
+    def append(self, other):
+        self._firstTable = None
+        return super().append(other)
+    
+    def predict(self, memo=None):
+        '''Builds the table from characters to candidate alternatives.'''
+        firsts = [firstSet(e, memo) for e in self.exprs]
+        def candidates(c):
+            return tuple(e for e, f in zip(self.exprs, firsts) if f.canStartWith(c))
+        table = {c: candidates(c) for c in _ascii.union(*[f.chars for f in firsts])}
+        # Non-ascii characters that are not listed explicitly in any FirstSet
+        self._otherCandidates = tuple(e for e, f in zip(self.exprs, firsts) if f.anything or f.nullable or f.nonascii)
+        self._endCandidates = candidates(None)
+        # The table is set last, since a parse in another thread takes the other attributes to be set once it is
+        self._firstTable = table
+        
+    def parseImpl(self, instring, loc, doActions=True):
+        checkDeadline()
+        if self._firstTable is None:
+            self.predict()
+        if loc < len(instring):
+            candidates = self._firstTable.get(instring[loc], self._otherCandidates)
+        else:
+            candidates = self._endCandidates
+        return self._tryAlternatives(candidates, instring, loc, doActions)
+
+#
+# The Parser class, to be instantiated in every Parsertools parser definition module
+#
+
+#
+# Packrat memoization, which is a setting of pyparsing for the whole process (see Parser.setPackrat)
+#
+
+# True if memoization was switched on by Parser.setPackrat, and the cache size it was switched on with
+_packratOwned = False
+_packratCacheSize = None
+_packratLock = threading.Lock()
+
+class Parser:
+    '''Class to be instantiated to contain a parser for the language being implemented.
+    Optionally, it takes a class argument if the language demands functionality in its
+    ParseStruct elements that goes beyond what is provided in base.py. The argument must be
+    a subclass of ParseStruct. The default is to instantiate the parser as a ParseStruct 
+    parser.
+    Packrat memoization can be switched on with the packrat argument or with setPackrat(). It is a setting of the process, and not of
+    the parser: see setPackrat() for details.
+    Before the first parse, the grammar is compiled for predictive parsing (see compile()).
+    Alternatively, parses can be performed by a generated recursive descent parser (see setGenerated()).
+    With the compact argument or setCompact(), parse trees are built in compact form (see ParseStruct.compact()).
+    With the spans argument or setSpans(), the tokens in parse trees are stored as spans of the string that was parsed (see setSpans()).
+    With the shared argument or setShared(), the elements of terminals with a fixed text are shared by all parse trees (see setShared()).
+    With setLexer(), the terminals match on the tokens of a single pass of a Lexer over the string (see setLexer()).'''
+    
+    def __init__(self, class_=ParseStruct, *, packrat=False, packratCacheSize=128, compact=False, spans=False, shared=False):
+        self.class_ = class_
+        if packrat:
+            self.setPackrat(cacheSize=packratCacheSize)
+        self.setCompact(compact)
+        self.setSpans(spans)
+        self.setShared(shared)
+        self._lexer = None
+        self.setGenerated(False)
+        self._firstSets = None
+        
+    def getPatterns(self):
+        '''Returns the patterns of all elements added to this parser.'''
+        return [v._pattern for v in vars(self).values() if isinstance(v, type) and issubclass(v, self.class_) and '_pattern' in vars(v)]
+        
+    def compile(self):
+        '''Computes the FirstSet (see FirstSet) of every registered pattern and of all elements reachable from them, and turns every
+        MatchFirst in the grammar into a PredictiveMatchFirst. At parse time, the alternatives that cannot start with the next character 
+        are then skipped instead of being tried in turn. Since the grammar is modified in place, the result applies to all parses with its 
+        patterns, with or without this parser. Compile is called automatically before the first parse with this parser; it must
+        be called again if the grammar is changed after that.'''
+        memo = {}
+        seen = set()
+        todo = self.getPatterns()
+        for pattern in todo:
+            pattern.streamline()
+        while todo:
+            expr = todo.pop()
+            if id(expr) in seen:
+                continue
+            seen.add(id(expr))
+            children = list(getattr(expr, 'exprs', []))
+            if getattr(expr, 'expr', None) is not None:
+                children.append(expr.expr)
+            todo.extend(children)
+            if isinstance(expr, MatchFirst) and len(expr.exprs) > 1:
+                if type(expr) is MatchFirst:
+                    expr.__class__ = PredictiveMatchFirst
+                expr.predict(memo)
+        self._firstSets = {pattern.name: firstSet(pattern, memo) for pattern in self.getPatterns()}
+        self._generated = None
+        
+    def getFirstSet(self, name):
+        '''Returns the FirstSet of the pattern for the element with the given name.'''
+        if self._firstSets is None:
+            self.compile()
+        return self._firstSets[name]
+        
+    def addElement(self, pattern, newclass=None):
+        if newclass:
+            assert issubclass(newclass, self.class_)
+        else:
+            newclass = self.class_ 
+        setattr(self, pattern.name, type(pattern.name, (newclass,), {'__slots__': (), '_pattern': pattern, '_parser': self}))
+        pattern.setParseAction(parseStructFunc(getattr(self, pattern.name)))
+        
+    @staticmethod
+    def setPackrat(enabled=True, *, cacheSize=128):
+        '''Switches packrat memoization on or off. When on, the results of trying a pattern at a given location in the string being parsed
+        are cached, so that alternatives that fail after a partial match do not cause the same span to be parsed again. The cache is 
+        bounded to cacheSize entries, and is cleared at the start of every parse.
+        Memoization is a setting of pyparsing, which holds for all parsers and all threads of the process, so that it can be switched 
+        off with any parser once it has been switched on with another one. It is meant to be chosen once, at startup, before parses are 
+        performed in other threads. pyparsing serializes the memoized parses of different threads.
+        Switching it on again with a different cacheSize raises a ParsertoolsException. Switching it off only has an effect if it was 
+        switched on with this method: if packrat parsing has been enabled in pyparsing otherwise, that setting is left alone.'''
+        global _packratOwned, _packratCacheSize
+        assert cacheSize is None or cacheSize > 0, 'cacheSize must be positive or None (unbounded), got {}'.format(cacheSize)
+        with _packratLock:
+            if enabled:
+                if not ParserElement._packratEnabled:
+                    ParserElement.enable_packrat(cacheSize)
+                    _packratOwned, _packratCacheSize = True, cacheSize
+                elif _packratOwned and cacheSize != _packratCacheSize:
+                    raise ParsertoolsException('Packrat memoization is switched on with cacheSize {} already, not {}'.format(_packratCacheSize, cacheSize))
+            elif _packratOwned:
+                ParserElement.disable_memoization()
+                _packratOwned = False
+        
+    @staticmethod
+    def getPackrat():
+        '''Returns True if packrat memoization is switched on (see setPackrat).'''
+        return ParserElement._packratEnabled
+    
+    def setCompact(self, enabled=True):
+        '''Switches compact parse trees on or off. When on, the chains of elements with a single element as their only item are collapsed
+        in every element that is parsed from a string with this parser (see ParseStruct.compact()).'''
+        self._compact = enabled
+        
+    def getCompact(self):
+        '''Returns True if compact parse trees are switched on for this parser.'''
+        return self._compact
+    
+    def setSpans(self, enabled=True):
+        '''Switches spans on or off for parses performed with this parser. When on, the tokens in the items of the elements that are built
+        are not stored as strings, but as spans: ints that hold the start and end offsets of the token in the string that was parsed. 
+        That string is shared by all elements of the parse tree, in their _source attribute. A span takes less memory than a string with
+        a copy of the token, except for tokens of a few characters. The spans are turned into strings when an element is rendered, compared
+        or dumped, and by getItems(). Tokens that do not occur literally in the string, such as those of caseless keywords, are stored as
+        strings, as are the tokens of elements that are changed with updateWith().'''
+        self._spans = enabled
+        
+    def getSpans(self):
+        '''Returns True if spans are switched on for this parser.'''
+        return self._spans
+    
+    def setShared(self, enabled=True):
+        '''Switches shared elements on or off for parses performed with this parser. When on, the elements of terminals whose pattern is a
+        Literal or a Keyword, such as punctuation and keywords, are not stored in the parse tree as elements of their own, but as a single 
+        shared element for every class, label and text. Shared elements have no parent and are not to be changed. They stay in the tree 
+        as long as the items of their parent are not accessed, e.g. by rendering, dumping, compacting or searching for elements of other 
+        classes. When the items are accessed, e.g. with getItems, getChildren or descend, or by a search that can return them, the shared 
+        elements among them are replaced by elements of the parent's own, with the attributes of the parent, so that a shared element
+        is never returned.'''
+        self._shared = enabled
+        
+    def getShared(self):
+        '''Returns True if shared elements are switched on for this parser.'''
+        return self._shared
+    
+    def setLexer(self, lexer=None):
+        '''Switches token mode on with lexer, a Lexer, or off with None. In token mode, every registered pattern that is a Regex with the 
+        name, the regex and the flags of a token kind of lexer becomes a TokenRegex, which matches on the kinds of the tokens of the string 
+        being parsed instead of scanning its characters. The string is tokenized once per parse. The resulting elements are the same.
+        As with compile(), the grammar is modified in place, so the mode applies to all parses with its patterns.'''
+        for pattern in self.getPatterns():
+            if isinstance(pattern, TokenRegex):
+                pattern.__class__ = Regex
+                del pattern._lexer, pattern._later
+            if lexer is None or type(pattern) is not Regex or pattern.asGroupList or pattern.asMatch or pattern.re.groupindex:
+                continue
+            if lexer._regexes.get(pattern.name) == pattern.pattern and lexer._flags == pattern.flags:
+                kinds = lexer.getKinds()
+                pattern.__class__ = TokenRegex
+                pattern._lexer = lexer
+                pattern._later = frozenset(kinds[kinds.index(pattern.name) + 1:])
+        self._lexer = lexer
+        
+    def getLexer(self):
+        '''Returns the lexer of the token mode, or None if token mode is off (see setLexer).'''
+        return self._lexer
+    
+    def setGenerated(self, enabled=True, *, cachedir=None):
+        '''Switches parsing with a generated parser on or off. When on, the grammar is translated into a plain Python recursive descent
+        parser (see parsertools.generator) before the first parse, and parses of registered patterns are performed by that parser instead
+        of by pyparsing. The resulting ParseStruct objects are the same. The generated module is cached in cachedir (default
+        ~/.cache/parsertools) under a hash of the grammar, so that it is only generated again when the grammar changes.
+        The packrat setting does not apply to the generated parser.'''
+        self._useGenerated = enabled
+        self._generatedCacheDir = cachedir
+        self._generated = None
+        
+    def getGenerated(self):
+        '''Returns True if parsing with a generated parser is switched on for this parser.'''
+        return self._useGenerated
+        
+    def parseString(self, pattern, expr, *, parseAll=True, spans=None, shared=None):
+        '''Parses expr against pattern and returns the pyparsing ParseResults. If spans or shared is None, the corresponding 
+        setting of the parser is used. If a generated parser is used (see setGenerated), the result is a list with the same tokens.'''
+        if spans is None:
+            spans = self._spans
+        if shared is None:
+            shared = self._shared
+        state = _parseState.spans, _parseState.source, _parseState.shared, _parseState.tokens
+        _parseState.spans = spans
+        _parseState.source = expr if spans and not '\t' in expr else None
+        _parseState.shared = shared
+        _parseState.tokens = None
+        try:
+            return self._parseString(pattern, expr, parseAll=parseAll)
+        finally:
+            _parseState.spans, _parseState.source, _parseState.shared, _parseState.tokens = state
+        
+    def _parseString(self, pattern, expr, *, parseAll=True):
+        if self._firstSets is None:
+            self.compile()
+        if self._useGenerated:
+            if self._generated is None:
+                from parsertools.generator import loadParser
+                self._generated = loadParser(self, self._generatedCacheDir)
+            if self._generated.canParse(pattern):
+                return self._generated.parseString(pattern, expr, parseAll=parseAll)
+        return pattern.parseString(expr, parseAll=parseAll)
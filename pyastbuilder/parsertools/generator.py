@@ -0,0 +1,594 @@
+'''
+Code generator for parsertools parsers. It translates the pyparsing patterns registered with a Parser object into a plain Python module
+with one recursive-descent function per pyparsing element, and loads that module. The generated functions do not use pyparsing at all:
+they match terminals directly against the string, signal failure by returning None instead of raising exceptions, and collect tokens
+in Results objects, a lightweight stand-in for pyparsing's ParseResults. The way tokens and results names are combined mirrors
+pyparsing exactly, so the generated parser builds the same ParseStruct objects, with the same labels, as the pyparsing parser.
+
+Generated modules are cached on disk. Their file name contains a fingerprint of the grammar, so a changed grammar results in a new
+module. Use Parser.setGenerated() to parse with a generated parser.
+'''
+
+import hashlib
+import importlib.util
+import os
+import re
+import tempfile
+
+from pyparsing import *
+from parsertools import GeneratorException
+from parsertools.base import ParseStruct, ParseAccelerator, KeywordDispatch, firstSet, checkDeadline, _setSpans, _setShared
+
+# Part of the fingerprint of generated modules. To be increased whenever the generated code changes.
+GENERATOR_VERSION = 3
+
+defaultCacheDir = os.path.join(os.path.expanduser('~'), '.cache', 'parsertools')
+
+#
+# Runtime support for generated parsers
+#
+
+class Results(list):
+    '''List of tokens, with an optional dict names that maps results names to values. Like a ParseResults object, a Results object only
+    keeps the last value for each name.'''
+
+    names = None
+
+def _mergeNames(results, names):
+    '''Adds names to results, as ParseResults.__iadd__ does.'''
+    if results.names is None:
+        results.names = {}
+    results.names.update(names)
+
+def _setName(results, toklist, name, asList):
+    '''Sets a results name on results, which was constructed from toklist. This follows ParseResults.__init__.'''
+    if not isinstance(toklist, Results) and (toklist is None or (isinstance(toklist, (list, tuple)) and len(toklist) == 0)):
+        return
+    if isinstance(toklist, str):
+        toklist = [toklist]
+    if asList:
+        if isinstance(toklist, Results):
+            value = Results(toklist)
+        else:
+            value = toklist[0]
+            if not isinstance(value, Results):
+                value = Results(value) if isinstance(value, list) else Results([value])
+    else:
+        try:
+            value = toklist[0]
+        except (KeyError, TypeError, IndexError):
+            if toklist is results:
+                return
+            value = toklist
+    if results.names is None:
+        results.names = {}
+    results.names[name] = value
+
+def _results(toklist, name=None, asList=False):
+    '''Returns the Results object for toklist, as ParseResults(toklist, name, asList) does.'''
+    if isinstance(toklist, Results):
+        results = toklist
+    elif isinstance(toklist, list):
+        results = Results(toklist)
+    else:
+        results = Results([toklist])
+    if name:
+        _setName(results, toklist, name, asList)
+    return results
+
+def _itemList(results):
+    '''Converts a Results object to the items of a ParseStruct object. This follows parseStructFunc.'''
+    while len(results) == 1 and isinstance(results[0], Results):
+        results = results[0]
+    valuedict = dict((id(t), k) for (k, t) in results.names.items()) if results.names else {}
+    assert len(valuedict) == (len(results.names) if results.names else 0), 'internal error: duplicate values for results names {}'.format(list(results.names))
+    result = []
+    for t in results:
+        if isinstance(t, str):
+            result.append(t)
+        elif isinstance(t, ParseStruct):
+            if t._label == None:
+                object.__setattr__(t, '_label', valuedict.get(id(t)))
+            result.append(t)
+        elif isinstance(t, Results):
+            assert valuedict.get(id(t)) == None, 'Error: found label ({}) for compound expression {}'.format(valuedict.get(id(t)), t)
+            result.extend(_itemList(t))
+        else:
+            assert isinstance(t, list), type(t)
+            result.append(t)
+    return result
+
+def _makeStruct(class_, results, s, loc):
+    '''Returns the ParseStruct object of class class_ for results, parsed from s at loc. This follows parseStructFunc.'''
+    checkDeadline()
+    result = class_(None)
+    result.setItems(_itemList(results))
+    _setSpans(result, s, loc)
+    _setShared(result)
+    result.createParentPointers(recursive=False)
+    return result
+
+def _makeSeparatedList(results, sep):
+    '''Returns the list of items and separators for results. This follows separatedList.'''
+    assert len(results) > 0, 'internal error'
+    keys = list(results.names) if results.names else []
+    assert len(keys) <= 1, 'internal error, got more than one key: {}'.format(keys)
+    label = keys[0] if len(keys) == 1 else None
+    templist = []
+    for item in results:
+        if isinstance(item, ParseStruct):
+            object.__setattr__(item, '_label', label)
+        else:
+            assert isinstance(item, str)
+        templist.append(item)
+    result = [templist[0]]
+    for p in templist[1:]:
+        result.append(sep)
+        result.append(p)
+    return result
+
+def _asStringList(results, sep=''):
+    out = []
+    for item in results:
+        if out and sep:
+            out.append(sep)
+        if isinstance(item, Results):
+            out += _asStringList(item)
+        else:
+            out.append(str(item))
+    return out
+
+def _combine(results, joinString, named):
+    '''Returns the tokens of a Combine element for results. This follows Combine.postParse.'''
+    result = Results([''.join(_asStringList(results, joinString))])
+    if results.names:
+        result.names = dict(results.names)
+    if named and result.names:
+        return [result]
+    return result
+
+def _table(entries, end):
+    '''Returns the dict that maps every character in the strings of entries to the corresponding candidates, and the empty string, 
+    which stands for the end of the string, to end.'''
+    result = {'': end}
+    for chars, candidates in entries:
+        for c in chars:
+            result[c] = candidates
+    return result
+
+class GeneratedParser:
+    '''Wrapper for a generated parser module, bound to the Parser object it was generated from.'''
+
+    def __init__(self, parser, module, fingerprint):
+        self.parser = parser
+        self.module = module
+        self.fingerprint = fingerprint
+        module.bind(parser)
+
+    def canParse(self, pattern):
+        return id(pattern) in self.module.entries
+
+    def parseString(self, pattern, expr, *, parseAll=True):
+        '''Parses expr against pattern, in the same way as pattern.parseString(expr, parseAll=parseAll) does, and returns a Results object.
+        Raises a ParseException if expr cannot be parsed.'''
+        func, keepTabs, skip = self.module.entries[id(pattern)]
+        if not keepTabs:
+            expr = expr.expandtabs()
+        failure = self.module._failure
+        failure.loc = 0
+        result = func(expr, skip(expr, 0).end() if skip else 0)
+        if result is None:
+            raise ParseException(expr, failure.loc, 'Expected {}'.format(pattern.name), pattern)
+        loc, tokens = result
+        if parseAll:
+            loc = self.module._skipEnd(expr, loc).end()
+            if loc < len(expr):
+                raise ParseException(expr, loc, 'Expected end of text', pattern)
+        return tokens
+
+#
+# The generator
+#
+
+def _skipName(whiteChars):
+    return '_ws_' + hashlib.sha1(''.join(sorted(whiteChars)).encode()).hexdigest()[:8]
+
+class _Generator:
+    '''Translates the pyparsing elements reachable from the patterns of a Parser object into Python source code. Every element gets a
+    number, and a spec: a tuple with everything the generated code depends on. The fingerprint of the grammar is computed from the specs.'''
+
+    def __init__(self, parser):
+        if parser._firstSets is None:
+            parser.compile()
+        self.parser = parser
+        self.patterns = parser.getPatterns()
+        self.actions = {}
+        for pattern in self.patterns:
+            for action in pattern.parseAction:
+                self.actions[id(action)] = pattern.name
+        self.numbers = {}
+        self.elements = []
+        for pattern in self.patterns:
+            self.number(pattern)
+        self.firstMemo = {}
+        self.specs = [self.spec(e) for e in self.elements]
+
+    def number(self, expr):
+        todo = [expr]
+        while todo:
+            e = todo.pop()
+            if id(e) in self.numbers:
+                continue
+            self.numbers[id(e)] = len(self.elements)
+            self.elements.append(e)
+            todo.extend(reversed(self.children(e)))
+
+    def children(self, e):
+        if isinstance(e, ParseExpression):
+            return list(e.exprs)
+        if isinstance(e, ParseElementEnhance):
+            return [e.expr] if e.expr is not None else []
+        return []
+
+    def fingerprint(self):
+        return hashlib.sha256(repr((GENERATOR_VERSION, self.specs)).encode()).hexdigest()
+
+    def unsupported(self, e, what=''):
+        raise GeneratorException('Cannot generate code for {} element {}{}'.format(e.__class__.__name__, e, what))
+
+    def spec(self, e):
+        '''Returns the spec of element e: (kind, details, children, resultsName, saveAsList, skip, callPreparse, action).'''
+        if e.ignoreExprs:
+            self.unsupported(e, ' with ignore expressions')
+        if not e.modalResults:
+            self.unsupported(e, ' with listAllMatches results name')
+        if e.debug or e.failAction:
+            self.unsupported(e, ' in debug mode or with a fail action')
+        action = None
+        if e.parseAction:
+            if len(e.parseAction) == 1 and id(e.parseAction[0]) in self.actions:
+                action = ('struct', self.actions[id(e.parseAction[0])])
+            elif len(e.parseAction) == 1 and getattr(e, '_separator', None) is not None and e.parseAction[0].__name__ == 'makeList':
+                action = ('separatedList', e._separator)
+            else:
+                self.unsupported(e, ' with parse action {}'.format([a.__name__ for a in e.parseAction]))
+        children = tuple(self.numbers[id(c)] for c in self.children(e))
+        if type(e) is Empty:
+            details = ()
+            kind = 'Empty'
+        elif isinstance(e, Keyword):
+            details = (e.match, ''.join(sorted(e.identChars)), bool(e.caseless))
+            kind = 'Keyword'
+        elif isinstance(e, CaselessLiteral):
+            details = (e.match, e.returnString)
+            kind = 'CaselessLiteral'
+        elif isinstance(e, Literal):
+            details = (e.match,)
+            kind = 'Literal'
+        elif isinstance(e, Regex):
+            if e.re.groupindex or e.asGroupList or e.asMatch:
+                self.unsupported(e, ' with named groups or non-string results')
+            details = (e.re.pattern, e.re.flags)
+            kind = 'Regex'
+        elif type(e) in (NotAny, And, Group, Suppress, Forward, Opt, ZeroOrMore, OneOrMore, Combine, KeywordDispatch):
+            kind = type(e).__name__
+            details = ()
+            if isinstance(e, (ZeroOrMore, OneOrMore)) and (e.not_ender is not None or e.max_count is not None):
+                self.unsupported(e, ' with stopOn or a maximum number of matches')
+            if isinstance(e, Opt):
+                notMatched = e.defaultValue is Opt._Opt__optionalNotMatched
+                details = (notMatched, None if notMatched else repr(e.defaultValue), e.expr.resultsName)
+                if not notMatched and not isinstance(e.defaultValue, str):
+                    self.unsupported(e, ' with non-string default value')
+            elif isinstance(e, Combine):
+                details = (e.joinString,)
+            elif isinstance(e, Group) and e._asPythonList:
+                self.unsupported(e, ' with aslist')
+            elif isinstance(e, KeywordDispatch):
+                if e._table is None:
+                    e._buildTable()
+                details = (tuple(sorted((key, tuple(self.numbers[id(a)] for a in alternatives)) for key, alternatives in e._table.items())),
+                           tuple(self.numbers[id(a)] for a in e._others), e._word.pattern)
+        elif isinstance(e, MatchFirst):
+            kind = 'MatchFirst'
+            details = self.prediction(e)
+        elif isinstance(e, ParseAccelerator) or (isinstance(e, ParseElementEnhance) and type(e).parseImpl is ParseElementEnhance.parseImpl and type(e).postParse is ParserElement.postParse):
+            # Accelerators parse the same as the element they wrap, for which code is generated
+            kind = 'Enhance'
+            details = ()
+        else:
+            self.unsupported(e)
+        skip = ''.join(sorted(e.whiteChars)) if e.skipWhitespace else None
+        return (kind, details, children, e.resultsName or None, bool(e.saveAsList), skip, bool(e.callPreparse), action)
+
+    def prediction(self, e):
+        '''Returns the table of candidate alternatives for the next character, as in PredictiveMatchFirst, as a tuple of (characters,
+        candidates) pairs, followed by the candidates for other characters and those for the end of the string.'''
+        firsts = [firstSet(a, self.firstMemo) for a in e.exprs]
+        numbers = [self.numbers[id(a)] for a in e.exprs]
+        def candidates(c):
+            return tuple(n for n, f in zip(numbers, firsts) if f.canStartWith(c))
+        groups = {}
+        for c in sorted(set(chr(i) for i in range(128)).union(*[f.chars for f in firsts])):
+            groups.setdefault(candidates(c), []).append(c)
+        others = tuple(n for n, f in zip(numbers, firsts) if f.anything or f.nullable or f.nonascii)
+        return (tuple(sorted((''.join(chars), cands) for cands, chars in groups.items())), others, candidates(None))
+
+    #
+    # Code generation
+    #
+
+    def generate(self):
+        self.lines = []
+        self.constants = []
+        self.constantNames = {}
+        self.skips = set()
+        self.tables = []
+        for n, spec in enumerate(self.specs):
+            self.function(n, spec)
+        out = ["# Parser generated by parsertools.generator (version {}) from grammar {}. Do not edit.".format(GENERATOR_VERSION, self.fingerprint()),
+               'import re',
+               'import threading',
+               'from parsertools.generator import Results, _mergeNames, _results, _makeStruct, _makeSeparatedList, _combine, _table',
+               '']
+        defaultWhiteChars = ''.join(sorted(ParserElement.DEFAULT_WHITE_CHARS))
+        for whiteChars in sorted(self.skips | {defaultWhiteChars}):
+            out.append('{} = re.compile({!r}).match'.format(_skipName(whiteChars), '[{}]*'.format(re.escape(whiteChars))))
+        out.append('_skipEnd = {}'.format(_skipName(defaultWhiteChars)))
+        out.append('# The furthest location at which a terminal failed to match, per thread, for the location of parse errors')
+        out.append('_failure = threading.local()')
+        out.extend(self.constants)
+        out.append('')
+        out.extend(self.lines)
+        out.extend(self.tables)
+        out.append('')
+        out.append('def bind(parser):')
+        out.append('    global entries')
+        classes = sorted({spec[7][1] for spec in self.specs if spec[7] and spec[7][0] == 'struct'})
+        for name in classes:
+            out.append('    globals()[{!r}] = parser.{}'.format('C_' + name, name))
+        out.append('    patterns = dict((pattern.name, pattern) for pattern in parser.getPatterns())')
+        out.append('    entries = {')
+        for pattern in self.patterns:
+            n = self.numbers[id(pattern)]
+            spec = self.specs[n]
+            skip = _skipName(spec[5]) if spec[5] is not None and spec[6] else None
+            out.append('        id(patterns[{!r}]): (p{}, {}, {}),'.format(pattern.name, n, pattern.keepTabs, skip))
+        out.append('    }')
+        out.append('')
+        return '\n'.join(out)
+
+    def constant(self, source):
+        '''Returns the name of a module level constant with the given source.'''
+        if source not in self.constantNames:
+            self.constantNames[source] = 'K{}'.format(len(self.constants))
+            self.constants.append('{} = {}'.format(self.constantNames[source], source))
+        return self.constantNames[source]
+
+    def call(self, n, loc, callPreParse):
+        '''Returns the expression for calling the function for element n at loc.'''
+        skip = self.skip(n) if callPreParse else None
+        if skip is not None:
+            loc = '{}(s, {}).end()'.format(skip, loc)
+        return 'p{}(s, {})'.format(n, loc)
+
+    def function(self, n, spec):
+        kind, details, children, name, saveAsList, skip, callPreparse, action = spec
+        e = self.elements[n]
+        emit = self.lines.append
+        emit('def p{}(s, loc):'.format(n))
+        emit('    # {}: {}'.format(kind, str(e).replace('\n', ' ')[:100]))
+        if action and action[0] == 'struct':
+            emit('    start = loc')
+        # The tokens returned by parseImpl and postParse are put in t. tokenType is the type of t, if it is known here.
+        tokenType = 'Results'
+        if kind == 'Literal':
+            m = self.constant(repr(details[0]))
+            emit('    if not s.startswith({}, loc):'.format(m))
+            self.fail()
+            emit('    loc += {}'.format(len(details[0])))
+            emit('    t = {}'.format(m))
+            tokenType = 'str'
+        elif kind == 'CaselessLiteral':
+            emit('    if s[loc:loc + {}].upper() != {!r}:'.format(len(details[0]), details[0]))
+            self.fail()
+            emit('    loc += {}'.format(len(details[0])))
+            emit('    t = {}'.format(self.constant(repr(details[1]))))
+            tokenType = 'str'
+        elif kind == 'Keyword':
+            match, identChars, caseless = details
+            m = self.constant(repr(match))
+            ident = self.constant('frozenset({!r})'.format(identChars))
+            size = len(match)
+            if caseless:
+                emit('    if s[loc:loc + {}].upper() != {!r} or (loc > 0 and s[loc - 1].upper() in {}) or (loc < len(s) - {} and s[loc + {}].upper() in {}):'.format(size, match.upper(), ident, size, size, ident))
+            else:
+                emit('    if not s.startswith({}, loc) or (loc > 0 and s[loc - 1] in {}) or (loc < len(s) - {} and s[loc + {}] in {}):'.format(m, ident, size, size, ident))
+            self.fail()
+            emit('    loc += {}'.format(size))
+            emit('    t = {}'.format(m))
+            tokenType = 'str'
+        elif kind == 'Regex':
+            r = self.constant('re.compile({!r}, {}).match'.format(details[0], details[1]))
+            emit('    m = {}(s, loc)'.format(r))
+            emit('    if m is None:')
+            self.fail()
+            emit('    loc = m.end()')
+            emit('    t = m.group()')
+            tokenType = 'str'
+        elif kind in ('Empty', 'NotAny'):
+            if kind == 'NotAny':
+                emit('    if {} is not None:'.format(self.call(children[0], 'loc', True)))
+                emit('        return None')
+            emit('    t = []')
+            tokenType = 'list'
+        elif kind == 'And':
+            for i, c in enumerate(children):
+                emit('    r = {}'.format(self.call(c, 'loc', i > 0)))
+                emit('    if r is None:')
+                emit('        return None')
+                if i == 0:
+                    emit('    loc, t = r')
+                else:
+                    emit('    loc, x = r')
+                    emit('    t += x')
+                    emit('    if x.names:')
+                    emit('        _mergeNames(t, x.names)')
+        elif kind in ('MatchFirst', 'KeywordDispatch'):
+            self.alternatives(n, kind, details)
+        elif kind in ('Group', 'Suppress', 'Forward', 'Combine', 'Enhance'):
+            if not children:
+                emit('    return None')
+            else:
+                emit('    r = {}'.format(self.call(children[0], 'loc', False)))
+                emit('    if r is None:')
+                emit('        return None')
+                emit('    loc, t = r')
+            if kind == 'Group':
+                emit('    t = [t]')
+                tokenType = 'list'
+            elif kind == 'Suppress':
+                emit('    t = []')
+                tokenType = 'list'
+            elif kind == 'Combine':
+                emit('    t = _combine(t, {!r}, {})'.format(details[0], bool(name)))
+                tokenType = None
+        elif kind == 'Opt':
+            notMatched, default, childName = details
+            emit('    r = {}'.format(self.call(children[0], 'loc', False)))
+            emit('    if r is None:')
+            if notMatched:
+                emit('        t = []')
+            elif childName:
+                emit('        t = Results([{}])'.format(default))
+                emit('        t.names = {{{!r}: t[0]}}'.format(childName))
+            else:
+                emit('        t = [{}]'.format(default))
+            emit('    else:')
+            emit('        loc, t = r')
+            tokenType = None
+        elif kind in ('ZeroOrMore', 'OneOrMore'):
+            emit('    r = {}'.format(self.call(children[0], 'loc', True)))
+            emit('    if r is None:')
+            if kind == 'OneOrMore':
+                emit('        return None')
+            else:
+                emit('        return loc, Results()')
+            emit('    loc, t = r')
+            emit('    while True:')
+            emit('        r = {}'.format(self.call(children[0], 'loc', True)))
+            emit('        if r is None:')
+            emit('            break')
+            emit('        loc, x = r')
+            emit('        t += x')
+            emit('        if x.names:')
+            emit('            _mergeNames(t, x.names)')
+        else:
+            raise GeneratorException('internal error: unknown kind {}'.format(kind))
+        # ret_tokens = ParseResults(tokens, self.resultsName, asList=self.saveAsList)
+        if name:
+            emit('    r = _results(t, {!r}, {})'.format(name, saveAsList))
+        elif tokenType == 'Results':
+            emit('    r = t')
+        elif tokenType == 'str':
+            emit('    r = Results([t])')
+        else:
+            emit('    r = _results(t)')
+        if action and action[0] == 'struct':
+            emit('    r = Results([_makeStruct(C_{}, r, s, start)])'.format(action[1]))
+            if name:
+                emit('    r.names = {{{!r}: r[0]}}'.format(name))
+        elif action:
+            emit('    t = _makeSeparatedList(r, {!r})'.format(action[1]))
+            emit('    r = _results(t, {!r}, {})'.format(name, saveAsList) if name else '    r = Results(t)')
+        emit('    return loc, r')
+        emit('')
+
+    def fail(self):
+        '''Emits the code for a terminal that fails to match at loc, which records loc if it is the furthest failure so far.'''
+        emit = self.lines.append
+        emit('        if loc > _failure.loc:')
+        emit('            _failure.loc = loc')
+        emit('        return None')
+
+    def candidates(self, numbers, mixed):
+        '''Returns the source of a tuple of candidate functions. If the candidates do not all skip the same whitespace, the tuple holds
+        (function, skip) pairs instead.'''
+        if not mixed:
+            return ''.join('p{}, '.format(c) for c in numbers)
+        return ''.join('(p{}, {}), '.format(c, self.skip(c)) for c in numbers)
+
+    def skip(self, n):
+        '''Returns the name of the whitespace skipping function to be applied before a call to element n with callPreParse=True, or None.'''
+        skip, callPreparse = self.specs[n][5], self.specs[n][6]
+        if skip is None or not callPreparse:
+            return None
+        self.skips.add(skip)
+        return _skipName(skip)
+
+    def alternatives(self, n, kind, details):
+        '''Emits the code for trying the candidate alternatives of a MatchFirst or KeywordDispatch element in order.'''
+        emit = self.lines.append
+        # All alternatives are called with callPreParse=True. If they skip the same whitespace, this is done once, before trying them.
+        entries, others = details[:2]
+        skips = {self.skip(c) for c in others + tuple(c for _, cands in entries for c in cands)}
+        mixed = len(skips) > 1
+        table = 'T{}'.format(n)
+        default = 'D{}'.format(n)
+        if kind == 'MatchFirst':
+            self.tables.append('{} = ({})'.format(default, self.candidates(others, mixed)))
+            self.tables.append('{} = _table([{}], ({}))'.format(table, ', '.join('({!r}, ({}))'.format(chars, self.candidates(cands, mixed)) for chars, cands in entries),
+                                                             self.candidates(details[2], mixed)))
+            candidates = '{}.get(s[loc:loc + 1], {})'.format(table, default)
+        else:
+            word = details[2]
+            self.tables.append('{} = ({})'.format(default, self.candidates(others, mixed)))
+            self.tables.append('{} = {{{}}}'.format(table, ', '.join('{!r}: ({})'.format(key, self.candidates(cands, mixed)) for key, cands in entries)))
+            w = self.constant('re.compile({!r}).match'.format(word))
+            candidates = '{}.get({}(s, loc).group(1).upper(), {})'.format(table, w, default)
+        if mixed:
+            emit('    for f, w in {}:'.format(candidates))
+            emit('        r = f(s, w(s, loc).end() if w else loc)')
+        else:
+            skip = skips.pop() if skips else None
+            if skip is not None:
+                emit('    loc = {}(s, loc).end()'.format(skip))
+            emit('    for f in {}:'.format(candidates))
+            emit('        r = f(s, loc)')
+        emit('        if r is not None:')
+        emit('            break')
+        emit('    else:')
+        emit('        return None')
+        emit('    loc, t = r')
+
+def grammarFingerprint(parser):
+    '''Returns the fingerprint of the grammar of parser, as used for the file names of generated modules.'''
+    return _Generator(parser).fingerprint()
+
+def generateSource(parser):
+    '''Returns the source code of a generated parser module for parser.'''
+    return _Generator(parser).generate()
+
+def loadParser(parser, cachedir=None):
+    '''Returns a GeneratedParser for parser. The generated module is taken from cachedir if it has been generated before for the same
+    grammar, otherwise it is generated and stored there. The default cache directory is ~/.cache/parsertools.'''
+    if cachedir is None:
+        cachedir = defaultCacheDir
+    generator = _Generator(parser)
+    fingerprint = generator.fingerprint()
+    modulename = 'parsertools_generated_{}'.format(fingerprint[:32])
+    path = os.path.join(cachedir, modulename + '.py')
+    if not os.path.isfile(path):
+        os.makedirs(cachedir, exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(suffix='.py', dir=cachedir)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(generator.generate())
+            os.replace(tmppath, path)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+    spec = importlib.util.spec_from_file_location(modulename, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return GeneratedParser(parser, module, fingerprint)
@@ -4,8 +4,9 @@ Created on 28 mrt. 2016
 @author: jeroenbruijning
 '''
 from pyparsing import *
-from parsertools.base import ParseStruct, parseStructFunc, separatedList
+from parsertools.base import ParseStruct, Parser, Lexer, ParseAccelerator, KeywordDispatch, parseStructFunc, separatedList, deadlineScope, checkDeadline, _setSpans, _setShared, _isShared
 from parsertools import ParsertoolsException, NoPrefixError
+from parsertools.visitor import Visitor, VisitorSet
 import rfc3987
 import re
 
@@ -25,20 +26,31 @@ class SPARQLElement(ParseStruct):
     '''Optional subclass of ParseStruct for the language. Typically, this class contains attributes and methods for the language that
     go beyond context free parsing, such as pre- and post processing, checking for conditions not covered by the grammar, etc.'''
     
-    def __init__(self, expr, base=None, postParseCheck=True):
+    __slots__ = ('_prefixes', '_baseiri')
+    
+    def __init__(self, expr, base=None, postParseCheck=True, compact=None, spans=None, shared=None, deadline=None, timeout=None):
         '''This constructor has an optional argument "base". This is the externally determined base iri, as per SPARQL definition par. 4.1.1.2.
         It is only applied when the constructor is called with a string as expression to be parsed. (For internal bootstrapping purposes,
-        the constructor can also be called with expr equal to "None". See also the documentation for the ParseStruct constructor.)'''
-        ParseStruct.__init__(self, expr)
-        self.__dict__['_prefixes'] = {}
-        self.__dict__['_baseiri'] = None
-        if not expr is None:
-            self._applyPrefixesAndBase(baseiri=base)
-            if postParseCheck:
-                self._checkParsedQuery()
+        the constructor can also be called with expr equal to "None". See also the documentation for the ParseStruct constructor.)
+        The optional arguments compact, spans and shared override the corresponding settings of SPARQLParser for this parse.
+        The element is compacted after the prefixes and base have been applied and the checks have been performed.
+        The optional arguments deadline and timeout bound the time taken by the parse and the post processing together (see deadlineScope).
+        When the deadline passes, a ParseTimeoutError is raised.'''
+        if expr is None:
+            ParseStruct.__init__(self, None)
+            object.__setattr__(self, '_prefixes', {})
+            object.__setattr__(self, '_baseiri', None)
+        else:
+            with deadlineScope(deadline=deadline, timeout=timeout):
+                ParseStruct.__init__(self, expr, compact=False, spans=spans, shared=shared)
+                self._applyPrefixesAndBase(baseiri=base)
+                if postParseCheck:
+                    self._checkParsedQuery()
+                if self._useCompact(compact):
+                    self.compact()
                     
     def _applyPrefixesAndBase(self, prefixes={}, baseiri=None):
-        '''Recursively attaches information to the element about the prefixes and base-iri valid at this point
+        '''Attaches information to the element and its descendants about the prefixes and base-iri valid at this point
         in the expression, as determined by PREFIX and BASE declarations in the query.
         The parameter baseiri is as determined by the environment or an enveloping parsed entity. It must be an absolute
         IRI, or None.
@@ -49,27 +61,36 @@ class SPARQLElement(ParseStruct):
         This is purely a syntactic (substitution) operation. Use other available tests afterwards to check whether iris can be correctly
         expanded using base and prefixes in force at their location. The function _checkParsedQuery can be used for this.'''
         
-        self.__dict__['_prefixes'] = prefixes
-        self.__dict__['_baseiri'] = baseiri
-        if baseiri:
-            assert rfc3987.parse(baseiri, rule='absolute_IRI')
-        prefixes = prefixes.copy()
-        for elt in self.getChildren():
-            if isinstance(elt, SPARQLParser.Prologue):
-                for decl in elt.getChildren():
-                    if isinstance(decl, SPARQLParser.PrefixDecl):
-                        assert str(decl.prefix) not in prefixes, 'Prefixes: {}, prefix: {}'.format(prefixes, decl.prefix)
-                        prefixes[str(decl.prefix)] = str(decl.namespace)[1:-1]
-                    else:
-                        assert isinstance(decl, SPARQLParser.BaseDecl)
-                        iripart = str(decl.baseiri)[1:-1]
-                        try:
-                            rfc3987.parse(iripart, rule='absolute_IRI')
-                            baseiri = iripart
-                        except ValueError:
-                            baseiri = rfc3987.resolve(baseiri, str(decl.baseiri)[1:-1])
-                            assert rfc3987.parse(baseiri, rule='absolute_IRI')                            
-            elt._applyPrefixesAndBase(prefixes, baseiri)
+        # The elements still to be visited, the next one last, with the prefixes of their parent, a copy of these as they were when the
+        # element was reached, and their baseiri
+        stack = [(self, prefixes, prefixes.copy(), baseiri)]
+        while stack:
+            checkDeadline()
+            element, prefixes, ownPrefixes, baseiri = stack.pop()
+            object.__setattr__(element, '_prefixes', prefixes)
+            object.__setattr__(element, '_baseiri', baseiri)
+            if baseiri:
+                assert rfc3987.parse(baseiri, rule='absolute_IRI')
+            prefixes = ownPrefixes
+            children = []
+            # Shared elements are left alone (see Parser.setShared)
+            for elt in [i for i in element._items if isinstance(i, ParseStruct) and not _isShared(i)]:
+                if isinstance(elt, SPARQLParser.Prologue):
+                    for decl in elt.getChildren():
+                        if isinstance(decl, SPARQLParser.PrefixDecl):
+                            assert str(decl.prefix) not in prefixes, 'Prefixes: {}, prefix: {}'.format(prefixes, decl.prefix)
+                            prefixes[str(decl.prefix)] = str(decl.namespace)[1:-1]
+                        else:
+                            assert isinstance(decl, SPARQLParser.BaseDecl)
+                            iripart = str(decl.baseiri)[1:-1]
+                            try:
+                                rfc3987.parse(iripart, rule='absolute_IRI')
+                                baseiri = iripart
+                            except ValueError:
+                                baseiri = rfc3987.resolve(baseiri, str(decl.baseiri)[1:-1])
+                                assert rfc3987.parse(baseiri, rule='absolute_IRI')                            
+                children.append((elt, prefixes, prefixes.copy(), baseiri))
+            stack.extend(reversed(children))
             
     def getPrefixes(self):
         return self._prefixes
@@ -80,59 +101,25 @@ class SPARQLElement(ParseStruct):
     def expandIris(self):
         '''Converts all contained iri elements to normal form, taking into account the prefixes and base in force at the location of the iri.
         The expansions are performed in place.'''
-        for elt in self.searchElements(element_type=SPARQLParser.iri):
-            children = elt.getChildren()
-            assert len(children) == 1, children
-            child = children[0]
-            newiriref = '<' + getExpansion(child) + '>'
-            elt.updateWith(newiriref)
+        expandIrisVisitor.visit(self)
              
     def processEscapeSeqs(self):
-        for stringtype in [SPARQLParser.STRING_LITERAL2, SPARQLParser.STRING_LITERAL1, SPARQLParser.STRING_LITERAL_LONG1, SPARQLParser.STRING_LITERAL_LONG2]:
-            for elt in self.searchElements(element_type=stringtype):
-                elt.updateWith(stringEscape(str(elt)))
+        escapeSeqsVisitor.visit(self)
 
     def _checkExpansion(self):
-        iris = self.searchElements(element_type=SPARQLParser.PrefixedName) + self.searchElements(element_type=SPARQLParser.IRIREF)
-        for iri in iris:
-            expansion = getExpansion(iri)
-            assert rfc3987.match(expansion, rule='IRI_reference'), 'Expression "{}" with expansion "{}" is not an IRI Reference'.format(iri, expansion)
+        expansionVisitor.visit(self)
 
     def _checkParsedQuery(self):
         '''Used to perform additional checks on the ParseStruct resulting from a parsing action. These are conditions that are not covered by the EBNF syntax.
-        See the applicable comments and remarks in https://www.w3.org/TR/sparql11-query/, sections 19.1 - 19.8.'''
+        See the applicable comments and remarks in https://www.w3.org/TR/sparql11-query/, sections 19.1 - 19.8.
+        The checks are done by the visitors in checkVisitors, in a single traversal.'''
         
-        # See 19.5 "IRI References"
-        self._checkExpansion()
+        VisitorSet(checkVisitors).visit(self)
             
         
     #  TODO: finish
 
 #
-# The following is boilerplate code, to be included in every Parsertools parser definition module
-#
-
-class Parser:
-    '''Class to be instantiated to contain a parser for the language being implemented.
-    This code must be present in the parser definition file for the language.
-    Optionally, it takes a class argument if the language demands functionality in its
-    ParseStruct elements that goes beyond what is provided in base.py. The argument must be
-    a subclass of ParseStruct. The default is to instantiate the parser as a ParseStruct 
-    parser.'''
-    
-    def __init__(self, class_=ParseStruct):
-        self.class_ = class_
-#     def addElement(self, pattern):
-#         setattr(self, pattern.name, type(pattern.name, (self.class_,), {'_pattern': pattern}))
-#         pattern.setParseAction(parseStructFunc(getattr(self, pattern.name)))
-    def addElement(self, pattern, newclass=None):
-        if newclass:
-            assert issubclass(newclass, self.class_)
-        else:
-            newclass = self.class_ 
-        setattr(self, pattern.name, type(pattern.name, (newclass,), {'_pattern': pattern}))
-        pattern.setParseAction(parseStructFunc(getattr(self, pattern.name)))
-#
 # Create the SPARQLParser object, optionally with a custom ParseStruct subclass
 #
 
@@ -142,22 +129,34 @@ SPARQLParser = Parser(SPARQLElement)
 # Main function to call. This is a convenience function, adapted to the SPARQL definition.
 #
 
-def parseQuery(querystring, base=None):
-    '''Entry point to parse any SPARQL query'''
-    
-    s = prepareQuery(querystring)
-    
-    # In SPARQL, there are two entry points to the grammar: QueryUnit and UpdateUnit. These are tried in order.
+def parseQuery(querystring, base=None, compact=None, spans=None, shared=None, deadline=None, timeout=None):
+    '''Entry point to parse any SPARQL query. If compact is True or False, it overrides the compact setting of SPARQLParser (see Parser.setCompact),
+    spans the spans setting (see Parser.setSpans) and shared the shared setting (see Parser.setShared). With spans, the tokens are stored 
+    as spans of the query after comment removal.
+    The optional arguments deadline (a time.monotonic() value) and timeout (in seconds) bound the time taken by the whole process, 
+    including the post processing. When the deadline passes, a ParseTimeoutError is raised (see deadlineScope).'''
     
-    try:
-        result = SPARQLParser.QueryUnit(s, base=base)
-    except ParseException:
-        try:
-            result = SPARQLParser.UpdateUnit(s, base=base)
-        except ParseException:
-            raise SPARQLParseException('Query {} cannot be parsed'.format(querystring))
+    with deadlineScope(deadline=deadline, timeout=timeout):
+        s = prepareQuery(querystring)
         
-    result.processEscapeSeqs()    
+        # In SPARQL, there are two entry points to the grammar: QueryUnit and UpdateUnit. The entry point is chosen by the first keyword
+        # after the prologue (see classifyRequest), so that the string is parsed only once. If it cannot be classified, both are tried in order.
+        
+        unit = classifyRequest(s)
+        units = [unit] if unit else [SPARQLParser.QueryUnit, SPARQLParser.UpdateUnit]
+        for unit in units:
+            try:
+                result = unit(s, base=base, postParseCheck=False, compact=False, spans=spans, shared=shared)
+                break
+            except ParseException:
+                pass
+        else:
+            raise SPARQLParseException('Query {} cannot be parsed'.format(querystring))
+            
+        # The checks of SPARQLElement._checkParsedQuery and the processing of escape sequences are done in a single traversal
+        postParseVisitors.visit(result)
+        if result._useCompact(compact):
+            result.compact()
     
     return result
 
@@ -174,17 +173,59 @@ def prepareQuery(querystring):
     return querystring
 
 
+# Keywords that start the first operation of a query or an update request, after the prologue
+queryKeywords = {'SELECT', 'CONSTRUCT', 'DESCRIBE', 'ASK'}
+updateKeywords = {'LOAD', 'CLEAR', 'DROP', 'CREATE', 'ADD', 'MOVE', 'COPY', 'INSERT', 'DELETE', 'WITH'}
+
+def classifyRequest(querystring):
+    '''Returns SPARQLParser.QueryUnit or SPARQLParser.UpdateUnit, depending on the first keyword after the prologue of the prepared querystring.
+    A string that consists of a prologue only is an (empty) update request. Returns None if the string cannot be classified this way, e.g. because 
+    it has a malformed prologue. Only the tokens up to the first keyword are read, with SPARQLLexer.'''
+    expected = ()
+    try:
+        for token in SPARQLLexer.iterTokens(querystring):
+            if token.kind == 'COMMENT':
+                continue
+            if expected:
+                if token.kind != expected[0]:
+                    return None
+                expected = expected[1:]
+            elif token.kind == 'NAME':
+                keyword = token.text.upper()
+                if keyword == 'BASE':
+                    expected = ('IRIREF',)
+                elif keyword == 'PREFIX':
+                    expected = ('PNAME_NS', 'IRIREF')
+                elif keyword in queryKeywords:
+                    return SPARQLParser.QueryUnit
+                elif keyword in updateKeywords:
+                    return SPARQLParser.UpdateUnit
+                else:
+                    return None
+            else:
+                return None
+    except ParsertoolsException:
+        return None
+    return None if expected else SPARQLParser.UpdateUnit
+
 def stripComments(text):
-    '''Strips SPARQL-style comments from a multiline string'''
+    '''Strips SPARQL-style comments from a multiline string. The text is scanned in a single pass with commentLexer, so that a '#' inside
+    a string or an IRIREF is not taken as the start of a comment, and long strings may span several lines. Leading whitespace is removed from 
+    every line, and the strings, iris and runs of other text on a line are separated by a single space. As before the text was scanned in a 
+    single pass, tabs are expanded to spaces (with tab stops every 8 columns) first, also in strings.'''
     if isinstance(text, list):
         text = '\n'.join(text)
-    Comment = Literal('#') + SkipTo(lineEnd)
-    NormalText = Regex('[^#<\'"]+')    
-    Line = ZeroOrMore(String | (IRIREF | Literal('<')) | NormalText) + Optional(Comment) + lineEnd
-    Line.ignore(Comment)
-    Line.setParseAction(lambda tokens: ' '.join([t if isinstance(t, str) else t.__str__() for t in tokens]))
-    lines = text.split('\n')
-    return '\n'.join([Line.parseString(l)[0] for l in lines])
+    text = text.expandtabs()
+    lines = []
+    parts = []
+    for token in commentLexer.iterTokens(text):
+        if token.kind == 'NEWLINE':
+            lines.append(' '.join(parts))
+            parts = []
+        elif token.kind != 'COMMENT':
+            parts.append(token.text)
+    lines.append(' '.join(parts))
+    return '\n'.join(lines)
 
 def unescapeUcode(s):
     
@@ -232,6 +273,29 @@ def getExpansion(iri):
 
     
     
+def expandIri(iri):
+    '''Replaces the child of iri by its normal form (see getExpansion and SPARQLElement.expandIris).'''
+    children = iri.getChildren()
+    assert len(children) == 1, children
+    child = children[0]
+    newiriref = '<' + getExpansion(child) + '>'
+    iri.updateWith(newiriref)
+
+def processEscapeSeq(string):
+    '''Replaces the escape sequences in a string literal element (see stringEscape and SPARQLElement.processEscapeSeqs).'''
+    checkDeadline()
+    old = str(string)
+    new = stringEscape(old)
+    # Strings without escape sequences are left alone, and keep their spans, if any (see Parser.setSpans)
+    if new != old:
+        string.updateWith(new)
+
+def checkExpansion(iri):
+    '''Checks that a PrefixedName or IRIREF element expands to an IRI reference (see SPARQLElement._checkExpansion).'''
+    checkDeadline()
+    expansion = getExpansion(iri)
+    assert rfc3987.match(expansion, rule='IRI_reference'), 'Expression "{}" with expansion "{}" is not an IRI Reference'.format(iri, expansion)
+
 def stringEscape(s):
     s = s.replace(r'\t', '\u0009')   
     s = s.replace(r'\n', '\u000A')   
@@ -674,6 +738,16 @@ SPARQLParser.addElement(BASE)
 # Parsers and classes for terminals
 #
 
+# The regular expressions for terminals that are built from other terminals are written such that at every position at most one 
+# alternative can match: character classes are merged into a single class (see charClass), and repetitions of the form (A | '.')* A
+# are unrolled into A* ('.'+ A+)*. Python's backtracking regex engine then matches (or fails) in time linear in the length of the 
+# input, also on long or crafted names and strings.
+
+def charClass(*classes):
+    '''Returns a regex for a single character class that is the union of classes, each a regex of the form '[...]'.'''
+    assert all(c.startswith('[') and c.endswith(']') and not c.startswith('[^') for c in classes), classes
+    return '[' + ''.join(c[1:-1] for c in classes) + ']'
+
 # [173]   PN_LOCAL_ESC      ::=   '\' ( '_' | '~' | '.' | '-' | '!' | '$' | '&' | "'" | '(' | ')' | '*' | '+' | ',' | ';' | '=' | '/' | '?' | '#' | '@' | '%' ) 
 PN_LOCAL_ESC_e = r'\\[_~.\-!$&\'()*+,;=/?#@%]'
 PN_LOCAL_ESC = Regex(PN_LOCAL_ESC_e).setName('PN_LOCAL_ESC')
@@ -686,12 +760,12 @@ HEX = Regex(HEX_e).setName('HEX')
 SPARQLParser.addElement(HEX)
 
 # [171]   PERCENT   ::=   '%' HEX HEX
-PERCENT_e = r'%({})({})'.format( HEX_e, HEX_e)
+PERCENT_e = r'%{}{}'.format( HEX_e, HEX_e)
 PERCENT = Regex(PERCENT_e).setName('PERCENT')
 SPARQLParser.addElement(PERCENT)
 
 # [170]   PLX       ::=   PERCENT | PN_LOCAL_ESC 
-PLX_e = r'({})|({})'.format( PERCENT_e, PN_LOCAL_ESC_e)
+PLX_e = r'{}|{}'.format( PERCENT_e, PN_LOCAL_ESC_e)
 PLX = Regex(PLX_e).setName('PLX')
 SPARQLParser.addElement(PLX)
 
@@ -701,27 +775,28 @@ PN_CHARS_BASE = Regex(PN_CHARS_BASE_e).setName('PN_CHARS_BASE')
 SPARQLParser.addElement(PN_CHARS_BASE)
 
 # [165]   PN_CHARS_U        ::=   PN_CHARS_BASE | '_' 
-PN_CHARS_U_e = r'({})|({})'.format( PN_CHARS_BASE_e, r'_')
+PN_CHARS_U_e = charClass(PN_CHARS_BASE_e, r'[_]')
 PN_CHARS_U = Regex(PN_CHARS_U_e).setName('PN_CHARS_U')
 SPARQLParser.addElement(PN_CHARS_U)
 
 # [167]   PN_CHARS          ::=   PN_CHARS_U | '-' | [0-9] | #x00B7 | [#x0300-#x036F] | [#x203F-#x2040] 
-PN_CHARS_e = r'({})|({})|({})|({})|({})|({})'.format( PN_CHARS_U_e, r'\-', r'[0-9]',  r'\u00B7', r'[\u0300-\u036F]', r'[\u203F-\u2040]')
+PN_CHARS_e = charClass(PN_CHARS_U_e, r'[\-0-9\u00B7\u0300-\u036F\u203F-\u2040]')
 PN_CHARS = Regex(PN_CHARS_e).setName('PN_CHARS')
 SPARQLParser.addElement(PN_CHARS)
 
 # [169]   PN_LOCAL          ::=   (PN_CHARS_U | ':' | [0-9] | PLX ) ((PN_CHARS | '.' | ':' | PLX)* (PN_CHARS | ':' | PLX) )?
-PN_LOCAL_e = r'(({})|({})|({})|({}))((({})|({})|({})|({}))*(({})|({})|({})))?'.format( PN_CHARS_U_e, r':', r'[0-9]', PLX_e, PN_CHARS_e, r'\.', r':', PLX_e, PN_CHARS_e, r':', PLX_e) 
+PN_LOCAL_e = r'(?:{}|{})(?:{}|{})*(?:\.+(?:{}|{})+)*'.format( charClass(PN_CHARS_U_e, r'[:0-9]'), PLX_e, charClass(PN_CHARS_e, r'[:]'), PLX_e, charClass(PN_CHARS_e, r'[:]'), PLX_e)
 PN_LOCAL = Regex(PN_LOCAL_e).setName('PN_LOCAL')
 SPARQLParser.addElement(PN_LOCAL)
             
 # [168]   PN_PREFIX         ::=   PN_CHARS_BASE ((PN_CHARS|'.')* PN_CHARS)?
-PN_PREFIX_e = r'({})((({})|({}))*({}))?'.format( PN_CHARS_BASE_e, PN_CHARS_e, r'\.', PN_CHARS_e)
+PN_PREFIX_e = r'{}{}*(?:\.+{}+)*'.format( PN_CHARS_BASE_e, PN_CHARS_e, PN_CHARS_e)
 PN_PREFIX = Regex(PN_PREFIX_e).setName('PN_PREFIX')
 SPARQLParser.addElement(PN_PREFIX)
 
 # [166]   VARNAME   ::=   ( PN_CHARS_U | [0-9] ) ( PN_CHARS_U | [0-9] | #x00B7 | [#x0300-#x036F] | [#x203F-#x2040] )* 
-VARNAME_e = r'(({})|({}))(({})|({})|({})|({})|({}))*'.format( PN_CHARS_U_e, r'[0-9]', PN_CHARS_U_e, r'[0-9]', r'\u00B7', r'[\u0030-036F]', r'[\u0203-\u2040]')
+# Note that, as in earlier versions, the range [#x0203-#x2040] is used for the last two alternatives, which is wider than the grammar prescribes.
+VARNAME_e = r'{}{}*'.format( charClass(PN_CHARS_U_e, r'[0-9]'), charClass(PN_CHARS_U_e, r'[0-9\u00B7\u0203-\u2040]'))
 VARNAME = Regex(VARNAME_e).setName('VARNAME')
 SPARQLParser.addElement(VARNAME)
 
@@ -743,22 +818,22 @@ ECHAR = Regex(ECHAR_e).setName('ECHAR')
 SPARQLParser.addElement(ECHAR)
  
 # [159]   STRING_LITERAL_LONG2      ::=   '"""' ( ( '"' | '""' )? ( [^"\] | ECHAR ) )* '"""'  
-STRING_LITERAL_LONG2_e = r'"""((""|")?(({})|({})))*"""'.format(r'[^"\\]', ECHAR_e)
+STRING_LITERAL_LONG2_e = r'"""{0}*(?:(?:{1}|""?(?:{0}|{1})){0}*)*"""'.format(r'[^"\\]', ECHAR_e)
 STRING_LITERAL_LONG2 = Regex(STRING_LITERAL_LONG2_e).parseWithTabs().setName('STRING_LITERAL_LONG2')
 SPARQLParser.addElement(STRING_LITERAL_LONG2)
 
 # [158]   STRING_LITERAL_LONG1      ::=   "'''" ( ( "'" | "''" )? ( [^'\] | ECHAR ) )* "'''" 
-STRING_LITERAL_LONG1_e = r"'''(('|'')?(({})|({})))*'''".format(r"[^'\\]", ECHAR_e)
+STRING_LITERAL_LONG1_e = r"'''{0}*(?:(?:{1}|''?(?:{0}|{1})){0}*)*'''".format(r"[^'\\]", ECHAR_e)
 STRING_LITERAL_LONG1 = Regex(STRING_LITERAL_LONG1_e).parseWithTabs().setName('STRING_LITERAL_LONG1')
 SPARQLParser.addElement(STRING_LITERAL_LONG1)
 
 # [157]   STRING_LITERAL2   ::=   '"' ( ([^#x22#x5C#xA#xD]) | ECHAR )* '"' 
-STRING_LITERAL2_e = r'"(({})|({}))*"'.format(ECHAR_e, r'[^\u0022\u005C\u000A\u000D]')
+STRING_LITERAL2_e = r'"{1}*(?:{0}{1}*)*"'.format(ECHAR_e, r'[^\u0022\u005C\u000A\u000D]')
 STRING_LITERAL2 = Regex(STRING_LITERAL2_e).parseWithTabs().setName('STRING_LITERAL2')
 SPARQLParser.addElement(STRING_LITERAL2)
                            
 # [156]   STRING_LITERAL1   ::=   "'" ( ([^#x27#x5C#xA#xD]) | ECHAR )* "'" 
-STRING_LITERAL1_e = r"'(({})|({}))*'".format(ECHAR_e, r'[^\u0027\u005C\u000A\u000D]')
+STRING_LITERAL1_e = r"'{1}*(?:{0}{1}*)*'".format(ECHAR_e, r'[^\u0027\u005C\u000A\u000D]')
 STRING_LITERAL1 = Regex(STRING_LITERAL1_e).parseWithTabs().setName('STRING_LITERAL1')
 SPARQLParser.addElement(STRING_LITERAL1)
                             
@@ -828,7 +903,7 @@ VAR1 = Regex(VAR1_e).setName('VAR1')
 SPARQLParser.addElement(VAR1)
 
 # [142]   BLANK_NODE_LABEL          ::=   '_:' ( PN_CHARS_U | [0-9] ) ((PN_CHARS|'.')* PN_CHARS)?
-BLANK_NODE_LABEL_e = r'_:(({})|[0-9])((({})|\.)*({}))?'.format(PN_CHARS_U_e, PN_CHARS_e, PN_CHARS_e)
+BLANK_NODE_LABEL_e = r'_:{}{}*(?:\.+{}+)*'.format(charClass(PN_CHARS_U_e, r'[0-9]'), PN_CHARS_e, PN_CHARS_e)
 BLANK_NODE_LABEL = Regex(BLANK_NODE_LABEL_e).setName('BLANK_NODE_LABEL')
 SPARQLParser.addElement(BLANK_NODE_LABEL)
 
@@ -847,6 +922,236 @@ IRIREF_e = r'<[^<>"{}|^`\\\\\u0000-\u0020]*>'
 IRIREF = Regex(IRIREF_e).setName('IRIREF')
 SPARQLParser.addElement(IRIREF)
 
+#
+# Lexers for SPARQL terminals
+#
+
+# Lexer used by stripComments. It only distinguishes what matters for finding comments: strings and iris, in which a '#' does not start
+# a comment, and runs of other text. A stray quote that does not start a valid string is passed on as is and left for the parser to reject,
+# together with the rest of the would-be string up to where it fails, so that this part is not scanned again from every quote in it.
+# A '<' that does not start an IRIREF is kept together with a following '=', as it may be the operator '<='.
+commentLexer = Lexer([('IRIREF', IRIREF_e),
+                      ('STRING_LITERAL_LONG1', STRING_LITERAL_LONG1_e),
+                      ('STRING_LITERAL_LONG2', STRING_LITERAL_LONG2_e),
+                      ('STRING_LITERAL1', STRING_LITERAL1_e),
+                      ('STRING_LITERAL2', STRING_LITERAL2_e),
+                      ('LT', r'<=?'),
+                      ('TEXT', r'[^#<\'"\n]+'),
+                      ('COMMENT', r'#[^\n]*'),
+                      ('NEWLINE', r'\n'),
+                      ('QUOTE', r'\'[^\'\\\n\r]*(?:{0}[^\'\\\n\r]*)*|"[^"\\\n\r]*(?:{0}[^"\\\n\r]*)*'.format(ECHAR_e))], skip=r'[ \t\r]+')
+
+# Lexer producing the token stream of a (prepared) SPARQL string. Token kinds are named after the corresponding terminals and
+# punctuation patterns. Keywords, the 'a' shorthand and boolean literals all have kind NAME, their text is to be compared caselessly
+# where the grammar does so. As in the grammar, a '-' or '+' before a number is a separate token.
+# SPARQLParser.setLexer(SPARQLLexer) switches on token mode, in which the terminals with a kind of their own match on these tokens (see
+# Parser.setLexer). It is off by default: with predictive parsing, terminals are seldom tried twice at the same place, so that the
+# tokenizing pass costs about as much as it saves.
+SPARQLLexer = Lexer([('COMMENT', r'#[^\n]*'),
+                     ('IRIREF', IRIREF_e),
+                     ('STRING_LITERAL_LONG1', STRING_LITERAL_LONG1_e),
+                     ('STRING_LITERAL_LONG2', STRING_LITERAL_LONG2_e),
+                     ('STRING_LITERAL1', STRING_LITERAL1_e),
+                     ('STRING_LITERAL2', STRING_LITERAL2_e),
+                     ('PNAME_LN', PNAME_LN_e),
+                     ('PNAME_NS', PNAME_NS_e),
+                     ('BLANK_NODE_LABEL', BLANK_NODE_LABEL_e),
+                     ('VAR1', VAR1_e),
+                     ('VAR2', VAR2_e),
+                     ('LANGTAG', LANGTAG_e),
+                     ('DOUBLE', DOUBLE_e),
+                     ('DECIMAL', DECIMAL_e),
+                     ('INTEGER', INTEGER_e),
+                     ('NAME', r'[A-Za-z][A-Za-z0-9_]*'),
+                     ('DATATYPE', r'\^\^'),
+                     ('NE', r'!='),
+                     ('GE', r'>='),
+                     ('LE', r'<='),
+                     ('AND', r'&&'),
+                     ('OR', r'\|\|'),
+                     ('LPAR', r'\('),
+                     ('RPAR', r'\)'),
+                     ('LBRACK', r'\['),
+                     ('RBRACK', r'\]'),
+                     ('LCURL', r'\{'),
+                     ('RCURL', r'\}'),
+                     ('SEMICOL', r';'),
+                     ('PERIOD', r'\.'),
+                     ('COMMA', r','),
+                     ('NEGATE', r'!'),
+                     ('PLUS', r'\+'),
+                     ('MINUS', r'\-'),
+                     ('TIMES', r'\*'),
+                     ('DIV', r'/'),
+                     ('EQ', r'='),
+                     ('GT', r'>'),
+                     ('LT', r'<'),
+                     ('INVERSE', r'\^'),
+                     ('ALTERNATIVE', r'\|'),
+                     ('QUESTION', r'\?')])
+
+#
+# Precedence climbing parser for expressions
+#
+
+class ExpressionParser(ParseAccelerator):
+    '''Parser for productions [111] - [118], from ConditionalOrExpression down to UnaryExpression, to be wrapped around their pyparsing 
+    pattern. The operators of every precedence level are matched directly against the string, in a loop per level, and the elements 
+    of the levels are built directly, instead of by the nested pyparsing elements that every operand otherwise passes through. The 
+    operands (PrimaryExpression), and the rare ExpressionList and signed numeric literal operands, are parsed with their own patterns.
+    The alternatives of every level are tried in the order of the grammar, with the same backtracking, so the resulting elements are 
+    the same as those of the wrapped pattern. Without parse actions (e.g. in lookaheads), and to report a failure, the wrapped pattern 
+    is used.'''
+    
+    def __init__(self, expr):
+        super().__init__(expr)
+        self._skip = re.compile('[{}]*'.format(re.escape(ParserElement.DEFAULT_WHITE_CHARS))).match
+        # The levels, from low to high precedence. Each has a method, the name of its class and its operators, in the order of the grammar.
+        self._levels = [(self._binary, 'ConditionalOrExpression', [('||', 'OR')]),
+                        (self._binary, 'ConditionalAndExpression', [('&&', 'AND')]),
+                        (self._single, 'ValueLogical', None),
+                        (self._relational, 'RelationalExpression', [('=', 'EQ'), ('!=', 'NE'), ('<', 'LT'), ('>', 'GT'), ('<=', 'LE'), ('>=', 'GE')]),
+                        (self._single, 'NumericExpression', None),
+                        (self._additive, 'AdditiveExpression', [('+', 'PLUS'), ('-', 'MINUS')]),
+                        (self._binary, 'MultiplicativeExpression', [('*', 'TIMES'), ('/', 'DIV')]),
+                        (self._unary, 'UnaryExpression', [('!', 'NEGATE'), ('+', 'PLUS'), ('-', 'MINUS')])]
+        
+    def parseImpl(self, instring, loc, doActions=True):
+        result = self._parseLevel(0, instring, loc) if doActions else None
+        if result is None:
+            # The wrapped pattern raises the same exception as when it is used by itself
+            return self.expr._parse(instring, loc, doActions, callPreParse=False)
+        loc, element = result
+        return loc, [element]
+    
+    def _parseLevel(self, level, instring, loc):
+        '''Returns (loc, element) for the element of the given level at loc, or None if there is none.'''
+        method, name, operators = self._levels[level]
+        return method(level, getattr(SPARQLParser, name), operators, instring, loc)
+    
+    def _parsePattern(self, pattern, instring, loc):
+        '''Returns (loc, element) for the pattern of an element at loc, or None if there is none.'''
+        try:
+            loc, tokens = pattern._parse(instring, loc)
+        except (ParseException, IndexError):
+            return None
+        return loc, tokens[0]
+        
+    def _element(self, class_, items, instring, loc):
+        '''Returns the element of class_ with the given items, parsed from instring at loc.'''
+        element = class_(None)
+        element.setItems(items)
+        _setSpans(element, instring, loc)
+        _setShared(element)
+        element.createParentPointers(recursive=False)
+        return element
+    
+    def _peek(self, instring, loc):
+        '''Returns the first character after the whitespace at loc, or '' at the end of instring.'''
+        loc = self._skip(instring, loc).end()
+        return instring[loc:loc + 1]
+    
+    def _operator(self, operators, instring, loc):
+        '''Yields the operators that can be matched at loc, with the location after them, in order.'''
+        loc = self._skip(instring, loc).end()
+        for op, name in operators:
+            if instring.startswith(op, loc):
+                yield self._element(getattr(SPARQLParser, name), [op], instring, loc), loc + len(op)
+    
+    def _single(self, level, class_, operators, instring, loc):
+        # E.g. ValueLogical ::= RelationalExpression
+        start = loc
+        result = self._parseLevel(level + 1, instring, loc)
+        if result is None:
+            return None
+        loc, operand = result
+        return loc, self._element(class_, [operand], instring, start)
+    
+    def _binary(self, level, class_, operators, instring, loc):
+        # E.g. ConditionalAndExpression ::= ValueLogical ( '&&' ValueLogical )*
+        start = loc
+        result = self._parseLevel(level + 1, instring, loc)
+        if result is None:
+            return None
+        loc, operand = result
+        items = [operand]
+        while True:
+            for op, oploc in self._operator(operators, instring, loc):
+                result = self._parseLevel(level + 1, instring, oploc)
+                if result is not None:
+                    loc, operand = result
+                    items.extend([op, operand])
+                    break
+            else:
+                return loc, self._element(class_, items, instring, start)
+    
+    def _relational(self, level, class_, operators, instring, loc):
+        # RelationalExpression ::= NumericExpression ( '=' NumericExpression | ... | 'IN' ExpressionList | 'NOT' 'IN' ExpressionList )?
+        start = loc
+        result = self._parseLevel(level + 1, instring, loc)
+        if result is None:
+            return None
+        loc, operand = result
+        for op, oploc in self._operator(operators, instring, loc):
+            result = self._parseLevel(level + 1, instring, oploc)
+            if result is not None:
+                return result[0], self._element(class_, [operand, op, result[1]], instring, start)
+        for pattern in IN, NOT_IN:
+            result = self._parsePattern(pattern, instring, loc) if self._peek(instring, loc).upper() in ('I', 'N') else None
+            if result is not None:
+                oploc, op = result
+                result = self._parsePattern(ExpressionList, instring, oploc)
+                if result is not None:
+                    return result[0], self._element(class_, [operand, op, result[1]], instring, start)
+        return loc, self._element(class_, [operand], instring, start)
+    
+    def _additive(self, level, class_, operators, instring, loc):
+        # AdditiveExpression ::= MultiplicativeExpression ( '+' MultiplicativeExpression | '-' MultiplicativeExpression | 
+        #                        ( NumericLiteralPositive | NumericLiteralNegative ) ( ( '*' UnaryExpression ) | ( '/' UnaryExpression ) )* )*
+        start = loc
+        result = self._parseLevel(level + 1, instring, loc)
+        if result is None:
+            return None
+        loc, operand = result
+        items = [operand]
+        while True:
+            for op, oploc in self._operator(operators, instring, loc):
+                result = self._parseLevel(level + 1, instring, oploc)
+                if result is not None:
+                    loc, operand = result
+                    items.extend([op, operand])
+                    break
+            else:
+                result = None
+                if self._peek(instring, loc) in ('+', '-'):
+                    result = self._parsePattern(NumericLiteralPositive, instring, loc) or self._parsePattern(NumericLiteralNegative, instring, loc)
+                if result is None:
+                    return loc, self._element(class_, items, instring, start)
+                loc, literal = result
+                items.append(literal)
+                # The operands of these operators are UnaryExpressions, at the level below MultiplicativeExpression
+                multiplicative = self._levels[level + 1][2]
+                while True:
+                    for op, oploc in self._operator(multiplicative, instring, loc):
+                        result = self._parseLevel(level + 2, instring, oploc)
+                        if result is not None:
+                            loc, operand = result
+                            items.extend([op, operand])
+                            break
+                    else:
+                        break
+    
+    def _unary(self, level, class_, operators, instring, loc):
+        # UnaryExpression ::= '!' PrimaryExpression | '+' PrimaryExpression | '-' PrimaryExpression | PrimaryExpression
+        for op, oploc in self._operator(operators, instring, loc):
+            result = self._parsePattern(PrimaryExpression, instring, oploc)
+            if result is not None:
+                return result[0], self._element(class_, [op, result[1]], instring, loc)
+        result = self._parsePattern(PrimaryExpression, instring, loc)
+        if result is None:
+            return None
+        return result[0], self._element(class_, [result[1]], instring, loc)
+
 #
 # Parsers and classes for non-terminals
 #
@@ -910,13 +1215,13 @@ SPARQLParser.addElement(iriOrFunction)
 #             | 'AVG' '(' 'DISTINCT'? Expression ')' 
 #             | 'SAMPLE' '(' 'DISTINCT'? Expression ')' 
 #             | 'GROUP_CONCAT' '(' 'DISTINCT'? Expression ( ';' 'SEPARATOR' '=' String )? ')' 
-Aggregate = Group((COUNT('count') + LPAR + Optional(DISTINCT('distinct')) + ( ALL_VALUES('all') | Expression('expression') ) + RPAR ) | 
+Aggregate = Group(KeywordDispatch((COUNT('count') + LPAR + Optional(DISTINCT('distinct')) + ( ALL_VALUES('all') | Expression('expression') ) + RPAR ) | 
             ( SUM('sum') + LPAR + Optional(DISTINCT('distinct')) + ( ALL_VALUES('all') | Expression('expression') ) + RPAR ) | 
             ( MIN('min') + LPAR + Optional(DISTINCT('distinct')) + ( ALL_VALUES('all') | Expression('expression') ) + RPAR ) | 
             ( MAX('max') + LPAR + Optional(DISTINCT('distinct')) + ( ALL_VALUES('all') | Expression('expression') ) + RPAR ) | 
             ( AVG('avg') + LPAR + Optional(DISTINCT('distinct')) + ( ALL_VALUES('all') | Expression('expression') ) + RPAR ) | 
             ( SAMPLE('sample') + LPAR + Optional(DISTINCT('distinct')) + ( ALL_VALUES('all') | Expression('expression') ) + RPAR ) | 
-            ( GROUP_CONCAT('group_concat') + LPAR + Optional(DISTINCT('distinct')) + Expression('expression') + Optional( SEMICOL + SEPARATOR + '=' + String('separator') ) + RPAR)).setName('Aggregate')
+            ( GROUP_CONCAT('group_concat') + LPAR + Optional(DISTINCT('distinct')) + Expression('expression') + Optional( SEMICOL + SEPARATOR + '=' + String('separator') ) + RPAR))).setName('Aggregate')
 SPARQLParser.addElement(Aggregate)
 
 GroupGraphPattern = Forward().setName('GroupGraphPattern')
@@ -1005,7 +1310,7 @@ SPARQLParser.addElement(ExpressionList)
 #             | RegexExpression 
 #             | ExistsFunc 
 #             | NotExistsFunc 
-BuiltInCall = Group(Aggregate | 
+BuiltInCall = Group(KeywordDispatch(Aggregate | 
                 STR + LPAR + Expression('expression') + RPAR    | 
                 LANG + LPAR + Expression('expression') + RPAR    | 
                 LANGMATCHES + LPAR + Expression('language-tag') + COMMA + Expression('language-range') + RPAR    | 
@@ -1059,7 +1364,7 @@ BuiltInCall = Group(Aggregate |
                 isNUMERIC + LPAR + Expression('expression') + RPAR    | 
                 RegexExpression | 
                 ExistsFunc | 
-                NotExistsFunc ).setName('BuiltInCall')
+                NotExistsFunc )).setName('BuiltInCall')
 SPARQLParser.addElement(BuiltInCall)
 
 # [120]   BrackettedExpression      ::=   '(' Expression ')' 
@@ -1113,7 +1418,7 @@ ConditionalOrExpression = Group(ConditionalAndExpression + ZeroOrMore(OR + Condi
 SPARQLParser.addElement(ConditionalOrExpression)
 
 # [110]   Expression        ::=   ConditionalOrExpression 
-Expression << Group(ConditionalOrExpression + Empty())
+Expression << ExpressionParser(Group(ConditionalOrExpression + Empty()))
 
 # [109]   GraphTerm         ::=   iri | RDFLiteral | NumericLiteral | BooleanLiteral | BlankNode | NIL 
 GraphTerm =   Group(iri | 
@@ -1334,7 +1639,7 @@ OptionalGraphPattern = Group(OPTIONAL + GroupGraphPattern ).setName('OptionalGra
 SPARQLParser.addElement(OptionalGraphPattern)
 
 # [56]    GraphPatternNotTriples    ::=   GroupOrUnionGraphPattern | OptionalGraphPattern | MinusGraphPattern | GraphGraphPattern | ServiceGraphPattern | Filter | Bind | InlineData 
-GraphPatternNotTriples = Group(GroupOrUnionGraphPattern | OptionalGraphPattern | MinusGraphPattern | GraphGraphPattern | ServiceGraphPattern | Filter | Bind | InlineData ).setName('GraphPatternNotTriples')
+GraphPatternNotTriples = Group(KeywordDispatch(GroupOrUnionGraphPattern | OptionalGraphPattern | MinusGraphPattern | GraphGraphPattern | ServiceGraphPattern | Filter | Bind | InlineData )).setName('GraphPatternNotTriples')
 SPARQLParser.addElement(GraphPatternNotTriples)
                                            
 # [55]    TriplesBlock      ::=   TriplesSameSubjectPath ( '.' TriplesBlock? )? 
@@ -1440,7 +1745,7 @@ Load = Group(LOAD + Optional(SILENT) + iri  + Optional(INTO + GraphRef)).setName
 SPARQLParser.addElement(Load)
 
 # [30]    Update1   ::=   Load | Clear | Drop | Add | Move | Copy | Create | InsertData | DeleteData | DeleteWhere | Modify 
-Update1 = Group(Load | Clear | Drop | Add | Move | Copy | Create | InsertData | DeleteData | DeleteWhere | Modify ).setName('Update1')
+Update1 = Group(KeywordDispatch(Load | Clear | Drop | Add | Move | Copy | Create | InsertData | DeleteData | DeleteWhere | Modify )).setName('Update1')
 SPARQLParser.addElement(Update1)
 
 Prologue = Forward().setName('Prologue')
@@ -1556,11 +1861,27 @@ UpdateUnit = Group(Update('update')).setName('UpdateUnit')
 SPARQLParser.addElement(UpdateUnit)
 
 # [2]     Query     ::=   Prologue ( SelectQuery | ConstructQuery | DescribeQuery | AskQuery ) ValuesClause 
-Query = Group(Prologue('prologue') + ( SelectQuery | ConstructQuery | DescribeQuery | AskQuery ) + ValuesClause ).setName('Query')
+Query = Group(Prologue('prologue') + KeywordDispatch( SelectQuery | ConstructQuery | DescribeQuery | AskQuery ) + ValuesClause ).setName('Query')
 SPARQLParser.addElement(Query)
 
 # [1]     QueryUnit         ::=   Query 
 QueryUnit = Group(Query).setName('QueryUnit')
 SPARQLParser.addElement(QueryUnit)
 
+#
+# Visitors for the post processing of parsed queries (see parsertools.visitor)
+#
+
+expandIrisVisitor = Visitor([(SPARQLParser.iri, expandIri)])
+
+escapeSeqsVisitor = Visitor([(stringtype, processEscapeSeq) for stringtype in [SPARQLParser.STRING_LITERAL2, SPARQLParser.STRING_LITERAL1, 
+                                                                              SPARQLParser.STRING_LITERAL_LONG1, SPARQLParser.STRING_LITERAL_LONG2]])
+
+# See 19.5 "IRI References"
+expansionVisitor = Visitor([(SPARQLParser.PrefixedName, checkExpansion), (SPARQLParser.IRIREF, checkExpansion)])
+
+# The checks of SPARQLElement._checkParsedQuery
+checkVisitors = [expansionVisitor]
 
+# The post processing of parseQuery, in a single traversal
+postParseVisitors = VisitorSet(checkVisitors + [escapeSeqsVisitor])
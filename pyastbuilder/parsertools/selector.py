@@ -0,0 +1,321 @@
+'''
+Structural selectors for parse trees, in a syntax modelled on CSS selectors. Elements are matched by the names of their classes, that is
+by the names of the productions of the grammar, so selectors work for the trees of any language defined with a Parser object.
+
+A selector is a comma separated list of alternatives. An alternative is a sequence of compound selectors, separated by combinators:
+
+- A B: an element matching B that has an ancestor matching A,
+- A > B: an element matching B of which the parent matches A.
+
+A compound selector is a class name, or * for any class, followed by any number of conditions without whitespace in between, or just
+the conditions:
+
+- [label]: the element has a label,
+- [label=name]: the element has the label name,
+- [text="..."]: the string of the element (see ParseStruct.__str__) is the quoted text, in which a backslash escapes the next character,
+- :root: the element has no parent,
+- :not(selector): the element does not match the selector,
+- :inside(selector): an ancestor of the element matches the selector.
+
+Examples are 'SelectQuery > WhereClause GroupGraphPattern TriplesBlock', 'iri[label=datatype_uri]' and 'Var:not(:inside(SubSelect))'.
+
+A selector is compiled to nested functions once, when its Selector object is created. The matches of a selector in a tree are found in a
+single traversal, which keeps the ancestors of the element at hand on a stack. The combinators and :inside are tested against that stack,
+and not by following the parent pointers. A SelectorSet finds the matches of a number of selectors in the same traversal. At every
+element, only the alternatives of which the last compound selector can match its class are tried.
+'''
+
+import functools
+import re
+
+from parsertools import ParsertoolsException, SelectorException
+from parsertools.base import ParseStruct, Lexer, _parentOf
+
+_selectorLexer = Lexer([('NAME', r'[A-Za-z_][A-Za-z0-9_]*'),
+                        ('STRING', r'"(?:[^"\\]|\\.)*"|' + r"'(?:[^'\\]|\\.)*'"),
+                        ('STAR', r'\*'),
+                        ('GT', r'>'),
+                        ('COMMA', r','),
+                        ('LBRACK', r'\['),
+                        ('RBRACK', r'\]'),
+                        ('EQ', r'='),
+                        ('COLON', r':'),
+                        ('LPAR', r'\('),
+                        ('RPAR', r'\)'),
+                        ])
+
+# The functions that selectors are compiled to take an element, the stack of ancestors of the traversal, and the number of ancestors of
+# the element on that stack, so that path[:depth] are the ancestors of the element. They return True if the element matches.
+
+class _Compound:
+    '''A compound selector: the class name it requires, or None, and its conditions. nested holds the alternatives of the selectors
+    of its pseudo-classes.'''
+
+    def __init__(self, name, conditions, nested):
+        self.name = name
+        self.nested = nested
+        if name is None:
+            self.test = lambda element, path, depth: all(c(element, path, depth) for c in conditions)
+        elif conditions:
+            self.test = lambda element, path, depth: element.__class__.__name__ == name and all(c(element, path, depth) for c in conditions)
+        else:
+            self.test = lambda element, path, depth: element.__class__.__name__ == name
+
+class _Alternative:
+    '''A sequence of compound selectors with the combinators between them. The last compound selector is matched with the element, and
+    the others, from right to left, with its ancestors.'''
+
+    def __init__(self, compounds, children):
+        # children[i] is True if compounds[i] must match the parent of the element matched by compounds[i + 1], rather than an ancestor
+        self.compounds = compounds
+        self.children = children
+        tests = [c.test for c in compounds]
+        last = len(compounds) - 1
+        # With only descendant combinators before compounds[i], the nearest ancestor that matches it will do
+        nearest = [not any(children[:i]) for i in range(len(compounds))]
+
+        def ancestors(i, path, depth):
+            '''Returns True if compounds[i] and those before it match ancestors among path[:depth].'''
+            if i < 0:
+                return True
+            test = tests[i]
+            if children[i]:
+                return depth > 0 and test(path[depth - 1], path, depth - 1) and ancestors(i - 1, path, depth - 1)
+            for j in range(depth - 1, -1, -1):
+                if test(path[j], path, j):
+                    if nearest[i]:
+                        return ancestors(i - 1, path, j)
+                    if ancestors(i - 1, path, j):
+                        return True
+            return False
+
+        if last == 0:
+            self.test = tests[0]
+        else:
+            self.test = lambda element, path, depth: tests[last](element, path, depth) and ancestors(last - 1, path, depth)
+
+class _Reader:
+    '''Reads a selector from its tokens, and compiles it to a list of _Alternative objects.'''
+
+    def __init__(self, text):
+        self.text = text
+        try:
+            self.tokens = _selectorLexer.tokenize(text)
+        except ParsertoolsException as e:
+            raise SelectorException('Invalid selector "{}": {}'.format(text, e))
+        self.position = 0
+
+    def error(self, message):
+        token = self.peek()
+        return SelectorException('Invalid selector "{}": {} {}'.format(self.text, message,
+                                                                       'at position {}'.format(token.start) if token else 'at the end'))
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, kind):
+        '''Returns the next token and moves past it if it is of the given kind. Otherwise returns None.'''
+        token = self.peek()
+        if token and token.kind == kind:
+            self.position += 1
+            return token
+        return None
+
+    def expect(self, kind, what):
+        token = self.take(kind)
+        if not token:
+            raise self.error('expected ' + what)
+        return token
+
+    def adjacent(self):
+        '''Returns True if there is no whitespace between the previous token and the next one.'''
+        return self.tokens[self.position].start == self.tokens[self.position - 1].end
+
+    def read(self):
+        result = self.selector()
+        if self.peek():
+            raise self.error('unexpected "{}"'.format(self.peek().text))
+        return result
+
+    def selector(self):
+        result = [self.alternative()]
+        while self.take('COMMA'):
+            result.append(self.alternative())
+        return result
+
+    def alternative(self):
+        compounds = [self.compound()]
+        children = []
+        while self.peek() and self.peek().kind not in ('COMMA', 'RPAR'):
+            if self.take('GT'):
+                children.append(True)
+            elif not self.adjacent():
+                children.append(False)
+            else:
+                raise self.error('unexpected "{}"'.format(self.peek().text))
+            compounds.append(self.compound())
+        return _Alternative(compounds, children)
+
+    def compound(self):
+        start = self.position
+        name = None
+        if not self.take('STAR'):
+            token = self.take('NAME')
+            if token:
+                name = token.text
+        conditions = []
+        nested = []
+        while self.peek() and self.peek().kind in ('LBRACK', 'COLON') and (self.position == start or self.adjacent()):
+            if self.take('LBRACK'):
+                conditions.append(self.attribute())
+            else:
+                self.take('COLON')
+                conditions.append(self.pseudoClass(nested))
+        if self.position == start:
+            raise self.error('expected a selector')
+        return _Compound(name, conditions, nested)
+
+    def attribute(self):
+        attribute = self.expect('NAME', 'an attribute').text
+        value = None
+        if self.take('EQ'):
+            token = self.take('NAME') or self.expect('STRING', 'a name or a string')
+            value = token.text if token.kind == 'NAME' else re.sub(r'\\(.)', r'\1', token.text[1:-1])
+        self.expect('RBRACK', '"]"')
+        if attribute == 'label':
+            if value is None:
+                return lambda element, path, depth: bool(element._label)
+            return lambda element, path, depth: element._label == value
+        if attribute == 'text' and value is not None:
+            return lambda element, path, depth: str(element) == value
+        raise SelectorException('Invalid selector "{}": unknown attribute [{}{}]'.format(self.text, attribute, '' if value is None else '=...'))
+
+    def pseudoClass(self, nested):
+        name = self.expect('NAME', 'a pseudo-class').text
+        if name == 'root':
+            return lambda element, path, depth: depth == 0
+        if name not in ('not', 'inside'):
+            raise SelectorException('Invalid selector "{}": unknown pseudo-class :{}'.format(self.text, name))
+        self.expect('LPAR', '"("')
+        alternatives = self.selector()
+        self.expect('RPAR', '")"')
+        nested.append(alternatives)
+        tests = [a.test for a in alternatives]
+        if name == 'not':
+            return lambda element, path, depth: not any(t(element, path, depth) for t in tests)
+        return lambda element, path, depth: any(t(path[j], path, j) for j in range(depth) for t in tests)
+
+def _names(alternatives):
+    '''Returns the set of class names that the alternatives and the selectors of their pseudo-classes require, or None if some of
+    them can match an element of any class, or have a child combinator. In the other cases, elements of other classes cannot affect a
+    match, so that compact and shared elements of these classes need not be created to find the matches.'''
+    result = set()
+    for alternative in alternatives:
+        if any(alternative.children):
+            return None
+        for compound in alternative.compounds:
+            if compound.name is None:
+                return None
+            result.add(compound.name)
+            for n in compound.nested:
+                names = _names(n)
+                if names is None:
+                    return None
+                result |= names
+    return result
+
+def _ancestors(element):
+    '''Returns the ancestors of element, from the top of the tree down, as found through the parent pointers.'''
+    result = []
+    parent = _parentOf(element)
+    while parent is not None:
+        result.append(parent)
+        parent = _parentOf(parent)
+    result.reverse()
+    return result
+
+class Selector:
+    '''A compiled selector (see the module documentation). Raises a SelectorException if text is not a valid selector.'''
+
+    def __init__(self, text):
+        self.text = text
+        self._alternatives = _Reader(text).read()
+
+    @classmethod
+    def getSelector(cls, selector):
+        '''Returns selector if it is a Selector object, or else the compiled selector for the string selector. The 256 most recently
+        used compiled selectors are cached.'''
+        if isinstance(selector, Selector):
+            return selector
+        return _compiled(cls, selector)
+
+    def __repr__(self):
+        return 'Selector({!r})'.format(self.text)
+
+    def matches(self, element):
+        '''Returns True if element matches the selector, with its ancestors as found through the parent pointers.'''
+        path = _ancestors(element)
+        return any(a.test(element, path, len(path)) for a in self._alternatives)
+
+    def select(self, element):
+        '''Returns a list of element and its descendants that match the selector, in preorder. The ancestors of element are taken into
+        account.'''
+        return SelectorSet([self]).select(element)[0]
+
+# The number of selectors given as strings that are kept compiled by Selector.getSelector. The cache is created with this size at import.
+_SELECTOR_CACHE_SIZE = 256
+
+@functools.lru_cache(maxsize=_SELECTOR_CACHE_SIZE)
+def _compiled(class_, text):
+    return class_(text)
+
+class SelectorSet:
+    '''A number of compiled selectors, of which the matches are found in a single traversal (see the module documentation). The selectors
+    can be given as Selector objects or as strings.'''
+
+    def __init__(self, selectors):
+        self._selectors = [Selector.getSelector(s) for s in selectors]
+        # The alternatives with the index of their selector, by the class name that their last compound selector requires, and those
+        # of which the last compound selector can match an element of any class
+        self._byName = {}
+        self._any = []
+        for index, selector in enumerate(self._selectors):
+            for alternative in selector._alternatives:
+                name = alternative.compounds[-1].name
+                (self._any if name is None else self._byName.setdefault(name, [])).append((index, alternative.test))
+        # The class names that the selectors require, or None (see _names)
+        self._names = _names([a for s in self._selectors for a in s._alternatives])
+
+    def getSelectors(self):
+        return list(self._selectors)
+
+    def select(self, element):
+        '''Returns a list with, for each selector, a list of element and its descendants that match it, in preorder. The ancestors of
+        element are taken into account. Compact and shared elements are only created where they can match (see _names).'''
+        results = [[] for _ in self._selectors]
+        any_, names = self._any, self._names
+        getEntries = self._byName.get
+        keep = None if names is None else (lambda class_, label: class_.__name__ in names)
+        # The ancestors of the element at hand, from the top of the tree down
+        path = _ancestors(element)
+        # The elements still to be visited, the next one last, with their number of ancestors
+        stack = [(element, len(path))]
+        pop, push = stack.pop, stack.append
+        while stack:
+            element, depth = pop()
+            del path[depth:]
+            entries = getEntries(element.__class__.__name__)
+            if any_:
+                entries = entries + any_ if entries else any_
+            if entries:
+                for index, test in entries:
+                    result = results[index]
+                    # An element can match several alternatives of a selector
+                    if (not result or result[-1] is not element) and test(element, path, depth):
+                        result.append(element)
+            path.append(element)
+            depth += 1
+            for i in reversed(element._searchItems(keep)):
+                if isinstance(i, ParseStruct):
+                    push((i, depth))
+        return results
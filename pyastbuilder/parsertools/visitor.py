@@ -0,0 +1,72 @@
+'''
+Visitors for parse trees. A Visitor holds handlers, which are functions that take an element, registered by the class of the elements
+they handle, such as SPARQLParser.iri. The handlers are found through a table from classes to handlers, so that an element costs a
+single lookup, however many handlers there are. A VisitorSet calls the handlers of a number of visitors in a single traversal of a tree,
+so that processing steps that would each search the whole tree share one walk.
+'''
+
+from parsertools.base import ParseStruct
+
+class Visitor:
+    '''Handlers for the elements of parse trees, by class. The optional argument handlers is an iterable of (class, handler) pairs,
+    which are registered in order.'''
+
+    def __init__(self, handlers=()):
+        self._handlers = {}
+        for class_, handler in handlers:
+            self.register(class_, handler)
+
+    def register(self, class_, handler=None):
+        '''Registers handler, a function that takes an element, for the elements of class_. The class must be that of the elements
+        themselves, as in ParseStruct.searchElements: a handler for a superclass is not called for its subclasses. The handlers for a
+        class are called in the order in which they were registered. Returns handler. Without handler, returns a decorator that 
+        registers the function it decorates.'''
+        if handler is None:
+            return lambda handler: self.register(class_, handler)
+        self._handlers.setdefault(class_, []).append(handler)
+        return handler
+
+    def getClasses(self):
+        return list(self._handlers)
+
+    def getHandlers(self, class_):
+        return list(self._handlers.get(class_, []))
+
+    def visit(self, element):
+        '''Calls the handlers for element and its descendants, in preorder (see VisitorSet.visit).'''
+        VisitorSet([self]).visit(element)
+
+class VisitorSet:
+    '''A number of visitors, of which the handlers are called in a single traversal.'''
+
+    def __init__(self, visitors):
+        self._visitors = list(visitors)
+
+    def getVisitors(self):
+        return list(self._visitors)
+
+    def visit(self, element):
+        '''Calls the handlers of the visitors for element and its descendants, in preorder. At each element, the handlers for its class
+        are called in the order of the visitors. The children of an element are taken after its handlers have been called, so that a
+        handler can update the element (see ParseStruct.updateWith), in which case its new descendants are visited. The tree should not
+        be changed otherwise while it is visited. Compact and shared elements are only created where they have handlers (see
+        ParseStruct.compact and Parser.setShared).'''
+        # The handlers by class, which is built for every traversal, so that handlers registered in the meantime are called
+        table = {}
+        for visitor in self._visitors:
+            for class_, handlers in visitor._handlers.items():
+                table.setdefault(class_, []).extend(handlers)
+        getHandlers = table.get
+        keep = lambda class_, label: class_ in table
+        # The elements still to be visited, the next one last
+        stack = [element]
+        pop, push = stack.pop, stack.append
+        while stack:
+            element = pop()
+            handlers = getHandlers(element.__class__)
+            if handlers:
+                for handler in handlers:
+                    handler(element)
+            for i in reversed(element._searchItems(keep)):
+                if isinstance(i, ParseStruct):
+                    push(i)
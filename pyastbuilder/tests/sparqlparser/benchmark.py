@@ -0,0 +1,708 @@
+'''
+Created on 18 okt. 2026
+
+Benchmarks for the SPARQL parser. The corpus consists of the positive syntax tests from the reftest directories, as listed in their manifests.
+
+Usage: python benchmark.py [benchmark ...]
+Without arguments, all benchmarks are run. Timings are the best of a number of rounds, in seconds.
+'''
+
+import gc
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import warnings
+from pyparsing import ParseException
+from parsertools.arena import ParseArena
+from parsertools.selector import SelectorSet
+from parsertools.base import ParseStruct
+from parsertools.parsers.sparqlparser import SPARQLParser, SPARQLLexer, SPARQLParseException, prepareQuery, classifyRequest, parseQuery
+from parsertools.parsers.sparqlparser import postParseVisitors, checkExpansion, processEscapeSeq
+
+reftestdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reftest')
+
+def loadCorpus():
+    '''Returns a list of (filename, querystring) pairs for all positive syntax tests in the reftest manifests. The query strings
+    have been prepared for parsing (see prepareQuery). Tests that are known not to parse (see the notes in the testCases.py scripts)
+    are left out.'''
+    result = []
+    for testdir in sorted(os.listdir(reftestdir)):
+        manifest = os.path.join(reftestdir, testdir, 'manifest.ttl')
+        if not os.path.isfile(manifest):
+            continue
+        positive = False
+        for line in open(manifest):
+            if line.lstrip().startswith('#'):
+                continue
+            testtype = re.search(r'rdf:type\s+mf:(\w+)', line)
+            if testtype:
+                positive = testtype.group(1).startswith('Positive')
+            action = re.search(r'mf:action\s+<([^>]*)>', line)
+            if action and positive:
+                fname = os.path.join(reftestdir, testdir, action.group(1))
+                querystring = prepareQuery(open(fname).read())
+                try:
+                    if parsePrepared(querystring) is not None:
+                        result.append((fname, querystring))
+                except Exception:
+                    pass
+    return result
+
+# Some tests have relative BASE declarations, which need an external base iri
+baseiri = 'http://example.org/base/'
+
+def parsePrepared(querystring, **kwargs):
+    '''Parses a prepared query string the way parseQuery does, without the preparation and post processing steps.
+    Returns None if the string cannot be parsed.'''
+    unit = classifyRequest(querystring)
+    for unit in [unit] if unit else [SPARQLParser.QueryUnit, SPARQLParser.UpdateUnit]:
+        try:
+            return unit(querystring, base=baseiri, postParseCheck=False, **kwargs)
+        except ParseException:
+            pass
+    return None
+
+def bestOf(func, rounds=3):
+    '''Returns the best wall clock time of a number of calls to func.'''
+    result = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if result is None or elapsed < result:
+            result = elapsed
+    return result
+
+def report(name, seconds, baseline=None):
+    line = '  {:<40} {:8.3f}s'.format(name, seconds)
+    if baseline:
+        line += '  ({:.2f}x)'.format(baseline / seconds)
+    print(line)
+
+def expressionQueries(count=40):
+    '''Returns a list of synthetic, prepared queries with expression heavy FILTER and HAVING clauses, dominated by built-in calls.'''
+    conditions = ['REGEX(STR(?x), "^a", "i")', 'YEAR(?d) > 2000', 'isIRI(?y)', 'CONTAINS(LCASE(?n), "b")', 'STRLEN(?n) < 10', 
+                  'COALESCE(?a, ?b, 1) = 1', 'SUBSTR(?n, 1, 2) = "ab"', 'sameTerm(?x, ?y)', 'NOT EXISTS { ?x ?p ?o }', 'isNUMERIC(ABS(?v))', 
+                  'STRSTARTS(UCASE(?n), "X")', 'BOUND(?z)', 'IF(?v > 0, ?v, -?v) < 3', 'ROUND(?v * 2) = 4', 'STRAFTER(?n, "#") != ""']
+    result = []
+    for i in range(count):
+        chosen = [conditions[(i + j * 7) % len(conditions)] for j in range(6)]
+        result.append(prepareQuery('SELECT ?x (SUM(?v) AS ?s) WHERE {{ ?x ?p ?y . ?y <p> ?n ; <q> ?v . FILTER ({}) FILTER ({}) }} '
+                                   'GROUP BY ?x HAVING (COUNT(DISTINCT ?y) > {} && AVG(?v) < MAX(?v))'.format(' && '.join(chosen[:3]), ' || '.join(chosen[3:]), i)))
+    return result
+
+def analyticsQueries(count=40):
+    '''Returns a list of synthetic, prepared analytics queries, with FILTER, BIND and HAVING clauses dominated by arithmetic, relational 
+    and logical operators.'''
+    conditions = ['?price * (1 - ?discount / 100) > 25.5', '?qty >= 10 && ?qty <= 100', '?total / ?n - ?avg < -1.5', '!(?a = ?b) || ?c != 3',
+                  '?x + ?y * 2 - ?z / 4 >= ?w', '?year IN (2019, 2020, 2021)', '?status NOT IN ("closed", "void")', '-?delta + 1 < 0',
+                  '?margin = (?revenue - ?cost) / ?revenue', '?score * 0.5 + ?bonus * 0.25 + 10 > ?threshold', '?a < 1 || ?b > 2 && ?c <= 3']
+    result = []
+    for i in range(count):
+        chosen = [conditions[(i + j * 5) % len(conditions)] for j in range(6)]
+        result.append(prepareQuery('SELECT ?g (SUM(?price * ?qty) AS ?revenue) (AVG(?v) AS ?a) WHERE {{ ?o <price> ?price ; <qty> ?qty ; <v> ?v . '
+                                   'BIND (?price * ?qty - ?cost AS ?v) FILTER ({}) FILTER ({}) }} GROUP BY ?g HAVING (SUM(?v) / COUNT(?o) > {} && '
+                                   'MIN(?v) + MAX(?v) < 2 * AVG(?v))'.format(' && '.join(chosen[:3]), ' || '.join(chosen[3:]), i)))
+    return result
+
+def payloadQueries(count=4, rows=200):
+    '''Returns a list of synthetic, prepared requests with large INSERT DATA and VALUES payloads, of IRIs and string literals.'''
+    result = []
+    for i in range(count):
+        triples = ' '.join('<http://example.org/data/item{0}> <http://example.org/schema/label> "Label of item {0} in batch {1}"@en .'.format(n, i) for n in range(rows))
+        result.append(prepareQuery('INSERT DATA {{ GRAPH <http://example.org/graph{}> {{ {} }} }}'.format(i, triples)))
+        values = ' '.join('(<http://example.org/data/item{0}> "Description of item {0}" {0})'.format(n) for n in range(rows))
+        result.append(prepareQuery('SELECT * WHERE {{ ?s ?p ?o }} VALUES (?s ?d ?n) {{ {} }}'.format(values)))
+    return result
+
+#
+# Benchmarks. Each takes the corpus as its argument.
+#
+
+def benchPackrat(corpus):
+    '''Parses the corpus with and without packrat memoization, which is switched on for the process (see Parser.setPackrat), and checks
+    that the results are identical.'''
+    def parseAll():
+        return [parsePrepared(s) for _, s in corpus]
+    plain = parseAll()
+    baseline = bestOf(parseAll)
+    SPARQLParser.setPackrat(True)
+    try:
+        memoized = parseAll()
+        packrat = bestOf(parseAll)
+    finally:
+        SPARQLParser.setPackrat(False)
+    assert [r.dump() if r else None for r in plain] == [r.dump() if r else None for r in memoized], 'packrat parse differs from plain parse'
+    report('plain', baseline)
+    report('packrat', packrat, baseline)
+
+def benchLexer(corpus):
+    '''Times the single pass front end: preparing the raw query texts (comment stripping and unescaping) and tokenizing the prepared
+    strings with SPARQLLexer, against a full parse of the corpus for scale.'''
+    raw = [open(fname).read() for fname, _ in corpus]
+    assert [prepareQuery(r) for r in raw] == [s for _, s in corpus], 'prepareQuery is not deterministic'
+    baseline = bestOf(lambda: [parsePrepared(s) for _, s in corpus])
+    report('parse', baseline)
+    report('prepare', bestOf(lambda: [prepareQuery(r) for r in raw]), baseline)
+    report('tokenize', bestOf(lambda: [SPARQLLexer.tokenize(s) for _, s in corpus]), baseline)
+
+def benchTokens(corpus):
+    '''Parses the corpus and the large update requests from payloadQueries with and without token mode (see Parser.setLexer), and checks 
+    that the results are identical.'''
+    for name, queries in ('corpus', [s for _, s in corpus]), ('payloads', payloadQueries()):
+        def parseAll():
+            return [parsePrepared(s) for s in queries]
+        plain = [r.dump() if r else None for r in parseAll()]
+        baseline = bestOf(parseAll)
+        SPARQLParser.setLexer(SPARQLLexer)
+        try:
+            assert [r.dump() if r else None for r in parseAll()] == plain, 'token mode parse differs from plain parse'
+            tokens = bestOf(parseAll)
+        finally:
+            SPARQLParser.setLexer(None)
+        report('plain, ' + name, baseline)
+        report('token mode, ' + name, tokens, baseline)
+
+def benchDispatch(corpus):
+    '''Parses the expression heavy queries from expressionQueries, in which built-in calls and aggregates are looked up by their leading 
+    keyword (see KeywordDispatch), and the corpus for comparison.'''
+    queries = expressionQueries()
+    assert all(parsePrepared(q) is not None for q in queries), 'expression query does not parse'
+    report('expressions ({} queries)'.format(len(queries)), bestOf(lambda: [parsePrepared(q) for q in queries]))
+    report('corpus', bestOf(lambda: [parsePrepared(s) for _, s in corpus]))
+
+def benchGenerated(corpus):
+    '''Parses the corpus with pyparsing and with the generated parser (see Parser.setGenerated), and checks that the results are identical.
+    The generated parser is written to a temporary cache directory; the time to generate it is reported separately.'''
+    queries = expressionQueries()
+    baseline = bestOf(lambda: [parsePrepared(s) for _, s in corpus])
+    expressions = bestOf(lambda: [parsePrepared(q) for q in queries])
+    expected = [parsePrepared(s).dump() for _, s in corpus]
+    with tempfile.TemporaryDirectory() as cachedir:
+        SPARQLParser.setGenerated(True, cachedir=cachedir)
+        try:
+            start = time.perf_counter()
+            SPARQLParser.QueryUnit('ASK {}')
+            report('generate', time.perf_counter() - start)
+            assert [parsePrepared(s).dump() for _, s in corpus] == expected, 'generated parse differs from pyparsing parse'
+            report('pyparsing', baseline)
+            report('generated', bestOf(lambda: [parsePrepared(s) for _, s in corpus]), baseline)
+            report('pyparsing, expressions', expressions)
+            report('generated, expressions', bestOf(lambda: [parsePrepared(q) for q in queries]), expressions)
+        finally:
+            SPARQLParser.setGenerated(False)
+
+def benchClassify(corpus):
+    '''Parses the update requests in the corpus with the entry point chosen by classifyRequest, and as parseQuery used to do: by trying
+    QueryUnit first and UpdateUnit when that fails.'''
+    updates = [s for _, s in corpus if classifyRequest(s) == SPARQLParser.UpdateUnit]
+    def parseBoth(querystring):
+        try:
+            return SPARQLParser.QueryUnit(querystring, base=baseiri, postParseCheck=False)
+        except ParseException:
+            return SPARQLParser.UpdateUnit(querystring, base=baseiri, postParseCheck=False)
+    assert [parseBoth(s).dump() for s in updates] == [parsePrepared(s).dump() for s in updates], 'classified parse differs'
+    baseline = bestOf(lambda: [parseBoth(s) for s in updates])
+    report('updates ({}), QueryUnit first'.format(len(updates)), baseline)
+    report('updates ({}), classified'.format(len(updates)), bestOf(lambda: [parsePrepared(s) for s in updates]), baseline)
+    report('classify corpus', bestOf(lambda: [classifyRequest(s) for _, s in corpus]))
+
+def iterElements(element):
+    '''Yields the ParseStruct objects in the tree of element, without expanding compact elements or replacing shared elements.'''
+    todo = [element]
+    while todo:
+        element = todo.pop()
+        yield element
+        items = element._chainItems if element.isCompact() else element._items
+        todo.extend(i for i in items if isinstance(i, ParseStruct))
+
+def countElements(element):
+    '''Returns the number of ParseStruct objects in the tree of element, without expanding compact elements.'''
+    return sum(1 for _ in iterElements(element))
+
+def elementSize(element):
+    '''Returns the size in bytes of the element object, including its instance dict if it has one, but not of the objects it refers to.'''
+    try:
+        return sys.getsizeof(element) + sys.getsizeof(vars(element))
+    except TypeError:
+        return sys.getsizeof(element)
+
+def retainedMemory(func):
+    '''Returns the result of func and the number of bytes allocated by func that are still in use afterwards. Parse trees that func
+    discarded are collected first, since their parent pointers form reference cycles.'''
+    tracemalloc.start()
+    try:
+        result = func()
+        gc.collect()
+        return result, tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+def benchCompact(corpus):
+    '''Parses the corpus with and without compact trees (see ParseStruct.compact), and compares the number of elements, the memory
+    retained by the trees, and the time to search and render them.'''
+    plain, plainMemory = retainedMemory(lambda: [parsePrepared(s) for _, s in corpus])
+    compact, compactMemory = retainedMemory(lambda: [parsePrepared(s, compact=True) for _, s in corpus])
+    assert [str(r) for r in plain] == [str(r) for r in compact], 'compact tree renders differently'
+    print('  elements: {} plain, {} compact'.format(sum(countElements(r) for r in plain), sum(countElements(r) for r in compact)))
+    print('  retained memory: {} kB plain, {} kB compact'.format(plainMemory // 1024, compactMemory // 1024))
+    baseline = bestOf(lambda: [parsePrepared(s) for _, s in corpus])
+    report('parse, plain', baseline)
+    report('parse, compact', bestOf(lambda: [parsePrepared(s, compact=True) for _, s in corpus]), baseline)
+    for name, trees in ('plain', plain), ('compact', compact):
+        report('search TriplesBlock, ' + name, bestOf(lambda: [r.searchElements(element_type=SPARQLParser.TriplesBlock) for r in trees]))
+        report('render, ' + name, bestOf(lambda: [str(r) for r in trees]))
+
+def benchMemory(corpus):
+    '''Parses the corpus and reports the memory retained by the parse trees, per query and per element, for plain and compact trees, 
+    with and without shared elements. Shared elements are counted once. The element objects themselves, including their instance dicts 
+    if they have them, are also measured separately.'''
+    for name, kwargs in ('plain', {}), ('compact', dict(compact=True)), ('shared', dict(shared=True)), ('both', dict(compact=True, shared=True)):
+        trees, memory = retainedMemory(lambda: [parsePrepared(s, **kwargs) for _, s in corpus])
+        elements = list({id(e): e for tree in trees for e in iterElements(tree)}.values())
+        print('  {:<8} {:5} kB retained, {:4.1f} kB per query, {} elements, {:3.0f} bytes per element, {:3.0f} bytes in the element objects'.format(
+            name, memory // 1024, memory / 1024 / len(trees), len(elements), memory / len(elements), sum(map(elementSize, elements)) / len(elements)))
+
+def benchArena(corpus):
+    '''Stores the parse trees of the corpus in ParseArena objects, and compares the memory they retain, and the time to search them, 
+    to find the ancestors of all variables and to render them, with those of the ParseStruct trees.'''
+    trees, treeMemory = retainedMemory(lambda: [parsePrepared(s) for _, s in corpus])
+    arenas, arenaMemory = retainedMemory(lambda: [ParseArena(parsePrepared(s)) for _, s in corpus])
+    assert [a.dump() for a in arenas] == [t.dump() for t in trees], 'arena differs from tree'
+    print('  retained memory: {} kB trees, {} kB arenas'.format(treeMemory // 1024, arenaMemory // 1024))
+    report('store in arenas', bestOf(lambda: [ParseArena(t) for t in trees]))
+    baseline = bestOf(lambda: [t.searchElements(element_type=SPARQLParser.TriplesBlock) for t in trees])
+    report('search TriplesBlock, trees', baseline)
+    report('search TriplesBlock, arenas', bestOf(lambda: [a.searchElements(element_type=SPARQLParser.TriplesBlock) for a in arenas]), baseline)
+    variables = [t.searchElements(element_type=SPARQLParser.Var) for t in trees]
+    baseline = bestOf(lambda: [v.getAncestors() for vs in variables for v in vs])
+    report('ancestors of variables, trees', baseline)
+    variables = [(a, a.searchElements(element_type=SPARQLParser.Var)) for a in arenas]
+    report('ancestors of variables, arenas', bestOf(lambda: [a.getAncestors(v) for a, vs in variables for v in vs]), baseline)
+    baseline = bestOf(lambda: [str(t) for t in trees])
+    report('render, trees', baseline)
+    report('render, arenas', bestOf(lambda: [a.getString(0) for a in arenas]), baseline)
+
+def peakMemory(func):
+    '''Returns the result of func and the peak number of bytes allocated by func.'''
+    tracemalloc.start()
+    try:
+        return func(), tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def benchSpans(corpus):
+    '''Parses the queries with large payloads from payloadQueries, and the corpus, with and without spans (see Parser.setSpans), checks 
+    that the trees are the same, and compares the memory retained by the trees, the peak memory while parsing, and the time to parse
+    and render them.'''
+    for name, queries in ('payloads', payloadQueries()), ('corpus', [s for _, s in corpus]):
+        plain = [parsePrepared(s) for s in queries]
+        assert [r.dump() for r in plain] == [parsePrepared(s, spans=True).dump() for s in queries], 'tree with spans differs from plain tree'
+        for spans in False, True:
+            memory = retainedMemory(lambda: [parsePrepared(s, spans=spans) for s in queries])[1]
+            peak = max(peakMemory(lambda: parsePrepared(s, spans=spans))[1] for s in queries)
+            print('  {:<24} {:5} kB retained, {:5} kB peak per query'.format('{}, {}'.format(name, 'spans' if spans else 'strings'), memory // 1024, peak // 1024))
+        baseline = bestOf(lambda: [parsePrepared(s) for s in queries])
+        report('parse {}, strings'.format(name), baseline)
+        report('parse {}, spans'.format(name), bestOf(lambda: [parsePrepared(s, spans=True) for s in queries]), baseline)
+        trees = [parsePrepared(s, spans=True) for s in queries]
+        baseline = bestOf(lambda: [str(r) for r in plain])
+        report('render {}, strings'.format(name), baseline)
+        report('render {}, spans'.format(name), bestOf(lambda: [str(r) for r in trees]), baseline)
+
+def benchParents(corpus):
+    '''Parses the corpus and the large update requests from payloadQueries, and checks that the parent pointers, which are set while the 
+    trees are built, are complete. Reports the parse time and the time of the walk over the whole tree that set them afterwards before,
+    measured on the same trees.'''
+    for name, queries in ('corpus', [s for _, s in corpus]), ('payloads', payloadQueries()):
+        trees = [parsePrepared(s) for s in queries]
+        assert all(t.hasParentPointers() for t in trees), 'missing parent pointers'
+        parse = bestOf(lambda: [parsePrepared(s) for s in queries])
+        report('parse ' + name, parse)
+        walk = bestOf(lambda: [t.createParentPointers() for t in trees])
+        print('  {:<40} {:8.3f}s  ({:.0%} of the parse time)'.format('saved walk, ' + name, walk, walk / parse))
+
+# The searches of the post processing of parseQuery (see SPARQLElement._checkExpansion and processEscapeSeqs)
+pipelineClasses = [SPARQLParser.PrefixedName, SPARQLParser.IRIREF, SPARQLParser.STRING_LITERAL2, SPARQLParser.STRING_LITERAL1, 
+                   SPARQLParser.STRING_LITERAL_LONG1, SPARQLParser.STRING_LITERAL_LONG2]
+
+def benchSearch(corpus):
+    '''Parses the corpus and the large update requests from payloadQueries, and times the searches of the post processing of parseQuery
+    on fresh trees, with a walk over the whole tree for each search, as before the trees were indexed, and with searchElements, which 
+    builds the index of the tree once (see ParseStruct.searchElements). Also times expandIris, of which the updates drop the index.'''
+    def walk(tree, class_):
+        return [e for e in [tree] + tree._ParseStruct__getElements(labeledOnly=False) if e.__class__ is class_]
+    for name, queries in ('corpus', [s for _, s in corpus]), ('payloads', payloadQueries()):
+        trees = [parsePrepared(s) for s in queries]
+        assert all([str(e) for e in walk(t, c)] == [str(e) for e in t.searchElements(element_type=c)] for t in trees for c in pipelineClasses)
+        times = {}
+        for method, search in ('walks', walk), ('index', lambda tree, class_: tree.searchElements(element_type=class_)):
+            best = None
+            for _ in range(3):
+                trees = [parsePrepared(s) for s in queries]
+                start = time.perf_counter()
+                for t in trees:
+                    for c in pipelineClasses:
+                        search(t, c)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            times[method] = best
+            report('searches {}, {}'.format(name, method), best, times['walks'] if method != 'walks' else None)
+        trees = [parsePrepared(s) for s in queries]
+        start = time.perf_counter()
+        for t in trees:
+            try:
+                t.expandIris()
+            except AssertionError:
+                # An iri that cannot be expanded
+                pass
+        report('expandIris {}'.format(name), time.perf_counter() - start)
+
+def benchFirst(corpus):
+    '''Parses the corpus and the large update requests from payloadQueries, and times two checks on fresh trees: whether the tree has
+    a SERVICE clause, and which is its first GroupGraphPattern. Both are done with searchElements, which visits the whole tree to build
+    its list (and the index of the tree, see ParseStruct.searchElements), and with findFirst, which stops at the first match.'''
+    checks = [('SERVICE', SPARQLParser.ServiceGraphPattern, lambda found: bool(found)), 
+              ('first GroupGraphPattern', SPARQLParser.GroupGraphPattern, lambda found: found[0] if found else None)]
+    for name, queries in ('corpus', [s for _, s in corpus]), ('payloads', payloadQueries()):
+        for check, class_, result in checks:
+            trees = [parsePrepared(s) for s in queries]
+            assert [result(t.searchElements(element_type=class_)) for t in trees] == [result([t.findFirst(element_type=class_)] if t.findFirst(element_type=class_) else []) for t in trees]
+            times = {}
+            for method, func in ('searchElements', lambda t: result(t.searchElements(element_type=class_))), ('findFirst', lambda t: t.findFirst(element_type=class_)):
+                best = None
+                for _ in range(3):
+                    trees = [parsePrepared(s) for s in queries]
+                    start = time.perf_counter()
+                    for t in trees:
+                        func(t)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                times[method] = best
+                report('{}, {}, {}'.format(check, name, method), best, times['searchElements'] if method != 'searchElements' else None)
+
+def benchValue(corpus):
+    '''Parses the corpus, and searches every query for the first variable and the first IRI in it by value, with an element_type and
+    without one, which compares the value with every element of the tree. The searches parse the value once for each class (see 
+    ParseStruct.searchElements), and are compared with searches that parse it for every element, as before.'''
+    def perElement(tree, class_, value):
+        result = []
+        for e in tree.searchElements(element_type=class_):
+            try:
+                if e == e._parse(value, parseAll=False):
+                    result.append(e)
+            except ParseException:
+                pass
+        return result
+    trees = [parsePrepared(s) for _, s in corpus]
+    needles = []
+    for t in trees:
+        for class_ in SPARQLParser.Var, SPARQLParser.iri:
+            found = t.searchElements(element_type=class_)
+            if found:
+                needles.append((t, class_, str(found[0])))
+    print('  {} needles in {} queries'.format(len(needles), len(trees)))
+    for typed in True, False:
+        name = 'typed' if typed else 'untyped'
+        assert all(perElement(t, c if typed else None, v) == t.searchElements(element_type=c if typed else None, value=v) for t, c, v in needles)
+        baseline = bestOf(lambda: [perElement(t, c if typed else None, v) for t, c, v in needles], rounds=1 if not typed else 3)
+        report('parse per element, ' + name, baseline)
+        report('parse per class, ' + name, bestOf(lambda: [t.searchElements(element_type=c if typed else None, value=v) for t, c, v in needles]), baseline)
+
+# Selectors, with the searches that find the same elements with searchElements and getAncestors
+ruleSelectors = [('Var:not(:inside(SubSelect))', lambda t: [v for v in t.searchElements(element_type=SPARQLParser.Var) if not any(isinstance(a, SPARQLParser.SubSelect) for a in v.getAncestors())]),
+                 ('iri[label=datatype_uri]', lambda t: t.searchElements(element_type=SPARQLParser.iri, label='datatype_uri')),
+                 ('Filter Var', lambda t: [v for v in t.searchElements(element_type=SPARQLParser.Var) if any(isinstance(a, SPARQLParser.Filter) for a in v.getAncestors())]),
+                 ('GroupGraphPattern TriplesBlock', lambda t: [b for b in t.searchElements(element_type=SPARQLParser.TriplesBlock) if any(isinstance(a, SPARQLParser.GroupGraphPattern) for a in b.getAncestors())]),
+                 ('SelectQuery > WhereClause', lambda t: [w for w in t.searchElements(element_type=SPARQLParser.WhereClause) if isinstance(w.getParent(), SPARQLParser.SelectQuery)]),
+                 ]
+
+def benchSelectors(corpus):
+    '''Parses the corpus and the large update requests from payloadQueries, and finds the matches of the selectors in ruleSelectors on 
+    fresh trees, with a search and a filter on the ancestors for each selector, and with a SelectorSet, in a single traversal.'''
+    selectors = SelectorSet([text for text, _ in ruleSelectors])
+    for name, queries in ('corpus', [s for _, s in corpus]), ('payloads', payloadQueries()):
+        trees = [parsePrepared(s) for s in queries]
+        assert all(selectors.select(t) == [rule(t) for _, rule in ruleSelectors] for t in trees), 'selectors differ from searches'
+        times = {}
+        for method, func in ('searches', lambda t: [rule(t) for _, rule in ruleSelectors]), ('SelectorSet', selectors.select):
+            best = None
+            for _ in range(3):
+                trees = [parsePrepared(s) for s in queries]
+                start = time.perf_counter()
+                for t in trees:
+                    func(t)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            times[method] = best
+            report('{}, {}'.format(method, name), best, times['searches'] if method != 'searches' else None)
+
+def benchVisitors(corpus):
+    '''Parses the corpus and the large update requests from payloadQueries, and times the post processing of parseQuery on fresh trees,
+    with a searchElements call for each class in pipelineClasses, as before it was done by visitors, and with postParseVisitors, in a
+    single traversal (see parsertools.visitor). Queries with an iri that cannot be expanded are left out.'''
+    def searches(tree):
+        for class_ in pipelineClasses:
+            for element in tree.searchElements(element_type=class_):
+                (checkExpansion if class_ in (SPARQLParser.PrefixedName, SPARQLParser.IRIREF) else processEscapeSeq)(element)
+    for name, queries in ('corpus', [s for _, s in corpus]), ('payloads', payloadQueries()):
+        valid = []
+        for s in queries:
+            try:
+                postParseVisitors.visit(parsePrepared(s))
+                valid.append(s)
+            except AssertionError:
+                pass
+        trees = [(parsePrepared(s), parsePrepared(s)) for s in valid]
+        for searched, visited in trees:
+            searches(searched)
+            postParseVisitors.visit(visited)
+        assert all(searched.dump() == visited.dump() for searched, visited in trees), 'visitors differ from searches'
+        times = {}
+        for method, func in ('searches', searches), ('visitors', postParseVisitors.visit):
+            best = None
+            for _ in range(3):
+                trees = [parsePrepared(s) for s in valid]
+                start = time.perf_counter()
+                for t in trees:
+                    func(t)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            times[method] = best
+            report('{}, {}'.format(method, name), best, times['searches'] if method != 'searches' else None)
+
+# The number of parses of benchGC. A million parses of the corpus take over an hour with the generated parser.
+gcParses = 1000000
+
+def residentMemory():
+    '''Returns the resident set size of the process in bytes, or None where /proc is not available.'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+def benchGC(corpus):
+    '''Parses gcParses queries of the corpus in turn, with the generated parser and, for a tenth of that number, with pyparsing, and
+    reports the resident memory and the pauses of the cyclic garbage collector. Parse trees have no reference cycles, and are freed as soon
+    as they are dropped; the cycles that remain are in pyparsing's own results.'''
+    queries = [s for _, s in corpus if parsePrepared(s)]
+    pauses = []
+    def measure(phase, info):
+        if phase == 'start':
+            pauses.append(time.perf_counter())
+        else:
+            pauses[-1] = (time.perf_counter() - pauses[-1], info['generation'], info['collected'])
+    generated = SPARQLParser.getGenerated()
+    gc.collect()
+    gc.callbacks.append(measure)
+    try:
+        for name, count in ('generated', gcParses), ('pyparsing', gcParses // 10):
+            SPARQLParser.setGenerated(name == 'generated')
+            gc.collect()
+            del pauses[:]
+            before = residentMemory()
+            start = time.perf_counter()
+            for i in range(count):
+                parsePrepared(queries[i % len(queries)])
+            elapsed = time.perf_counter() - start
+            after = residentMemory()
+            print('  {}: {} parses in {:.1f}s, resident memory {}'.format(name, count, elapsed, 
+                'unknown' if before is None else '{:.1f} MB before, {:.1f} MB after'.format(before / 2 ** 20, after / 2 ** 20)))
+            for generation in range(3):
+                times = [t for t, g, _ in pauses if g == generation]
+                print('    generation {}: {:6} collections, {:8.3f}s in total, longest pause {:.2f}ms, {} objects collected'.format(generation, 
+                    len(times), sum(times), max(times, default=0) * 1000, sum(c for _, g, c in pauses if g == generation)))
+    finally:
+        gc.callbacks.remove(measure)
+        SPARQLParser.setGenerated(generated)
+
+def benchExpression(corpus):
+    '''Parses the operator heavy queries from analyticsQueries, the built-in call heavy queries from expressionQueries, and the corpus, 
+    with the precedence climbing parser for expressions (see ExpressionParser) and with the pyparsing pattern it wraps, and checks
+    that the results are identical.'''
+    forward = SPARQLParser.Expression._pattern
+    engine = forward.expr
+    workloads = [('analytics', analyticsQueries()), ('expressions', expressionQueries()), ('corpus', [s for _, s in corpus])]
+    expected = [[parsePrepared(q).dump() for q in queries] for _, queries in workloads]
+    forward.expr = engine.expr
+    try:
+        assert [[parsePrepared(q).dump() for q in queries] for _, queries in workloads] == expected, 'pyparsing parse differs from engine parse'
+        baselines = [bestOf(lambda: [parsePrepared(q) for q in queries]) for _, queries in workloads]
+    finally:
+        forward.expr = engine
+    for (name, queries), baseline in zip(workloads, baselines):
+        report('{}, pyparsing'.format(name), baseline)
+        report('{}, engine'.format(name), bestOf(lambda: [parsePrepared(q) for q in queries]), baseline)
+
+# Hostile queries, as functions of a size n. Each is built around a long or crafted name or string, in which a naive regex for the
+# terminal concerned, or a lexer that scans the same text from many positions, takes time quadratic (or worse) in n.
+adversarialQueries = {'local name': lambda n: 'PREFIX ex: <x:> ASK { ?s ?p ex:a' + '.%41-' * n + ' }',
+                      'local name, dots': lambda n: 'PREFIX ex: <x:> ASK { ?s ?p ex:a' + '.' * n + 'b }',
+                      'prefix': lambda n: 'PREFIX ' + 'a.-' * n + 'a: <x:> ASK {}',
+                      'blank node label': lambda n: 'ASK { _:b' + '.-' * n + '0 ?p ?o }',
+                      'variable': lambda n: 'ASK { ?v' + 'v\u00B70' * n + ' ?p ?o }',
+                      'string': lambda n: 'ASK { ?s ?p "' + 'a\\t' * n + '" }',
+                      'long string': lambda n: "ASK { ?s ?p '''" + "''a\\n" * n + "''' }",
+                      'unterminated string': lambda n: "ASK { ?s ?p '" + "\\'" * n + ' }',
+                      'unterminated long string': lambda n: "ASK { ?s ?p '''" + "''\\'" * n + ' }',
+                      }
+
+def benchAdversarial(corpus):
+    '''Parses the hostile queries from adversarialQueries with parseQuery, for sizes that double from 2000 to 16000. Time linear in the 
+    size of the query shows as a growth of about 8x from the first to the last size; quadratic time would show as 64x.'''
+    sizes = [2000, 4000, 8000, 16000]
+    def parse(querystring):
+        try:
+            return parseQuery(querystring)
+        except SPARQLParseException:
+            return None
+    print('  {:<28} {}'.format('size', ' '.join('{:>8}'.format(n) for n in sizes)))
+    for name, query in adversarialQueries.items():
+        expected = parse(query(10)) is not None
+        assert all((parse(query(n)) is not None) == expected for n in sizes), 'hostile query "{}" not consistently accepted or rejected'.format(name)
+        times = [bestOf(lambda: parse(query(n))) for n in sizes]
+        print('  {:<28} {}s  ({}, {:.1f}x)'.format(name, ' '.join('{:8.4f}'.format(t) for t in times), 'accepted' if expected else 'rejected', times[-1] / times[0]))
+
+def benchRender(corpus):
+    '''Parses the corpus and the large update requests from payloadQueries, and times dump() and equality of two trees for the same 
+    query, on fresh trees and once more on the same trees, which then use the strings cached by the first renders (see ParseStruct.__str__).'''
+    for name, queries in ('corpus', [s for _, s in corpus]), ('payloads', payloadQueries()):
+        for operation, func in ('dump', lambda pair: pair[0].dump()), ('equality', lambda pair: pair[0] == pair[1]):
+            fresh = None
+            for _ in range(3):
+                pairs = [(parsePrepared(s), parsePrepared(s)) for s in queries]
+                start = time.perf_counter()
+                assert all(func(pair) for pair in pairs)
+                elapsed = time.perf_counter() - start
+                fresh = elapsed if fresh is None else min(fresh, elapsed)
+            report('{}, {}, fresh'.format(operation, name), fresh)
+            report('{}, {}, cached'.format(operation, name), bestOf(lambda: [func(pair) for pair in pairs]), fresh)
+
+def benchDedupe(corpus):
+    '''Parses every query of the corpus twice, and removes the duplicate trees with a set, which uses ParseStruct.__hash__, and by 
+    comparing each tree with the distinct trees found so far, as was needed while elements were unhashable. Both start from fresh trees.'''
+    queries = [s for _, s in corpus] * 2
+    def byList(trees):
+        result = []
+        for tree in trees:
+            if tree not in result:
+                result.append(tree)
+        return result
+    counts = set()
+    for name, dedupe in ('list', byList), ('set', set):
+        best = None
+        for _ in range(3):
+            trees = [parsePrepared(s) for s in queries]
+            start = time.perf_counter()
+            counts.add(len(dedupe(trees)))
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        report('dedupe by ' + name, best)
+    assert len(counts) == 1, 'different numbers of distinct trees'
+    print('  {} distinct trees of {}'.format(counts.pop(), len(queries)))
+
+def benchLocations(corpus):
+    '''Parses the corpus and the large update requests from payloadQueries with spans, and times taking the text of every element, 
+    with str() on fresh trees, which renders the elements, and with getSourceText(), which slices the text from the parsed string 
+    (see ParseStruct.getLocation). Both are compared without whitespace and case, which str() normalizes.'''
+    for name, queries in ('corpus', [s for _, s in corpus]), ('payloads', payloadQueries()):
+        trees = [parsePrepared(s, spans=True) for s in queries]
+        assert all(''.join(str(e).upper().split()) == ''.join(e.getSourceText().upper().split()) for r in trees for e in r.searchElements()), 'source text differs'
+        times = {}
+        for method in 'str', 'getSourceText':
+            best = None
+            for _ in range(3):
+                elements = [e for r in [parsePrepared(s, spans=True) for s in queries] for e in r.searchElements()]
+                func = str if method == 'str' else ParseStruct.getSourceText
+                start = time.perf_counter()
+                for e in elements:
+                    func(e)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            times[method] = best
+            report('{}, {} ({} elements)'.format(method, name, len(elements)), best, times['str'] if method != 'str' else None)
+
+deepQueries = {'nested group patterns': lambda n: 'SELECT * WHERE { ' + '{ ' * n + '?s ?p ?o' + ' }' * n + ' }',
+               'update chain': lambda n: ' ; '.join(['CLEAR GRAPH <a:b>'] * n),
+               'nested expressions': lambda n: 'SELECT * WHERE { FILTER (' + '(' * n + '1' + ')' * n + ') }',
+               }
+
+def treeDepth(element):
+    '''Returns the number of elements on the longest path from element to a leaf.'''
+    result = 0
+    stack = [(element, 1)]
+    while stack:
+        element, depth = stack.pop()
+        result = max(result, depth)
+        stack.extend((i, depth + 1) for i in element._items if isinstance(i, ParseStruct))
+    return result
+
+def benchDepth(corpus):
+    '''Parses the deeply nested queries from deepQueries, with a nesting of 10000 (1000 for the expressions, which nest about a dozen 
+    elements per parenthesis), and times the tree algorithms on them. The parse itself recurses in pyparsing, and runs in a thread with a 
+    raised recursion limit and a large stack; the algorithms run with the default recursion limit, which is far below the depth of the trees.'''
+    trees = {}
+    def parse():
+        for name, query in deepQueries.items():
+            n = 1000 if name == 'nested expressions' else 10000
+            unit = SPARQLParser.UpdateUnit if name == 'update chain' else SPARQLParser.QueryUnit
+            trees[name] = unit(query(n), postParseCheck=False), query(n)
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(10 ** 6)
+    size = threading.stack_size(1 << 30)
+    try:
+        thread = threading.Thread(target=parse)
+        thread.start()
+        thread.join()
+    finally:
+        threading.stack_size(size)
+        sys.setrecursionlimit(limit)
+    for name, (tree, querystring) in trees.items():
+        print('  {} (depth {})'.format(name, treeDepth(tree)))
+        assert tree.hasParentPointers(), 'missing parent pointers'
+        assert ''.join(str(tree).split()) == ''.join(querystring.split()), 'rendering differs from the query'
+        report('str', bestOf(lambda: str(tree)))
+        report('searchElements', bestOf(lambda: tree.searchElements()))
+        report('createParentPointers', bestOf(lambda: tree.createParentPointers()))
+        report('hasParentPointers', bestOf(lambda: tree.hasParentPointers()))
+        report('_applyPrefixesAndBase', bestOf(lambda: tree._applyPrefixesAndBase(baseiri=baseiri)))
+        report('compact', bestOf(lambda: tree.compact(), rounds=1))
+
+benchmarks = {'packrat': benchPackrat,
+              'lexer': benchLexer,
+              'tokens': benchTokens,
+              'dispatch': benchDispatch,
+              'generated': benchGenerated,
+              'classify': benchClassify,
+              'compact': benchCompact,
+              'memory': benchMemory,
+              'arena': benchArena,
+              'spans': benchSpans,
+              'parents': benchParents,
+              'expression': benchExpression,
+              'adversarial': benchAdversarial,
+              'depth': benchDepth,
+              'render': benchRender,
+              'dedupe': benchDedupe,
+              'gc': benchGC,
+              'locations': benchLocations,
+              'search': benchSearch,
+              'first': benchFirst,
+              'value': benchValue,
+              'selectors': benchSelectors,
+              'visitors': benchVisitors,
+              }
+
+if __name__ == '__main__':
+    warnings.simplefilter('ignore')
+    names = sys.argv[1:] or list(benchmarks)
+    corpus = loadCorpus()
+    print('Corpus: {} queries, {} characters'.format(len(corpus), sum(len(s) for _, s in corpus)))
+    for name in names:
+        print('\n' + name)
+        benchmarks[name](corpus)
@@ -4,9 +4,25 @@ Created on 20 apr. 2016
 @author: jeroenbruijning
 '''
 import unittest
+import unittest.mock
+import copy
+import gc
+import os
+import sys
+import tempfile
+import threading
+import time
+import weakref
+from pyparsing import ParserElement, ParseException, Forward, Group, Literal, Regex, Word, ZeroOrMore, alphas
 
 from parsertools.parsers.sparqlparser import SPARQLParser, SPARQLParseException
-from parsertools.parsers.sparqlparser import stripComments, parseQuery, unescapeUcode
+from parsertools.parsers.sparqlparser import stripComments, parseQuery, unescapeUcode, classifyRequest, SPARQLLexer, ExpressionParser, charClass
+from parsertools import ParsertoolsException, ParseTimeoutError, SelectorException, GeneratorException
+from parsertools.base import ParseStruct, Parser, PredictiveMatchFirst, TokenRegex, deadlineScope, checkDeadline
+from parsertools.generator import grammarFingerprint, loadParser, _Generator
+from parsertools.arena import ParseArena
+from parsertools.selector import Selector, SelectorSet, _SELECTOR_CACHE_SIZE
+from parsertools.visitor import Visitor, VisitorSet
 
 
 class Test(unittest.TestCase):
@@ -108,7 +124,64 @@ SELECT ?p WHERE
 'sdfasf# sdfsfd'
 """[1:-1]
         assert stripComments(s1) == s2
-    
+        
+        s3 = """
+SELECT * { ?s ?p '''one # two
+three''' } # comment
+"""[1:-1]
+        s4 = "SELECT * { ?s ?p  '''one # two\nthree''' } "
+        assert stripComments(s3) == s4
+        r = parseQuery(s3)
+        assert str(r.searchElements(element_type=SPARQLParser.STRING_LITERAL_LONG1)[0]) == "'''one # two\nthree'''"
+        assert str(parseQuery('ASK { FILTER (?x<=1 && ?y <= 2 && ?z < 3) } # <=').searchElements(element_type=SPARQLParser.LE)[1]) == '<='
+        # Tabs are expanded, as pyparsing did when comments were stripped with it
+        assert stripComments('SELECT\t?x # a\tb\n\t{ ?x ?p "a\tb" }') == 'SELECT  ?x \n{ ?x ?p  "a      b" }'
+        assert stripComments("ASK { ?s ?p '''x\ty''' }") == "ASK { ?s ?p  '''x        y''' }"
+
+    def testTerminals(self):
+        assert charClass(r'[a-z]', r'[_0-9]') == r'[a-z_0-9]'
+        for class_, valid, invalid in [(SPARQLParser.PN_LOCAL, ['a', '0', ':', 'a..b', 'a:.%41', '\\.a.\\.', 'a-\u00B7'], ['.a', 'a.', '%4', 'a%4g']),
+                                       (SPARQLParser.PN_PREFIX, ['a', 'a.-b', 'a..0'], ['0', '_a', 'a.', 'a:']),
+                                       (SPARQLParser.BLANK_NODE_LABEL, ['_:0', '_:a.b', '_:a-.-'], ['_:a.', '_:-a', '_:']),
+                                       (SPARQLParser.VARNAME, ['a', '0a', 'a\u00B7\u0300'], ['-a', 'a-b', '\u00B7']),
+                                       (SPARQLParser.STRING_LITERAL_LONG1, ["''''''", "'''a''b'c\\''''", "'''\n'''"], ["'''''''", "'''\\x'''"]),
+                                       (SPARQLParser.STRING_LITERAL2, ['""', '"a\\"b"', '"\\\\"'], ['"a\nb"', '"\\"']),]:
+            for s in valid:
+                assert str(class_(s)) == s, s
+            for s in invalid:
+                self.assertRaises(ParseException, class_, s)
+        # A hostile query with a long unterminated string is rejected (in linear time)
+        self.assertRaises(SPARQLParseException, parseQuery, "ASK { ?s ?p '" + "\\'" * 10000 + ' }')
+        
+    def testLexer(self):
+        s = 'PREFIX ex: <http://a#b> SELECT ?x { ?x a ex:b ; ex:c "x"@en, 1.5e+3, -2 FILTER (?x != 3) } # c'
+        tokens = SPARQLLexer.tokenize(s)
+        assert [t.kind for t in tokens] == ['NAME', 'PNAME_NS', 'IRIREF', 'NAME', 'VAR1', 'LCURL', 'VAR1', 'NAME', 'PNAME_LN', 'SEMICOL', 'PNAME_LN', 
+                                            'STRING_LITERAL2', 'LANGTAG', 'COMMA', 'DOUBLE', 'COMMA', 'MINUS', 'INTEGER', 'NAME', 'LPAR', 'VAR1',
+                                            'NE', 'INTEGER', 'RPAR', 'RCURL', 'COMMENT'], [t.kind for t in tokens]
+        assert all(s[t.start:t.end] == t.text for t in tokens)
+        assert next(SPARQLLexer.iterTokens(s, tokens[3].start)) == tokens[3]
+        self.assertRaises(ParsertoolsException, SPARQLLexer.tokenize, 'SELECT ?x { ?x ~ 3 }')
+        # In token mode, the terminals match on the tokens of the lexer, with the same results
+        queries = [s[:-4], 'PREFIX ex: <a:> SELECT * { ?s ?p "a", 1, 1.5, -2, +3.0e+1, _:b, $v, ex:, ex:a.b, """x""", \'\'\'y\'\'\' } VALUES ?v { <a:b> 2 }',
+                   'PREFIX : <a:> INSERT DATA { :a :b :c } ; DELETE WHERE { ?x :p "a"@en-gb }', 'ASK { ?x <a:p> 1.e+5 FILTER (?x<3&&?y>-.5) }']
+        expected = [parseQuery(q).dump() for q in queries]
+        assert SPARQLParser.getLexer() is None
+        SPARQLParser.setLexer(SPARQLLexer)
+        try:
+            assert SPARQLParser.getLexer() is SPARQLLexer and isinstance(SPARQLParser.IRIREF.getPattern(), TokenRegex)
+            assert not isinstance(SPARQLParser.INTEGER_NEGATIVE.getPattern(), TokenRegex)
+            assert [parseQuery(q).dump() for q in queries] == expected
+            assert [parseQuery(q, spans=True).dump() for q in queries] == expected
+            self.assertRaises(ParseException, SPARQLParser.PrefixedName, 'ex:a b', postParseCheck=False)
+            assert str(SPARQLParser.PNAME_NS('ex:')) == 'ex:' and str(SPARQLParser.INTEGER_NEGATIVE('-2')) == '-2'
+            # Where the string cannot be tokenized any further, the terminals run their regexes
+            self.assertRaises(ParseException, SPARQLParser.GroupGraphPattern, '{ ?x ~ 3 }', postParseCheck=False)
+            assert str(SPARQLParser.GroupGraphPattern('{ ?x <a:b> "~" }', postParseCheck=False)) == '{ ?x <a:b> "~" }'
+        finally:
+            SPARQLParser.setLexer(None)
+        assert type(SPARQLParser.IRIREF.getPattern()) is Regex
+
     def testSearchElements(self):
         
         s = '<c:check#22?> ( $var, ?var )'
@@ -138,13 +211,60 @@ SELECT ?p WHERE
          
         ancestors = arglist.getAncestors()
         assert str(ancestors) == '[iriOrFunction("<c:check#22?> ( $var , ?var )"), PrimaryExpression("<c:check#22?> ( $var , ?var )")]', str(ancestors)
+        # The parent pointers are set while the tree is built, also by the expression parser
+        r = parseQuery('SELECT ?x WHERE { ?x <p:p> ?y FILTER (?y > 1 + 2 * -?x || !BOUND(?y)) }')
+        assert r.hasParentPointers()
+        assert [e.__class__.__name__ for e in r.searchElements(element_type=SPARQLParser.NEGATE)[0].getAncestors()[:2]] == ['UnaryExpression', 'MultiplicativeExpression']
 
     def testParseQuery(self):
         s = 'BASE <work:22?> SELECT REDUCED $var1 ?var2 (("*Expression*") AS $var3) { SELECT * {} } GROUP BY ROUND ( "*Expression*") VALUES $S { <t:testIri> <t:testIri> }'
         parseQuery(s)
         s = 'BASE <prologue:22> PREFIX prologue: <prologue:33> LOAD <t:testIri> ; BASE <prologue2:42> PREFIX prologue2: <prologue3:33>'
         parseQuery(s)
+        assert classifyRequest('BASE <a:> PREFIX p: <a:b>\nprefix : <c:d> select * {}') == SPARQLParser.QueryUnit
+        assert classifyRequest('PREFIX p: <a:b> with <a:c> DELETE { ?s ?p ?o } WHERE {}') == SPARQLParser.UpdateUnit
+        assert classifyRequest('BASE <a:>') == SPARQLParser.UpdateUnit
+        assert classifyRequest('') == SPARQLParser.UpdateUnit
+        assert classifyRequest('PREFIX <a:b> SELECT * {}') == None
+        assert classifyRequest('PREFIX p: <a:b') == None
+        assert classifyRequest('SELECTX * {}') == None
+        assert parseQuery('').__class__ == SPARQLParser.UpdateUnit
+        assert parseQuery('PREFIX : <a:b> CLEAR ALL').__class__ == SPARQLParser.UpdateUnit
+        self.assertRaises(SPARQLParseException, parseQuery, 'PREFIX : <a:b> SELECT * { } ; CLEAR ALL')
+        self.assertRaises(SPARQLParseException, parseQuery, 'PREFIX <a:b> SELECT * {}')
+        
+    def testKeywordDispatch(self):
+        for s in ['str(?x)', 'Group_Concat(DISTINCT ?x ; SEPARATOR = ",")', 'NOT EXISTS {}', 'bnode()', 'BNODE(?x)', 'isIRI(<a:b>)']:
+            r = SPARQLParser.BuiltInCall(s, postParseCheck=False)
+            assert r.yieldsValidExpression()
+        self.assertRaises(ParseException, SPARQLParser.BuiltInCall, 'STRX(?x)', postParseCheck=False)
+        self.assertRaises(ParseException, SPARQLParser.BuiltInCall, 'UNKNOWN(?x)', postParseCheck=False)
+        # Alternatives without a leading keyword are tried for every word
+        assert SPARQLParser.GraphPatternNotTriples('{ ?s ?p ?o } UNION {}', postParseCheck=False).getChildren()[0].__class__ == SPARQLParser.GroupOrUnionGraphPattern
+        assert SPARQLParser.Update1('INSERT DATA { <a:b> <a:b> <a:b> }', postParseCheck=False).getChildren()[0].__class__ == SPARQLParser.InsertData
+        assert SPARQLParser.Update1('INSERT { ?s ?p ?o } WHERE { ?s ?p ?o }', postParseCheck=False).getChildren()[0].__class__ == SPARQLParser.Modify
+        assert SPARQLParser.Update1('WITH <a:b> DELETE { ?s ?p ?o } WHERE { ?s ?p ?o }', postParseCheck=False).getChildren()[0].__class__ == SPARQLParser.Modify
     
+    def testFirstSets(self):
+        SPARQLParser.compile()
+        first = SPARQLParser.getFirstSet('Var')
+        assert first.canStartWith('?') and first.canStartWith('$') and not first.canStartWith('<') and not first.canStartWith(None)
+        first = SPARQLParser.getFirstSet('BooleanLiteral')
+        assert first.canStartWith('t') and not first.canStartWith('T')
+        first = SPARQLParser.getFirstSet('DISTINCT')
+        assert first.canStartWith('d') and first.canStartWith('D')
+        first = SPARQLParser.getFirstSet('PNAME_NS')
+        assert first.canStartWith(':') and first.canStartWith('\u00C0') and not first.canStartWith('1')
+        assert SPARQLParser.getFirstSet('Prologue').nullable
+        # Alternatives of GraphTerm that cannot start with the next character are not tried
+        alternatives = SPARQLParser.GraphTerm._pattern.expr
+        assert isinstance(alternatives, PredictiveMatchFirst)
+        assert alternatives._firstTable['?'] == ()
+        assert [e.name for e in alternatives._firstTable['"']] == ['RDFLiteral']
+        for s in ['<a:b>', 'ex:b', '"x"@en', '1.5', '-1', 'true', '_:b1', '[]', '()']:
+            assert SPARQLParser.GraphTerm(s, postParseCheck=False).yieldsValidExpression()
+        self.assertRaises(ParseException, SPARQLParser.GraphTerm, '?x', postParseCheck=False)
+        
     def testDump(self):
         s = '(DISTINCT "*Expression*",  "*Expression*",   "*Expression*" )'
         s_dump = '''
@@ -563,6 +683,600 @@ WHERE   { <book1>  dc:title  ?title }
         s = 'abra\\U000C00AAcada\\u00AAbr\u99DDa'
         assert unescapeUcode(s) == 'abra󀂪cadaªbr駝a'
 
+    def testPackrat(self):
+        s = 'PREFIX ex: <http://example.org/> SELECT ?s (COUNT(?o) AS ?n) WHERE { ?s ex:p/ex:q* ?o FILTER (?o > 2 || STRLEN(STR(?o)) < 4) } GROUP BY ?s'
+        assert not SPARQLParser.getPackrat()
+        r1 = parseQuery(s)
+        # Memoization is a setting of the process, which is not switched for single parses
+        self.assertRaises(TypeError, parseQuery, s, packrat=True)
+        SPARQLParser.setPackrat(True, cacheSize=16)
+        try:
+            assert SPARQLParser.getPackrat() and ParserElement._packratEnabled
+            r2 = parseQuery(s)
+            assert r1.dump() == r2.dump()
+            assert r2.hasParentPointers()
+            r3 = SPARQLParser.QueryUnit(s)
+            assert r3.dump() == r1.dump()
+            r3.searchElements(element_type=SPARQLParser.Var)[0].updateWith('?t')
+            assert str(r3.searchElements(element_type=SPARQLParser.SelectClause)[0]) == 'SELECT ?t ( COUNT ( ?o ) AS ?n )'
+            # Parses in several threads share the setting, and give the same trees
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(parseQuery(s).dump())) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert results == [r1.dump()] * 4 and ParserElement._packratEnabled
+            # Switching it on again with another cache size is an error
+            SPARQLParser.setPackrat(True, cacheSize=16)
+            self.assertRaises(ParsertoolsException, SPARQLParser.setPackrat, True, cacheSize=32)
+        finally:
+            SPARQLParser.setPackrat(False)
+        assert not ParserElement._packratEnabled and not SPARQLParser.getPackrat()
+        # All parsers share the setting
+        other = Parser()
+        SPARQLParser.setPackrat(True)
+        try:
+            assert other.getPackrat()
+            other.setPackrat(False)
+            assert not ParserElement._packratEnabled and not SPARQLParser.getPackrat()
+        finally:
+            Parser.setPackrat(False)
+        # Packrat parsing that was enabled in pyparsing itself is left alone
+        ParserElement.enable_packrat()
+        try:
+            SPARQLParser.setPackrat(False)
+            assert ParserElement._packratEnabled and parseQuery(s).dump() == r1.dump()
+        finally:
+            ParserElement.disable_memoization()
+
+    def testCompact(self):
+        s = 'PREFIX ex: <http://example.org/> SELECT ?s WHERE { ?s ex:p 1 , "a" FILTER (?s != ex:b) }'
+        plain = parseQuery(s)
+        r = parseQuery(s, compact=True)
+        assert str(r) == str(plain)
+        e = SPARQLParser.Expression('1', compact=True)
+        assert e.isCompact() and str(e) == '1'
+        # Searches that cannot match an element of a chain leave the chain collapsed
+        assert e.searchElements(element_type=SPARQLParser.Var) == [] and e.isCompact()
+        assert [c.__class__.__name__ for c in e.getChildren()] == ['ConditionalOrExpression'] and not e.isCompact()
+        assert e.descend().__class__ == SPARQLParser.INTEGER
+        assert e.descend().getAncestors()[-1] is e
+        for kwargs in [dict(element_type=SPARQLParser.PrefixedName), dict(label='prefix'), dict(labeledOnly=True), dict(value='"a"')]:
+            assert [(e.__class__, e.getLabel(), str(e)) for e in r.searchElements(**kwargs)] == [(e.__class__, e.getLabel(), str(e)) for e in plain.searchElements(**kwargs)]
+        name = r.searchElements(element_type=SPARQLParser.PrefixedName)[-1]
+        assert [str(e) for e in name.getAncestors()] == [str(e) for e in plain.searchElements(element_type=SPARQLParser.PrefixedName)[-1].getAncestors()]
+        assert name.getPrefixes() == {'ex:': 'http://example.org/'}
+        assert r.dump() == plain.dump()
+        assert r.hasParentPointers()
+        r = parseQuery(s, compact=True)
+        r.searchElements(element_type=SPARQLParser.PrefixedName)[-1].updateWith('ex:c')
+        assert str(r) == str(plain).replace('ex:b', 'ex:c')
+        SPARQLParser.setCompact(True)
+        try:
+            assert SPARQLParser.Expression('1').isCompact()
+            assert SPARQLParser.Expression('1', compact=False).getItems()[0].__class__ == SPARQLParser.ConditionalOrExpression
+        finally:
+            SPARQLParser.setCompact(False)
+
+    def testSlots(self):
+        s = 'PREFIX ex: <http://example.org/> SELECT ?s WHERE { ?s ex:p "a" }'
+        r = parseQuery(s)
+        for e in [r] + r.searchElements():
+            self.assertRaises(TypeError, vars, e)
+        self.assertRaises(AttributeError, setattr, r, '_items', [])
+        self.assertRaises(AttributeError, setattr, r, 'other', None)
+        self.assertRaises(AttributeError, getattr, r, '_other')
+        name = r.searchElements(element_type=SPARQLParser.PrefixedName)[0]
+        assert str(name.getParent().getParent().getParent()) == 'ex:p'
+        assert name.getPrefixes() == {'ex:': 'http://example.org/'}
+        for compact in False, True:
+            r = parseQuery(s, compact=compact)
+            r_copy = copy.deepcopy(r)
+            assert r_copy.dump() == r.dump() and r_copy.hasParentPointers()
+            assert r_copy.searchElements(element_type=SPARQLParser.PrefixedName)[0].getPrefixes() == name.getPrefixes()
+        # Subclasses without __slots__ keep their attributes in an instance dict
+        class Annotated(SPARQLParser.Expression):
+            pass
+        e = Annotated(None)
+        e.__dict__['note'] = 'annotated'
+        e.setItems(SPARQLParser.Expression('1').getItems())
+        assert copy.deepcopy(e).__getstate__()['note'] == 'annotated'
+        assert str(copy.deepcopy(e)) == '1'
+
+    def testExpressionParser(self):
+        engine = SPARQLParser.Expression._pattern.expr
+        assert isinstance(engine, ExpressionParser)
+        for s in ['1', '?x <= 1', '?x != 2', '!?x', '- -1', '?x -1', '?x +1*2', '?x+-1/2*3', '?x - 1 * 2 / ?y', '?x IN (1, 2)', '?x NOT IN ()', 
+                  '?a || ?b && !BOUND(?c)', '(?a || ?b) && -?c', '?x < ?y < ?z', '1 +', 'STR(?x) = "a"@en && ?y']:
+            expected = engine.expr.parseString(s)[0][0]
+            r = engine.parseString(s)[0]
+            assert r.dump() == expected.dump(), s
+            assert str(r) == str(expected)
+        self.assertRaisesRegex(ParseException, 'ConditionalOrExpression', engine.parseString, 'NOT IN')
+        r = SPARQLParser.Expression('?x - -2 * 3')
+        assert [e.__class__.__name__ for e in r.getChildren()[0].descend().getChildren()] == ['MultiplicativeExpression', 'MINUS', 'MultiplicativeExpression']
+        
+    def testDeadline(self):
+        query = 'PREFIX ex: <http://example.org/> SELECT ?s WHERE { ?s ex:p "a\\tb" FILTER (?s != ex:o) }'
+        expected = parseQuery(query).dump()
+        assert parseQuery(query, timeout=60).dump() == expected
+        assert parseQuery(query, deadline=time.monotonic() + 60).dump() == expected
+        self.assertRaises(ParseTimeoutError, parseQuery, query, deadline=time.monotonic() - 1)
+        self.assertRaises(ParseTimeoutError, parseQuery, query, timeout=-1)
+        self.assertRaises(ParseTimeoutError, SPARQLParser.QueryUnit, query, timeout=-1)
+        self.assertRaises(ParseTimeoutError, SPARQLParser.Expression, '?x + 1', timeout=-1)
+        # The timeout is distinct from a parse failure
+        assert not issubclass(ParseTimeoutError, (SPARQLParseException, ParseException))
+        # The earliest deadline in force applies, also in post processing steps; afterwards, the deadline is lifted
+        r = parseQuery(query)
+        with deadlineScope(timeout=60) as deadline:
+            with deadlineScope(timeout=3600) as inner:
+                assert inner == deadline
+            with deadlineScope(deadline=deadline - 120):
+                self.assertRaises(ParseTimeoutError, checkDeadline)
+                self.assertRaises(ParseTimeoutError, r.processEscapeSeqs)
+                self.assertRaises(ParseTimeoutError, r._checkParsedQuery)
+                self.assertRaises(ParseTimeoutError, r._applyPrefixesAndBase)
+            checkDeadline()
+        checkDeadline()
+        assert parseQuery(query).dump() == expected
+        # Deadlines are per thread
+        results = []
+        with deadlineScope(timeout=-1):
+            thread = threading.Thread(target=lambda: results.append(parseQuery(query).dump()))
+            thread.start()
+            thread.join()
+        assert results == [expected]
+        
+    def testArena(self):
+        s = 'PREFIX ex: <http://example.org/> SELECT ?s (COUNT(?o) AS ?n) WHERE { ?s ex:p "a" , ?o FILTER (?o != ex:b) } GROUP BY ?s'
+        for compact in False, True:
+            r = parseQuery(s, compact=compact)
+            arena = ParseArena(r)
+            plain = parseQuery(s)
+            assert arena.dump() == plain.dump()
+            # searchElements returns the root twice
+            assert len(arena) + 1 == len(plain.searchElements())
+            assert arena.getString(0) == str(plain)
+            for kwargs in [dict(element_type=SPARQLParser.Var), dict(label='prefix'), dict(labeledOnly=True), dict(value='?o'), dict(element_type=SPARQLParser.Update)]:
+                assert [(arena.getClass(i), arena.getLabel(i), arena.getString(i)) for i in arena.searchElements(**kwargs)] == [(e.__class__, e.getLabel(), str(e)) for e in plain.searchElements(**kwargs)]
+        v = arena.searchElements(element_type=SPARQLParser.PrefixedName)[-1]
+        expected = plain.searchElements(element_type=SPARQLParser.PrefixedName)[-1]
+        assert [arena.getString(i) for i in arena.getAncestors(v)] == [str(e) for e in expected.getAncestors()]
+        assert arena.getAncestors(v)[-1] == 0 and arena.getParent(0) is None
+        assert arena.getAttributes(v) == {'_prefixes': {'ex:': 'http://example.org/'}, '_baseiri': None}
+        # Views offer the ParseStruct methods for inspecting the tree
+        view = arena.getView()
+        assert view.getClass() == SPARQLParser.QueryUnit and str(view) == str(plain)
+        select = view.searchElements(element_type=SPARQLParser.SelectClause)[0]
+        assert select == arena.getView(select.getIndex()) and select is not arena.getView(select.getIndex())
+        assert [str(e) for e in select.getChildren()] == [str(e) for e in plain.searchElements(element_type=SPARQLParser.SelectClause)[0].getChildren()]
+        assert str(view.searchElements(label='prefix')[0].descend()) == 'ex:'
+        assert view.searchElements(element_type=SPARQLParser.PrefixedName)[0].getAncestors()[-1] == view
+        self.assertRaises(AttributeError, setattr, view, 'other', None)
+        # ParseStruct trees can be recreated from the arena
+        e = arena.getElement()
+        assert e.dump() == plain.dump() and e.hasParentPointers()
+        assert e.searchElements(element_type=SPARQLParser.PrefixedName)[0].getPrefixes() == {'ex:': 'http://example.org/'}
+        e = select.getElement()
+        assert e.getParent() is None and str(e) == str(select)
+
+    def testSpans(self):
+        s = 'PREFIX ex: <http://example.org/> select ?s WHERE { ?s ex:p "a\\tb" , ?o FILTER (?o != ex:b) } VALUES ?x { 1 "c" UNDEF }'
+        expected = parseQuery(s)
+        r = parseQuery(s, spans=True)
+        assert str(r) == str(expected) and r.dump() == expected.dump() and r == expected
+        tokens = [i for e in r.searchElements() for i in e._items if not isinstance(i, ParseStruct)]
+        # Caseless keywords and strings changed by processEscapeSeqs are kept as strings
+        assert [i for i in tokens if isinstance(i, str)] == ['SELECT', '"a\tb"']
+        assert len([i for i in tokens if isinstance(i, int)]) == 24
+        assert all(e._source is r._source for e in r.searchElements() if any(isinstance(i, int) for i in e._items))
+        literal = r.searchElements(element_type=SPARQLParser.String)[-1]
+        assert literal.getItems()[0].getItems() == ['"c"'] and literal.descend().isAtom()
+        assert parseQuery(s, spans=True, compact=True).dump() == expected.dump()
+        assert ParseArena(r).dump() == expected.dump()
+        r_copy = copy.deepcopy(r)
+        assert r_copy.dump() == expected.dump()
+        r.searchElements(element_type=SPARQLParser.Var)[0].updateWith('?t')
+        assert str(r) == str(expected).replace('?s', '?t', 1)
+        SPARQLParser.setSpans(True)
+        try:
+            e = SPARQLParser.Expression('?x + 1')
+            var = e.searchElements(element_type=SPARQLParser.Var)[0]
+            assert str(e) == '?x + 1' and isinstance(var.descend()._items[0], int)
+            e = SPARQLParser.Expression('?x + 1', spans=False)
+            assert isinstance(e.searchElements(element_type=SPARQLParser.Var)[0].descend()._items[0], str)
+        finally:
+            SPARQLParser.setSpans(False)
+        e = SPARQLParser.Expression('?x + 1')
+        assert isinstance(e.searchElements(element_type=SPARQLParser.Var)[0].descend()._items[0], str)
+        # getItems returns a new list, with and without spans
+        for r in parseQuery(s), parseQuery(s, spans=True):
+            var = r.searchElements(element_type=SPARQLParser.Var)[0].descend()
+            items = var.getItems()
+            items[0] = '?t'
+            assert var.getItems() == ['?s'] and str(r) == str(expected)
+
+    def testShared(self):
+        s = 'PREFIX ex: <http://example.org/> SELECT ?s WHERE { ?s ex:p "a" , ?o ; ex:q (1) FILTER (?o != ex:b || ?o > 1+2) } VALUES ?x { 1 }'
+        expected = parseQuery(s)
+        r = parseQuery(s, shared=True)
+        assert str(r) == str(expected) and r.dump() == expected.dump()
+        other = parseQuery(s.replace('?s', '?t'), shared=True)
+        select, otherSelect = [t._items[0]._items[1]._items[0] for t in (r, other)]
+        assert select._items[0] is otherSelect._items[0] and select._items[0].getParent() is None
+        # Searches that cannot return shared elements leave them in place
+        assert len(r.searchElements(element_type=SPARQLParser.Var)) == 6
+        assert select._items[0] is otherSelect._items[0]
+        # Shared elements are never returned; they are replaced by elements of their own, with parent pointers
+        keywords = r.searchElements(element_type=SPARQLParser.SELECT)
+        assert len(keywords) == 1 and keywords[0] is not otherSelect._items[0] and keywords[0].getParent() is select
+        assert select.getChildren()[0] is keywords[0]
+        assert [str(e) for e in r.searchElements(element_type=SPARQLParser.LPAR)[0].getAncestors()] == [str(e) for e in expected.searchElements(element_type=SPARQLParser.LPAR)[0].getAncestors()]
+        assert r.searchElements(element_type=SPARQLParser.RPAR)[0].getPrefixes() == {'ex:': 'http://example.org/'}
+        assert r.hasParentPointers() and r.dump() == expected.dump()
+        r = parseQuery(s, shared=True)
+        assert copy.deepcopy(r)._items[0]._items[1]._items[0]._items[0] is otherSelect._items[0]
+        assert ParseArena(r).dump() == expected.dump()
+        assert ParseArena(r).getAttributes(ParseArena(r).searchElements(element_type=SPARQLParser.RPAR)[0]) == {'_prefixes': {'ex:': 'http://example.org/'}, '_baseiri': None}
+        assert parseQuery(s, shared=True, spans=True, compact=True).dump() == expected.dump()
+        r.searchElements(element_type=SPARQLParser.Var)[-1].updateWith('?y')
+        assert str(r) == str(expected).replace('?x', '?y') and str(other).startswith('PREFIX ex: <http://example.org/> SELECT ?t WHERE')
+
+    def testDeep(self):
+        # The parse recurses in pyparsing, and needs a raised recursion limit and a large stack; the tree algorithms do not
+        s = 'PREFIX ex: <http://example.org/> ' + ' ; '.join(['CLEAR GRAPH ex:g'] * 1000)
+        trees = []
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(100000)
+        size = threading.stack_size(1 << 28)
+        try:
+            thread = threading.Thread(target=lambda: trees.append(parseQuery(s)))
+            thread.start()
+            thread.join()
+        finally:
+            threading.stack_size(size)
+            sys.setrecursionlimit(limit)
+        r = trees[0]
+        assert str(r) == s
+        assert len(r.searchElements(element_type=SPARQLParser.PrefixedName)) == 1000
+        assert r.searchElements(element_type=SPARQLParser.PrefixedName)[-1].getPrefixes() == {'ex:': 'http://example.org/'}
+        r.createParentPointers()
+        assert r.hasParentPointers() and len(r.searchElements(element_type=SPARQLParser.iri)[-1].getAncestors()) > limit
+        assert r.dump().count('[CLEAR]') == 1000
+        assert str(r.compact()) == s and r.hasParentPointers()
+
+    def testCachedStr(self):
+        s = 'PREFIX ex: <http://example.org/> SELECT ?s WHERE { ?s ex:p "a" FILTER ( ?s != ex:b ) }'
+        r = parseQuery(s)
+        assert r._string is None and str(r) == s and r._string == s
+        # Only the rendered element keeps its string
+        filter_ = r.searchElements(element_type=SPARQLParser.Filter)[0]
+        assert filter_._string is None and str(filter_) == 'FILTER ( ?s != ex:b )' and filter_._string is not None
+        # Changes drop the cached strings of the element and its ancestors
+        var = filter_.searchElements(element_type=SPARQLParser.Var)[0]
+        var.updateWith('?t')
+        assert filter_._string is None and r._string is None
+        assert str(filter_) == 'FILTER ( ?t != ex:b )' and str(r) == s.replace('( ?s', '( ?t')
+        assert r == parseQuery(str(r)) and r != parseQuery(s)
+        # setItems makes the element the parent of its new items, so that their changes drop the cached strings as well
+        new = SPARQLParser.VAR1('?y')
+        var.setItems([new])
+        assert new.getParent() is var and str(r) == s.replace('( ?s', '( ?y')
+        new.updateWith('?z')
+        assert str(r) == s.replace('( ?s', '( ?z') and r.hasParentPointers()
+        # Also for compact elements, whose chains are expanded when their items are changed
+        r = parseQuery(s, compact=True)
+        assert str(r) == s
+        r.searchElements(element_type=SPARQLParser.String)[0].updateWith('"b"')
+        assert str(r) == s.replace('"a"', '"b"') and r.dump() == parseQuery(str(r)).dump()
+
+    def testHash(self):
+        s = 'SELECT ?s WHERE { ?s ?p "a" }'
+        r = parseQuery(s)
+        # Equal elements have equal hashes, also when their structures differ
+        assert r == parseQuery(s, compact=True) and hash(r) == hash(parseQuery(s, compact=True))
+        assert len({r, parseQuery(s), parseQuery(s, spans=True, shared=True), parseQuery(s.replace('"a"', '"b"'))}) == 2
+        assert r != SPARQLParser.QueryUnit(s.replace('?p', '?q')) and r != s
+        # Elements of different classes with the same string differ
+        var = r.searchElements(element_type=SPARQLParser.VAR1)[0]
+        assert var != var.getParent() and str(var) == str(var.getParent())
+        cache = {r: 'a'}
+        assert cache[parseQuery(s)] == 'a'
+        old = hash(r)
+        r.searchElements(element_type=SPARQLParser.String)[0].updateWith('"b"')
+        assert hash(r) != old and parseQuery(str(r)) not in cache
+        assert r == parseQuery(s.replace('"a"', '"b"')) and hash(r) == hash(parseQuery(s.replace('"a"', '"b"')))
+        assert len({ParseArena(r).getView(), ParseArena(parseQuery(str(r))).getView()}) == 1
+
+    def testWeakParents(self):
+        s = 'PREFIX ex: <http://example.org/> SELECT ?s WHERE { ?s ex:p "a" FILTER (?s != ex:b) }'
+        # Trees have no reference cycles, and are freed without the cyclic garbage collector
+        gc.disable()
+        try:
+            r = parseQuery(s)
+            tree = weakref.ref(r)
+            var = r.searchElements(element_type=SPARQLParser.Var)[-1]
+            assert var.getParent().getParent() is var.getAncestors()[1] and var.getAncestors()[-1] is r
+            del r
+            assert tree() is None and str(var) == '?s'
+        finally:
+            gc.enable()
+        r = parseQuery(s, compact=True)
+        assert r.searchElements(element_type=SPARQLParser.Var)[-1].getAncestors()[-1] is r and r.hasParentPointers()
+        # Copies of an element get their own children, and have no parent
+        filter_ = r.searchElements(element_type=SPARQLParser.Filter)[0]
+        other = copy.deepcopy(filter_)
+        assert other == filter_ and other.getParent() is None and other.hasParentPointers()
+        assert other.searchElements(element_type=SPARQLParser.Var)[0].getAncestors()[-1] is other
+        assert copy.deepcopy(r).hasParentPointers() and copy.deepcopy(r).dump() == r.dump()
+
+    def testLocations(self):
+        s = 'PREFIX ex: <http://example.org/> SELECT ?s WHERE { ?s ex:p "a" FILTER (?o   !=  ex:b) # c\n }'
+        r = parseQuery(s, spans=True)
+        assert r.getLocation() == (0, len(r._source)) and r.getSourceText() == r._source
+        assert all(e.getSourceText() is not None for e in r.searchElements())
+        # The source text keeps the whitespace between the tokens, that str() normalizes
+        filter_ = r.searchElements(element_type=SPARQLParser.Filter)[0]
+        assert filter_.getSourceText() == 'FILTER (?o   !=  ex:b)' and str(filter_) == 'FILTER ( ?o != ex:b )'
+        start, end = filter_.getLocation()
+        assert r._source[start:end] == filter_.getSourceText()
+        assert r.searchElements(element_type=SPARQLParser.RelationalExpression)[0].getSourceText() == '?o   !=  ex:b'
+        var = r.searchElements(element_type=SPARQLParser.Var)[-1]
+        assert var.getSourceText() == '?o' and start < var.getLocation()[0] < var.getLocation()[1] < end
+        compact = parseQuery(s, spans=True, compact=True)
+        assert compact.searchElements(element_type=SPARQLParser.Filter)[0].getSourceText() == filter_.getSourceText()
+        assert copy.deepcopy(filter_).getLocation() == filter_.getLocation()
+        # Changing an element drops the locations of the element and its ancestors only
+        var.updateWith('?t')
+        assert var.getLocation() is None and filter_.getLocation() is None and r.getSourceText() is None
+        assert r.searchElements(element_type=SPARQLParser.Prologue)[0].getSourceText() == 'PREFIX ex:  <http://example.org/>'
+        assert parseQuery(s).getLocation() is None and parseQuery(s).searchElements(element_type=SPARQLParser.Var)[0].getSourceText() is None
+        # Terminals of which str() normalizes the whitespace have a location too
+        r = parseQuery('INSERT  DATA { <a:s> <a:p> (   ) }', spans=True)
+        assert [e.getSourceText() for e in r.searchElements(element_type=SPARQLParser.NIL)] == ['(   )']
+        assert r.searchElements(element_type=SPARQLParser.INSERT_DATA)[0].getSourceText() == 'INSERT  DATA'
+
+    def testIndex(self):
+        s = 'PREFIX ex: <http://example.org/> SELECT ?s WHERE { ?s ex:p "a" , ex:o . ?x a ex:c FILTER (?o != ex:b) } VALUES ?x { 1 }'
+        r = parseQuery(s)
+        # The post processing does not search the tree (see testVisitor), so the first search builds the index
+        assert r._index is None
+        r.searchElements(element_type=SPARQLParser.Var)
+        assert r._index is not None and r not in r._index.get(SPARQLParser.QueryUnit, [])
+        def walk(element):
+            return [element] + element._ParseStruct__getElements(labeledOnly=False)
+        def check(tree):
+            elements = walk(tree)
+            for key in {e.__class__ for e in elements} | {e._label for e in elements if e._label}:
+                found = tree.searchElements(element_type=key) if isinstance(key, type) else tree.searchElements(label=key)
+                expected = [e for e in elements if e.__class__ is key or e._label == key]
+                assert len(found) == len(expected) and all(f is e for f, e in zip(found, expected)), key
+        check(r)
+        # Changes drop the index, which is built again by the next search
+        r.expandIris()
+        assert r._index is None and not r.searchElements(element_type=SPARQLParser.PrefixedName) and r._index is not None
+        check(r)
+        iris = r.searchElements(element_type=SPARQLParser.IRIREF)
+        assert [str(i) for i in iris] == ['<http://example.org/>'] + ['<http://example.org/{}>'.format(n) for n in 'pocb']
+        pattern = r.searchElements(element_type=SPARQLParser.GroupGraphPattern)[0]
+        var = r.searchElements(element_type=SPARQLParser.Var)[1]
+        pattern.updateWith('{ ?a <a:q> ?b OPTIONAL { ?b <a:r> "x" } }')
+        assert r._index is None
+        check(r)
+        assert [str(v) for v in r.searchElements(element_type=SPARQLParser.Var)] == ['?s', '?a', '?b', '?b', '?x']
+        # An element that is no longer in the tree does not change it
+        var.updateWith('?z')
+        assert str(r).count('?z') == 0
+        check(r)
+        r.searchElements(element_type=SPARQLParser.Var)[0].setItems(['?t'])
+        assert r._index is None and r.searchElements(element_type=SPARQLParser.Var)[0] is r.searchElements(element_type=SPARQLParser.Var)[0]
+        check(r)
+        assert copy.deepcopy(r)._index is None
+        check(copy.deepcopy(r))
+        # Trees with compact or shared elements are not indexed
+        for tree in parseQuery(s, compact=True), parseQuery(s, shared=True):
+            assert tree._index is None and len(tree.searchElements(element_type=SPARQLParser.Var)) == 5 and tree._index is None
+
+    def testIterElements(self):
+        s = 'SELECT ?s WHERE { ?s ?p ?o { SELECT ?x WHERE { ?x ?q ?y SERVICE <a:s> { ?y ?r ?z } } } SERVICE <a:t> { ?s ?p ?v } }'
+        for r in parseQuery(s), parseQuery(s, compact=True), parseQuery(s, shared=True):
+            iterator = r.iterElements(element_type=SPARQLParser.Var)
+            assert next(iterator) is r.searchElements(element_type=SPARQLParser.Var)[0]
+            assert [str(e) for e in r.iterElements(element_type=SPARQLParser.Var)] == [str(e) for e in r.searchElements(element_type=SPARQLParser.Var)]
+            assert list(r.iterElements()) == r.searchElements()[1:] and list(r.iterElements(labeledOnly=True)) == r.searchElements(labeledOnly=True)
+            assert list(r.iterElements(element_type=SPARQLParser.Var, value='?y')) == r.searchElements(element_type=SPARQLParser.Var, value='?y')
+            # A pruned element is generated, but its descendants are not
+            subSelect = lambda e: isinstance(e, SPARQLParser.SubSelect)
+            assert [str(e) for e in r.iterElements(element_type=SPARQLParser.ServiceGraphPattern, prune=subSelect)] == ['SERVICE <a:t> { ?s ?p ?v }']
+            assert [str(e) for e in r.iterElements(element_type=SPARQLParser.Var, prune=subSelect)] == ['?s', '?s', '?p', '?o', '?s', '?p', '?v']
+            assert len(list(r.iterElements(element_type=SPARQLParser.SubSelect, prune=subSelect))) == 1
+            assert str(r.findFirst(element_type=SPARQLParser.GroupGraphPattern)).startswith('{ ?s ?p ?o {')
+            assert str(r.findFirst(element_type=SPARQLParser.ServiceGraphPattern)) == 'SERVICE <a:s> { ?y ?r ?z }'
+            assert r.findFirst(element_type=SPARQLParser.ServiceGraphPattern, prune=subSelect).getParent().getParent() is not None
+            assert r.findFirst(element_type=SPARQLParser.Filter) is None
+            assert r.findFirst(element_type=SPARQLParser.QueryUnit) is r
+            # The element itself is generated once, where searchElements lists it twice
+            assert list(r.iterElements(element_type=SPARQLParser.QueryUnit)) == [r] and r.searchElements(element_type=SPARQLParser.QueryUnit) == [r, r]
+        # The search stops at the first match
+        visited = []
+        def prune(element):
+            visited.append(element)
+            return False
+        r = parseQuery(s)
+        assert str(r.findFirst(element_type=SPARQLParser.Var, prune=prune)) == '?s' and len(visited) < len(r.searchElements()) // 10
+        # An element can be updated when it is generated
+        for var in r.iterElements(element_type=SPARQLParser.Var, value='?s'):
+            var.updateWith('?t')
+        assert str(r).count('?t') == 3 and r.hasParentPointers()
+
+    def testValueSearch(self):
+        s = 'PREFIX ex: <http://example.org/> SELECT ?s WHERE { ?s ex:p ?o , ex:p . ?o ?s "?s" FILTER (?o != ex:p) }'
+        r = parseQuery(s)
+        # The value is parsed once for every class of the elements it is compared with
+        parse = ParseStruct.__dict__['_parse']
+        parsed = []
+        def counted(cls, expr, **kwargs):
+            parsed.append(cls)
+            return parse.__func__(cls, expr, **kwargs)
+        ParseStruct._parse = classmethod(counted)
+        try:
+            found = r.searchElements(value='?s')
+            assert len(parsed) == len(set(parsed)) and SPARQLParser.Var in parsed
+            assert [e.__class__ for e in found if e.__class__ is SPARQLParser.Var] == [SPARQLParser.Var] * 3
+            del parsed[:]
+            found = r.searchElements(element_type=SPARQLParser.PrefixedName, value='ex:p')
+            assert parsed == [SPARQLParser.PrefixedName] and len(found) == 3
+            del parsed[:]
+            found = list(r.iterElements(element_type=SPARQLParser.PrefixedName, value='ex:p'))
+            assert parsed == [SPARQLParser.PrefixedName] and len(found) == 3
+            # A value that cannot be parsed as a class is not parsed again
+            del parsed[:]
+            assert r.searchElements(element_type=SPARQLParser.Var, value='ex:p') == [] and parsed == [SPARQLParser.Var]
+        finally:
+            ParseStruct._parse = parse
+        assert [str(e) for e in r.searchElements(element_type=SPARQLParser.Var, value='?s')] == ['?s'] * 3
+        assert r.searchElements(element_type=SPARQLParser.String, value='"?s"')[0].getAncestors()[-1] is r
+
+    def testSelector(self):
+        s = 'PREFIX ex: <http://example.org/> SELECT ?s WHERE { ?s ex:p "a"^^ex:t , ?o { SELECT ?x WHERE { ?x ?q ?y } } FILTER (?o != ex:b) }'
+        r = parseQuery(s)
+        assert [str(e) for e in r.select('SelectQuery > WhereClause GroupGraphPattern TriplesBlock')] == ['?s ex:p "a" ^^ ex:t , ?o', '?x ?q ?y']
+        assert [str(e) for e in r.select('SelectQuery > WhereClause > GroupGraphPattern > GroupGraphPatternSub > TriplesBlock')] == ['?s ex:p "a" ^^ ex:t , ?o']
+        assert [str(e) for e in r.select('iri[label=datatype_uri]')] == ['ex:t'] == [str(e) for e in r.select('[label=datatype_uri]')]
+        assert [str(e) for e in r.select('Var:not(:inside(SubSelect))')] == ['?s', '?s', '?o', '?o']
+        assert [str(e) for e in r.select('SubSelect Var, Filter Var')] == ['?x', '?x', '?q', '?y', '?o']
+        assert [str(e) for e in r.select("Var[text='?o'], Var[text=\"?o\"]")] == ['?o', '?o']
+        assert r.select('*:root') == [r] and r.select('Var') == r.searchElements(element_type=SPARQLParser.Var)
+        assert all(e.getLabel() for e in r.select('[label]')) and len(r.select('*')) == len(r.searchElements()) - 1
+        # The ancestors of the element a search starts from are taken into account
+        subSelect = r.select('SubSelect')[0]
+        assert [str(e) for e in subSelect.select('WhereClause Var')] == ['?x', '?x', '?q', '?y'] and subSelect.select('Var:not(:inside(SubSelect))') == []
+        assert [str(e) for e in subSelect.select('SubSelect > WhereClause Var')] == ['?x', '?q', '?y']
+        assert Selector('SubSelect Var').matches(subSelect.select('Var')[-1]) and not Selector('Filter Var').matches(subSelect.select('Var')[-1])
+        # Several selectors are matched in a single traversal
+        selectors = ['Var:not(:inside(SubSelect))', 'iri[label=datatype_uri]', 'Filter *', 'SubSelect Var, Filter Var']
+        assert SelectorSet(selectors).select(r) == [r.select(t) for t in selectors]
+        assert Selector.getSelector('Filter *') is Selector.getSelector('Filter *')
+        # Only the most recently used selectors given as strings are kept compiled
+        first = Selector.getSelector('Filter Var')
+        for n in range(_SELECTOR_CACHE_SIZE):
+            Selector.getSelector('Var[label=v{}]'.format(n))
+        assert Selector.getSelector('Filter Var') is not first
+        # Compact elements are only created where they can match
+        for tree in parseQuery(s, compact=True), parseQuery(s, shared=True):
+            assert [[str(e) for e in found] for found in SelectorSet(selectors).select(tree)] == [[str(e) for e in found] for found in SelectorSet(selectors).select(r)]
+        def chains(element):
+            if element._chain is not None:
+                return 1 + sum(chains(i) for i in element._chainItems if isinstance(i, ParseStruct))
+            return sum(chains(i) for i in element._items if isinstance(i, ParseStruct))
+        tree = parseQuery(s, compact=True)
+        before = chains(tree)
+        assert [str(e) for e in tree.select('Filter Var')] == ['?o']
+        assert 0 < chains(tree) < before
+        for text in '', 'Var >', 'Var[', ':foo', 'Var:not(', 'A ~ B', 'Var[label]x', 'Var[size=1]':
+            self.assertRaises(SelectorException, Selector, text)
+        # Selectors work for any language defined with a Parser
+        toy = Parser()
+        Atom = Group(Word(alphas)).setName('Atom')
+        toy.addElement(Atom)
+        List = Forward().setName('List')
+        toy.addElement(List)
+        Item = Group(Atom | List).setName('Item')
+        toy.addElement(Item)
+        List << Group(Literal('(') + ZeroOrMore(Item) + Literal(')'))
+        r = toy.List('(a (b (c)) d)')
+        assert [str(e) for e in r.select('List > Item > Atom')] == ['a', 'b', 'c', 'd']
+        assert [str(e) for e in r.select('List List Atom')] == ['b', 'c'] and [str(e) for e in r.select('Atom:not(:inside(List List))')] == ['a', 'd']
+
+    def testVisitor(self):
+        s = 'PREFIX ex: <http://example.org/> SELECT ?s WHERE { ?s ex:p "a\\tb" , ?o { SELECT ?x WHERE { ?x ?q \'c\' } } FILTER (?o != <b:c>) }'
+        r = parseQuery(s)
+        found = []
+        vars_ = Visitor([(SPARQLParser.Var, lambda e: found.append(('var', str(e))))])
+        @vars_.register(SPARQLParser.Var)
+        def second(e):
+            found.append(('again', str(e)))
+        iris = Visitor()
+        iris.register(SPARQLParser.iri, lambda e: found.append(('iri', str(e))))
+        # Handlers are called in preorder, and at each element in the order of the visitors and of their registration
+        VisitorSet([iris, vars_]).visit(r)
+        assert found == [(k, str(e)) for e in r.iterElements() for k in ('iri', 'var', 'again') 
+                         if e.__class__ == {'iri': SPARQLParser.iri, 'var': SPARQLParser.Var, 'again': SPARQLParser.Var}[k]]
+        assert [v for k, v in found if k == 'var'] == [str(e) for e in r.searchElements(element_type=SPARQLParser.Var)]
+        assert vars_.getClasses() == [SPARQLParser.Var] and len(vars_.getHandlers(SPARQLParser.Var)) == 2 and not iris.getHandlers(SPARQLParser.Var)
+        # Handlers are registered for a class itself, not for its superclasses
+        found = []
+        Visitor([(ParseStruct, found.append), (SPARQLParser.__class__, found.append)]).visit(r)
+        assert found == []
+        # The post processing of parseQuery is done in a single traversal, which visits every element once
+        calls = []
+        searchItems = ParseStruct.__dict__['_searchItems']
+        ParseStruct._searchItems = lambda self, keep: calls.append(self) or searchItems(self, keep)
+        try:
+            r = parseQuery(s)
+        finally:
+            ParseStruct._searchItems = searchItems
+        assert len(calls) == len(set(map(id, calls))) == len(list(r.iterElements()))
+        assert [str(e) for e in r.searchElements(element_type=SPARQLParser.STRING_LITERAL2)] == ['"a\tb"']
+        assert [str(e) for e in r.searchElements(element_type=SPARQLParser.STRING_LITERAL1)] == ["'c'"]
+        self.assertRaises(AssertionError, parseQuery, 'PREFIX ex: <http://example.org/> SELECT * { ?s ex:p <a:b#c#d> }')
+        # A handler can update its element, after which the new descendants are visited
+        r.expandIris()
+        assert [str(e) for e in r.searchElements(element_type=SPARQLParser.iri)] == ['<http://example.org/p>', '<b:c>']
+        # Compact and shared elements are only created where there are handlers
+        for tree in parseQuery(s, compact=True), parseQuery(s, shared=True):
+            found = []
+            Visitor([(SPARQLParser.Var, lambda e: found.append(str(e)))]).visit(tree)
+            assert found == [str(e) for e in r.searchElements(element_type=SPARQLParser.Var)]
+        tree = parseQuery(s, compact=True)
+        found = []
+        Visitor([(SPARQLParser.SubSelect, found.append)]).visit(tree)
+        assert [str(e) for e in found] == ['SELECT ?x WHERE { ?x ?q \'c\' }']
+        assert any(e.isCompact() for e in tree.iterElements(prune=lambda e: e.isCompact()))
+
+    def testGenerated(self):
+        queries = ['PREFIX ex: <http://example.org/> SELECT ?s (COUNT(?o) AS ?n) WHERE { ?s ex:p/ex:q* ?o FILTER (?o > 2 || STRLEN(STR(?o)) < 4) } GROUP BY ?s',
+                   'BASE <work:22?> SELECT REDUCED $var1 ?var2 (("*Expression*") AS $var3) { SELECT * {} } GROUP BY ROUND ( "*Expression*") VALUES $S { <t:testIri> <t:testIri> }',
+                   'BASE <prologue:22> PREFIX prologue: <prologue:33> LOAD <t:testIri> ; BASE <prologue2:42> PREFIX prologue2: <prologue3:33>',
+                   'ASK { ?s <a:p> [ <a:p> "x"@en, -1.5 ; <a:q> ( ?x _:b1 ) ] OPTIONAL { ?x <a:r>? ?y } MINUS { ?y ^<a:s>|!(<a:t>) ?z } }']
+        expected = [parseQuery(s).dump() for s in queries]
+        with tempfile.TemporaryDirectory() as cachedir:
+            assert not SPARQLParser.getGenerated()
+            SPARQLParser.setGenerated(True, cachedir=cachedir)
+            try:
+                assert [parseQuery(s).dump() for s in queries] == expected
+                assert len(os.listdir(cachedir)) == 1
+                self.assertRaises(ParseException, SPARQLParser.GraphTerm, '?x', postParseCheck=False)
+                self.assertRaises(ParseException, SPARQLParser.Var, '?x ?y', postParseCheck=False)
+                # Parse errors are reported at the furthest location where a terminal failed to match
+                for class_, s, loc in [(SPARQLParser.GroupGraphPattern, '{ ?s <a:p> "x }', 11), (SPARQLParser.GroupGraphPattern, '{ ?s ?p ?o FILTER (?o > ) }', 22),
+                                       (SPARQLParser.Var, '?x ?y', 3)]:
+                    with self.assertRaises(ParseException) as context:
+                        class_(s, postParseCheck=False)
+                    assert context.exception.loc == loc
+                r = parseQuery(queries[0])
+                r.searchElements(element_type=SPARQLParser.Var)[0].updateWith('?t')
+                assert str(r.searchElements(element_type=SPARQLParser.SelectClause)[0]) == 'SELECT ?t ( COUNT ( ?o ) AS ?n )'
+                # The generated module is loaded from the cache, with the same grammar fingerprint
+                module = os.listdir(cachedir)[0]
+                SPARQLParser.setGenerated(True, cachedir=cachedir)
+                assert parseQuery(queries[1]).dump() == expected[1]
+                assert os.listdir(cachedir) == [module]
+                assert grammarFingerprint(SPARQLParser) in open(os.path.join(cachedir, module)).read()
+                self.assertRaises(ParseTimeoutError, parseQuery, queries[0], timeout=-1)
+                r = parseQuery(queries[0], spans=True)
+                assert r.dump() == expected[0] and isinstance(r.searchElements(element_type=SPARQLParser.Var)[0].descend()._items[0], int)
+                assert [parseQuery(s, shared=True).dump() for s in queries] == expected
+            finally:
+                SPARQLParser.setGenerated(False)
+        # No temporary file is left behind in the cache directory if generating the module fails
+        with tempfile.TemporaryDirectory() as cachedir:
+            with unittest.mock.patch.object(_Generator, 'generate', side_effect=GeneratorException('failed')):
+                self.assertRaises(GeneratorException, loadParser, SPARQLParser, cachedir)
+            assert os.listdir(cachedir) == []
+
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']